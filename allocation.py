@@ -0,0 +1,50 @@
+# ロットの自動割り当て (FEFO / FIFO)
+#
+# 必要な数量を、賞味期限が近いロットから順に割り当てる (First Expired, First Out)。
+# 賞味期限のないロットはその後に入荷日の古い順 (FIFO) で割り当てる。
+# 1つのロットで足りない場合は複数のロットに分けて割り当てる。
+#
+# 同じトランザクションの中で何度も割り当てる場合 (まとめて製造など) に備えて、
+# ロットの一覧は商品ごとに1回だけ読み込み、残量はメモリ上で管理する。
+# 賞味期限が切れたロット (available = 0, expiry.py) は割り当てない。
+
+
+class Allocator:
+    def __init__(self, conn):
+        self.conn = conn
+        self._lots = {}  # (商品名, 質量/体積) -> [[id, lot_number, unit, 残量], ...] (割り当てる順)
+
+    def _candidates(self, product_name, dimension):
+        key = (product_name, dimension)
+        if key not in self._lots:
+            # 賞味期限のあるロット (期限の近い順) -> 期限のないロット (入荷日の古い順)
+            # どちらも idx_inventory_fefo / idx_inventory_fifo を使うのでテーブル全体は読まない
+            expiring = self.conn.execute('''
+                SELECT i.id, i.lot_number, i.unit, i.quantity_base
+                FROM inventory i JOIN units u ON u.unit = i.unit
+                WHERE i.product_name = ? AND i.expiration_date IS NOT NULL
+                  AND u.dimension = ? AND i.quantity_base > 0 AND i.available = 1
+                ORDER BY i.expiration_date, i.received_date, i.id''', key).fetchall()
+            undated = self.conn.execute('''
+                SELECT i.id, i.lot_number, i.unit, i.quantity_base
+                FROM inventory i JOIN units u ON u.unit = i.unit
+                WHERE i.product_name = ? AND i.expiration_date IS NULL
+                  AND u.dimension = ? AND i.quantity_base > 0 AND i.available = 1
+                ORDER BY i.received_date, i.id''', key).fetchall()
+            self._lots[key] = [list(row) for row in expiring + undated]
+        return self._lots[key]
+
+    # needed (基本単位) を割り当てる
+    # 戻り値は ([(inventory_id, lot_number, unit, 使用量), ...], 不足分)
+    def allocate(self, product_name, dimension, needed):
+        picks = []
+        for lot in self._candidates(product_name, dimension):
+            if needed <= 0:
+                break
+            if lot[3] <= 0:
+                continue
+            used = min(needed, lot[3])
+            lot[3] -= used
+            needed -= used
+            picks.append((lot[0], lot[1], lot[2], used))
+        return picks, max(needed, 0)
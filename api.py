@@ -0,0 +1,217 @@
+# JSON の読み込み用API (/api/v1/...)
+#
+# 全てのエンドポイントで以下に対応:
+#   fields   返すフィールドをカンマ区切りで指定 (例: fields=product_name,quantity)
+#   after    前のレスポンスの "next" の値を渡すと次のページを返す
+#   limit    1ページの件数 (最大 MAX_LIMIT)
+# ETag / Last-Modified はテーブルの変更カウンター (data_versions) から作るので、
+# データが変わっていなければデータを読み込まずに304を返す。
+import hashlib
+from datetime import datetime, timezone
+from flask import Blueprint, current_app, jsonify, request
+import capacity
+import db
+import expiry
+import ledger
+import stock
+import units
+from db import get_db
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+MAX_SERIES_POINTS = 5000
+SERIES_BUCKETS = ['auto', 'raw'] + list(ledger.ROLLUP_PERIODS)
+
+INVENTORY_FIELDS = ['id', 'product_name', 'lot_number', 'quantity', 'unit', 'quantity_base',
+                    'received_date', 'expiration_date', 'receipt_file']
+RECIPE_FIELDS = ['id', 'drink_name', 'ingredients']
+MANUFACTURE_FIELDS = ['id', 'drink_name', 'manufacture_date', 'expiration_date', 'quantity', 'unit']
+HISTORY_FIELDS = ['id', 'action_type', 'details', 'timestamp']
+
+
+# fields パラメータから返すフィールドを決める (id は常に含める)
+def _fields(allowed):
+    requested = request.args.get('fields')
+    if not requested:
+        return allowed
+    names = [name.strip() for name in requested.split(',')]
+    return ['id'] + [name for name in allowed if name in names and name != 'id']
+
+
+def _limit():
+    return min(max(request.args.get('limit', DEFAULT_LIMIT, type=int), 1), MAX_LIMIT)
+
+
+# 変更がなければ304を返す。変更があれば body() の結果をJSONで返す
+# daily=True の場合は日付が変わるとデータが変わらなくても結果が変わるものとして扱う
+def _conditional(tables, body, daily=False):
+    versions, updated_at = db.data_versions(get_db(), tables)
+    last_modified = (datetime.strptime(updated_at, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+                     if updated_at else None)
+    if daily:
+        today = datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+        versions += (today.date().isoformat(),)
+        last_modified = max(last_modified, today) if last_modified else today
+    etag = hashlib.sha1(f'{request.full_path}:{versions}'.encode('utf-8')).hexdigest()
+
+    not_modified = request.if_none_match.contains(etag) or (
+        not request.if_none_match and last_modified and request.if_modified_since
+        and last_modified <= request.if_modified_since)
+    if not_modified:
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(body())
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
+def _page(table, fields, where='', params=(), newest_first=False):
+    columns = ', '.join(fields)
+    rows, next_cursor, prev_cursor = db.keyset_page(
+        get_db(), table, columns=columns, where=where, params=params,
+        after=request.args.get('after', type=int), page_size=_limit(), newest_first=newest_first)
+    return {'data': [dict(zip(fields, row)) for row in rows], 'next': next_cursor}
+
+
+# product, lot で絞り込みできる
+@bp.route('/inventory')
+def inventory():
+    fields = _fields(INVENTORY_FIELDS)
+    conditions = []
+    params = []
+    if request.args.get('product'):
+        conditions.append('product_name = ?')
+        params.append(request.args['product'])
+    if request.args.get('lot'):
+        conditions.append('lot_number = ?')
+        params.append(request.args['lot'])
+    return _conditional(['inventory'], lambda: _page('inventory', fields, ' AND '.join(conditions), params))
+
+
+# 存在しないIDは404
+@bp.route('/inventory/<int:id>')
+def inventory_item(id):
+    fields = _fields(INVENTORY_FIELDS)
+    if get_db().execute("SELECT 1 FROM inventory WHERE id = ?", (id,)).fetchone() is None:
+        return jsonify({'error': 'not found'}), 404
+
+    def body():
+        row = get_db().execute(f"SELECT {', '.join(fields)} FROM inventory WHERE id = ?", (id,)).fetchone()
+        return {'data': dict(zip(fields, row)) if row else None}
+    return _conditional(['inventory'], body)
+
+
+# レシピと材料を1つのクエリで取得する
+@bp.route('/recipes')
+def recipes():
+    fields = _fields(RECIPE_FIELDS)
+    limit = _limit()
+    after = request.args.get('after', 0, type=int)
+
+    def body():
+        rows = get_db().execute('''
+            SELECT r.id, r.drink_name, i.ingredient_name, i.quantity, i.unit, i.quantity_base
+            FROM (SELECT id, drink_name FROM recipes WHERE id > ? ORDER BY id LIMIT ?) r
+            LEFT JOIN ingredients i ON i.recipe_id = r.id
+            ORDER BY r.id, i.id''', (after, limit + 1)).fetchall()
+
+        data = []
+        for recipe_id, drink_name, ingredient_name, quantity, unit, quantity_base in rows:
+            if not data or data[-1]['id'] != recipe_id:
+                data.append({'id': recipe_id, 'drink_name': drink_name, 'ingredients': []})
+            if ingredient_name is not None:
+                data[-1]['ingredients'].append({'ingredient_name': ingredient_name, 'quantity': quantity,
+                                                'unit': unit, 'quantity_base': quantity_base})
+        next_cursor = None
+        if len(data) > limit:
+            data = data[:limit]
+            next_cursor = data[-1]['id']
+        return {'data': [{name: recipe[name] for name in fields} for recipe in data], 'next': next_cursor}
+    return _conditional(['recipes', 'ingredients'], body)
+
+
+@bp.route('/manufactures')
+def manufactures():
+    fields = _fields(MANUFACTURE_FIELDS)
+    return _conditional(['manufactures'], lambda: _page('manufactures', fields, newest_first=True))
+
+
+@bp.route('/history')
+def history():
+    fields = _fields(HISTORY_FIELDS)
+    return _conditional(['history'], lambda: _page('history', fields, newest_first=True))
+
+
+# レシピごとの最大バッチ数と足りなくなる材料 (mix=1 で在庫を共有した組み合わせも返す)
+@bp.route('/capacity')
+def capacity_plan():
+    def body():
+        matrix = capacity.get_matrix(get_db())
+        result = {'recipes': capacity.max_batches(matrix)}
+        if request.args.get('mix', type=int) == 1:
+            result['mix'] = capacity.plan_mix(matrix)
+        return result
+    return _conditional(capacity.TABLES, body)
+
+
+# 発注点以下の商品 (all=1 で発注点が設定されている全商品)
+@bp.route('/low_stock')
+def low_stock():
+    low_only = request.args.get('all', type=int) != 1
+    return _conditional(['inventory', 'reorder_points'],
+                        lambda: {'data': stock.reorder_status(get_db(), low_only=low_only)})
+
+
+# 確認されていない在庫不足のアラート (新しい順)
+@bp.route('/alerts')
+def alerts():
+    return _conditional(['stock_alerts'], lambda: {'data': stock.open_alerts(get_db(), _limit())})
+
+
+# days 日以内に賞味期限が切れる在庫と製品
+@bp.route('/expiring')
+def expiring():
+    days = min(max(request.args.get('days', expiry.DEFAULT_DAYS, type=int), 0), 3650)
+    return _conditional(['inventory', 'manufactures'], lambda: expiry.expiring(get_db(), days), daily=True)
+
+
+# 商品と質量/体積ごとの在庫の合計 (在庫のグラフ用)
+@bp.route('/inventory_totals')
+def inventory_totals():
+    return _conditional(['inventory'], lambda: {'data': stock.totals(get_db())})
+
+
+# 商品の残高の推移 (在庫推移のグラフ用)。列ごとの配列で返す
+#   start, end   期間 ('YYYY-MM-DD' または 'YYYY-MM-DD HH:MM:SS', UTC)
+#   bucket       auto (期間の長さから選ぶ) / raw (台帳の行) / day / week / month
+#   max_points   点の最大数 (これより多ければ LTTB で間引く)
+# timestamps は UNIX 時間 (秒)、balances は unit の単位
+@bp.route('/inventory_history/<product_name>')
+def inventory_history(product_name):
+    bucket = request.args.get('bucket', 'auto')
+    if bucket not in SERIES_BUCKETS:
+        return jsonify({'error': f"bucket must be one of {', '.join(SERIES_BUCKETS)}"}), 400
+    try:
+        start, end = ledger.normalize_range(request.args.get('start'), request.args.get('end'))
+    except ValueError:
+        return jsonify({'error': 'start and end must be YYYY-MM-DD or YYYY-MM-DD HH:MM:SS'}), 400
+    max_points = min(max(request.args.get('max_points', ledger.MAX_POINTS, type=int), 3), MAX_SERIES_POINTS)
+
+    def body():
+        conn = get_db()
+        timestamps, balances, period = ledger.history_series(conn, product_name, start, end, max_points,
+                                                             None if bucket == 'auto' else bucket)
+        unit = ledger.display_unit(conn, product_name)
+        if unit:
+            balances = units.from_base_many(balances, unit)
+        return {'product_name': product_name, 'unit': unit, 'bucket': period or 'raw', 'start': start, 'end': end,
+                'timestamps': [int(datetime.fromisoformat(timestamp).replace(tzinfo=timezone.utc).timestamp())
+                               for timestamp in timestamps],
+                'balances': [round(balance, 3) for balance in balances]}
+    return _conditional(['stock_movements'], body)
+
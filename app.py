@@ -1,249 +1,272 @@
-from flask import Flask, request, redirect, url_for, send_from_directory, render_template
-import sqlite3
+from flask import Blueprint, Flask, current_app, g, request, redirect, url_for, send_from_directory, render_template, jsonify
 import os
-from werkzeug.utils import secure_filename
-import matplotlib.pyplot as plt
-import io
-import base64
+import hashlib
+import logging
+import json
+import math
+import uuid
+import api
+import audit
+import charts
+import db
+from db import get_db
+from search import search_inventory
+import ledger
+import units
+import manufacturing
+from allocation import Allocator
+from dates import normalize_date
+import imports
+import receipts
+import fragments
+import stock
+import expiry
+import jobs
+import metrics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-app = Flask(__name__)
+# Upload folder configuration
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}  # 許可するファイル形式
 
-# デバッグ用にデータベースのパスを出力
-database_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inventory.db')
-print(f"Database path: {database_path}")
+DEFAULT_CONFIG = {
+    'DATABASE': os.path.join(BASE_DIR, 'inventory.db'),
+    'UPLOAD_FOLDER': os.path.join(BASE_DIR, 'uploads'),  # アップロードフォルダの場所
+    'PAGE_SIZE': 50,                  # 一覧ページの1ページあたりの件数
+    'START_BACKGROUND_THREADS': True,  # ジョブキュー・期限切れの確認・履歴の書き込みのスレッドを起動する
+    'PRECOMPILE_TEMPLATES': True,      # テンプレートを起動時にまとめてコンパイルする
+    'PROFILING': False,                # True の場合 ?profile=1 のリクエストを cProfile で計測する (metrics.py)
+}
 
+bp = Blueprint('main', __name__)
 
-# Upload folder configuration
-UPLOAD_FOLDER = 'uploads/'  # アップロードフォルダの場所
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}  # 許可するファイル形式
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# アプリケーションを作成する。config で DEFAULT_CONFIG の値を上書きできる
+# (import しただけではデータベースやスレッドには触らない)
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    if config:
+        app.config.update(config)
+    app.logger.info('Database path: %s', app.config['DATABASE'])
+
+    # アップロードフォルダが存在しない場合、作成
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    # 全てのルートで共有するコネクションプールの設定
+    db.init_app(app)
+
+    # ルートごとのレイテンシと SQL の計測 (/metrics)
+    metrics.init_app(app)
+
+    # データベースのスキーマを最新にする (PRAGMA user_version が最新なら何もしない)
+    db.migrate(app.config['DATABASE'])
+
+    # 履歴はキューに入れて書き込みスレッドがまとめて追加する
+    audit.init_app(app, start=app.config['START_BACKGROUND_THREADS'])
+
+    app.register_blueprint(bp)
+    # JSON API (/api/v1/...)
+    app.register_blueprint(api.bp)
+
+    # バックグラウンドジョブ (/jobs/...)
+    jobs.init_app(app, start=app.config['START_BACKGROUND_THREADS'])
+
+    # 期限切れの在庫・製品を定期的に利用できないようにする
+    if app.config['START_BACKGROUND_THREADS']:
+        expiry.start_sweeper(app)
+
+    # テンプレートは起動時にまとめてコンパイルしておく (最初のリクエストでコンパイルしない)
+    if app.config['PRECOMPILE_TEMPLATES']:
+        for template_name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(template_name)
+    return app
 
-# アップロードフォルダが存在しない場合、作成
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
 
 # ファイルの拡張子をチェックする関数を定義
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 # ファイル提供用のルート
-@app.route('/uploads/<filename>')
+# 内容のハッシュで保存したファイルは変更されないので1年間キャッシュさせる (Range リクエストにも対応)
+@bp.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    if receipts.is_stored_name(filename):
+        response = send_from_directory(current_app.config['UPLOAD_FOLDER'], filename, max_age=31536000)
+        response.cache_control.immutable = True
+        return response
+    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
 
 
-# データベース初期化関数
-def init_db():
-    database_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inventory.db')
-    conn = sqlite3.connect(database_path)
-    c = conn.cursor()
+# サムネイル (receipts.py がバックグラウンドで作る)
+@bp.route('/uploads/thumbs/<filename>')
+def uploaded_thumbnail(filename):
+    response = send_from_directory(os.path.join(current_app.config['UPLOAD_FOLDER'], receipts.THUMBNAIL_FOLDER),
+                                   filename, max_age=31536000)
+    response.cache_control.immutable = True
+    return response
 
-    # Inventory テーブルの作成
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS inventory (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        product_name TEXT NOT NULL,
-        lot_number TEXT NOT NULL,
-        quantity INTEGER NOT NULL,
-        unit TEXT NOT NULL,
-        received_date TEXT NOT NULL
-    )''')
-
-    # `receipt_file` カラムがない場合に追加
-    c.execute('''PRAGMA table_info(inventory)''')
-    columns = [col[1] for col in c.fetchall()]
-    if 'receipt_file' not in columns:
-        c.execute('ALTER TABLE inventory ADD COLUMN receipt_file TEXT')
-
-    # Recipes テーブルの作成
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS recipes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        drink_name TEXT NOT NULL
-    )''')
-
-    # Ingredients テーブルの作成
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS ingredients (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        recipe_id INTEGER NOT NULL,
-        ingredient_name TEXT NOT NULL,
-        quantity INTEGER NOT NULL,
-        unit TEXT NOT NULL
-    )''')
-
-    # Manufactures テーブルの作成
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS manufactures (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        drink_name TEXT NOT NULL,
-        manufacture_date TEXT NOT NULL,
-        expiration_date TEXT NOT NULL,
-        quantity REAL NOT NULL,
-        unit TEXT NOT NULL
-    )''')
-
-    # History テーブルの作成
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        action_type TEXT NOT NULL,
-        details TEXT NOT NULL,
-        timestamp TEXT NOT NULL
-    )''')
-
-    conn.commit()
-    conn.close()
 
-# Flaskアプリケーション開始前にデータベースを初期化する
-init_db()
+# 前後のページへのURL (macros.html の pager に渡す)
+def page_links(endpoint, next_cursor, prev_cursor, **args):
+    return {'prev_url': url_for(endpoint, before=prev_cursor, **args) if prev_cursor is not None else None,
+            'next_url': url_for(endpoint, after=next_cursor, **args) if next_cursor is not None else None}
 
 
-@app.route('/', methods=['GET', 'POST'])
+@bp.route('/', methods=['GET', 'POST'])
 def home():
-    database_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inventory.db')
-    print("Database path:", database_path)  # デバッグ用
-    conn = sqlite3.connect('inventory.db')
+    conn = get_db()
     c = conn.cursor()
 
-    query = "SELECT * FROM inventory"
-    search_term = ""
+    # 検索語はフォーム(POST)とページ送りのリンク(GET)のどちらからも受け取る
+    search_term = request.values.get('search', '').strip()
+    if search_term:
+        # 検索結果は関連度順なのでページ番号でページ送りする
+        page = max(request.args.get('page', 1, type=int), 1)
+        inventory, has_next = search_inventory(conn, search_term, page, current_app.config['PAGE_SIZE'])
+        pager = {'prev_url': url_for('main.home', search=search_term, page=page - 1) if page > 1 else None,
+                 'next_url': url_for('main.home', search=search_term, page=page + 1) if has_next else None}
+    else:
+        inventory, next_cursor, prev_cursor = db.keyset_page(
+            conn, 'inventory',
+            after=request.args.get('after', type=int), before=request.args.get('before', type=int),
+            page_size=current_app.config['PAGE_SIZE'])
+        pager = page_links('main.home', next_cursor, prev_cursor)
+
+    # 最新5件の履歴を取得
+    c.execute("SELECT * FROM history ORDER BY timestamp DESC LIMIT 5")
+    history = c.fetchall()
+    current_app.logger.debug('Recent history: %s', history)
 
+    # 行のHTMLは内容が変わった行だけ描画する
+    return render_template('home.html', search_term=search_term, inventory_rows=fragments.inventory_rows.render(inventory),
+                           pages=pager, history=history, low_stock=stock.low_stock(conn), alerts=stock.open_alerts(conn, 10))
+
+
+# days 日以内に賞味期限が切れる在庫と製品
+@bp.route('/expiring')
+def expiring():
+    days = min(max(request.args.get('days', expiry.DEFAULT_DAYS, type=int), 0), 3650)
+    return render_template('expiring.html', days=days, **expiry.expiring(get_db(), days))
+
+
+# 発注点・安全在庫の一覧と設定
+@bp.route('/reorder_points', methods=['GET', 'POST'])
+def reorder_points():
+    conn = get_db()
     if request.method == 'POST':
-        search_term = request.form['search']
-        query += " WHERE product_name LIKE ? OR lot_number LIKE ?"
-        c.execute(query, ('%' + search_term + '%', '%' + search_term + '%'))
-    else:
-        print("Executing query:", query)
-        c.execute(query)
+        product_name = request.form['product_name'].strip()
+        if not product_name:
+            return "Error: Product name is required.", 400
+        try:
+            reorder_point = float(request.form['reorder_point'])
+            safety_stock = float(request.form.get('safety_stock') or 0)
+            stock.set_reorder_point(conn, product_name, reorder_point, safety_stock, request.form['unit'])
+        except ValueError as e:
+            return f"Error: {e}", 400
+        conn.commit()
+        audit.record('Set Reorder Point', f"Set reorder point of {product_name} to {reorder_point} {request.form['unit']}, "
+                                          f"safety stock {safety_stock} {request.form['unit']}")
+        return redirect(url_for('main.reorder_points'))
 
-    inventory = c.fetchall()
+    products = [row[0] for row in conn.execute("SELECT product_name FROM stock_on_hand ORDER BY product_name")]
+    return render_template('reorder_points.html', status=stock.reorder_status(conn), products=products)
 
 
+@bp.route('/reorder_points/delete', methods=['POST'])
+def delete_reorder_point():
+    conn = get_db()
+    stock.delete_reorder_point(conn, request.form['product_name'], request.form['dimension'])
+    conn.commit()
+    audit.record('Delete Reorder Point', f"Removed reorder point of {request.form['product_name']} ({request.form['dimension']})")
+    return redirect(url_for('main.reorder_points'))
 
-    # 最新5件の履歴を取得
-    c.execute("SELECT * FROM history ORDER BY timestamp DESC LIMIT 5")
-    history = c.fetchall()
-    print(history)  # デバッグ用に履歴の内容を出力
-
-    history_list = ''
-    for entry in history:
-        # 'timestamp'から日付のみを取り出す（YYYY-MM-DD形式）
-        timestamp = entry[3][:10]
-        history_list += f'<p>{entry[1]}: {entry[2]} on {timestamp}</p>'
-
-    conn.close()
-
-    inventory_list = ''
-    for item in inventory:
-        inventory_list += f'<p>{item[1]} (Lot: {item[2]}), Quantity: {item[3]} {item[4]}, Received Date: {item[5]} <a href="/edit/{item[0]}">Edit</a></p>'
-        inventory_list += f'<form action="/delete/{item[0]}" method="post" style="display:inline;"><button type="submit">Delete</button></form>'
-
-    history_list = ''
-    for entry in history:
-        history_list += f'<p>{entry[1]}: {entry[2]} at {entry[3]}</p>'
-
-    return f'''
-        <h1>Shroomworks Inventory System</h1>
-        <form method="post">
-            Search: <input type="text" name="search" value="{search_term}">
-            <input type="submit" value="Search">
-        </form>
-        {inventory_list}
-        <a href="/add">Add Inventory</a><br>
-        <a href="/manufacture/{{ recipe_id }}">Manufacture Products</a>
-        <a href="/inventory_chart">View Inventory Chart</a><br>
-        <a href="/view_recipes">Manage Recipes</a><br>
-        
-        <h2>History</h2>
-        {history_list}
-        <a href="/more_history">More History</a>
-        
-        <!-- CSVエクスポートのボタンを追加 -->
-        <h2>Export Data</h2>
-        <a href="/export_inventory"><button>Export Inventory to CSV</button></a><br>
-        <a href="/export_recipes"><button>Export Recipes to CSV</button></a><br>
-
-    '''
-
-@app.route('/add', methods=['GET', 'POST'])
+
+@bp.route('/alerts/<int:alert_id>/acknowledge', methods=['POST'])
+def acknowledge_alert(alert_id):
+    conn = get_db()
+    if stock.acknowledge(conn, alert_id):
+        conn.commit()
+        audit.record('Acknowledge Alert', f"Acknowledged stock alert {alert_id}")
+    return redirect(url_for('main.home'))
+
+
+# 在庫を変更するリクエストの後に、トリガーが追加した在庫不足のアラートをログに出力する
+# 失敗したリクエストの接続には未コミットの変更が残っていることがあるので、プールの別の接続を使う
+# (変更が残っている場合は書き込みのロックを持っているので何もしない。変更は close_db() で破棄される)
+@bp.after_app_request
+def notify_stock_alerts(response):
+    if request.method != 'GET' and 'db' in g and not g.db.in_transaction:
+        pool = db.get_pool()
+        conn = pool.acquire()
+        try:
+            stock.notify(conn)
+        finally:
+            pool.release(conn)
+    return response
+
+
+# 履歴の一覧 (新しい順にページ送り)
+@bp.route('/more_history')
+def more_history():
+    conn = get_db()
+    history, next_cursor, prev_cursor = db.keyset_page(
+        conn, 'history', newest_first=True,
+        after=request.args.get('after', type=int), before=request.args.get('before', type=int),
+        page_size=current_app.config['PAGE_SIZE'])
+
+    return render_template('history.html', history=history,
+                           pages=page_links('main.more_history', next_cursor, prev_cursor))
+
+
+@bp.route('/add', methods=['GET', 'POST'])
 def add_inventory():
     if request.method == 'POST':
         product_name = request.form['product_name']
         lot_number = request.form['lot_number']
 
-        # ファイルがリクエストにあるか確認
-        if 'file' not in request.files or request.files['file'].filename == '':
-            filename = None  # ファイルがない場合はNoneに設定
-        else:
-            file = request.files['file']
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)  # ファイル名の安全性を確保
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))  # ファイルを保存
-
         # Quantityの入力処理
         unit = request.form['unit']
-        if unit == 'lbs_oz':
-            quantity_lbs = int(request.form.get('quantity_lbs', 0))
-            quantity_oz = int(request.form.get('quantity_oz', 0))
-            quantity = (quantity_lbs * 16) + quantity_oz
-        else:
-            quantity = float(request.form['quantity'])
-
-        received_date = request.form['received_date']
+        try:
+            if unit == 'lbs_oz':
+                quantity_lbs = float(request.form.get('quantity_lbs') or 0)
+                quantity_oz = float(request.form.get('quantity_oz') or 0)
+                quantity = (quantity_lbs * 16) + quantity_oz
+            else:
+                quantity = float(request.form['quantity'])
+        except ValueError:
+            return "Error: Invalid quantity.", 400
+
+        received_date = normalize_date(request.form['received_date'])
+        expiration_date = normalize_date(request.form.get('expiration_date'))  # 任意
+
+        # 基本単位 (mg / µl) に変換して保存
+        if not units.is_valid(unit):
+            return "Error: Unknown unit.", 400
+        try:
+            quantity_base = units.to_base(quantity, unit)
+        except ValueError:
+            return "Error: Invalid quantity.", 400
+
+        # ファイルがリクエストにあるか確認 (入力の確認が終わってから保存する)
+        filename = None  # ファイルがない場合はNoneに設定
+        if 'file' in request.files and request.files['file'].filename != '':
+            file = request.files['file']
+            if file and allowed_file(file.filename):
+                filename = receipts.store(get_db(), file, current_app.config['UPLOAD_FOLDER'])  # 内容のハッシュの名前で保存
 
-        conn = sqlite3.connect('inventory.db')
+        conn = get_db()
         c = conn.cursor()
-        c.execute("INSERT INTO inventory (product_name, lot_number, quantity, unit, received_date, receipt_file) VALUES (?, ?, ?, ?, ?, ?)",
-                  (product_name, lot_number, quantity, unit, received_date,  filename))
-        
-         # History に記録を追加
-        action_details = f"Added {quantity} {unit} of {product_name} (Lot: {lot_number}) on {received_date}"
-        c.execute("INSERT INTO history (action_type, details, timestamp) VALUES (?, ?, datetime('now'))",
-                  ('Add Inventory', action_details))
-        
+        c.execute("INSERT INTO inventory (product_name, lot_number, quantity, unit, received_date, receipt_file, quantity_base, expiration_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                  (product_name, lot_number, quantity, unit, received_date,  filename, quantity_base, expiration_date))
+        ledger.record_movement(conn, product_name, lot_number, quantity_base, unit, 'add')
         conn.commit()
-        conn.close()
-        return redirect(url_for('home'))
 
-    return '''
-        <form method="post">
-            Product Name: <input type="text" name="product_name"><br>
-            Lot Number: <input type="text" name="lot_number"><br>
-            Unit: 
-            <select name="unit" id="unitSelect" onchange="toggleLbsOzFields()">
-                <option value="g">g</option>
-                <option value="kg">kg</option>
-                <option value="ml">ml</option>
-                <option value="L">L</option>
-                <option value="lbs_oz">Lbs & Oz</option>
-            </select><br>
-            
-            <div id="lbsOzFields" style="display: none;">
-                Quantity: 
-                <input type="text" name="quantity_lbs"> lbs
-                <input type="text" name="quantity_oz"> oz
-            </div>
-            
-            Quantity: <input type="text" name="quantity"><br>
-            Received Date: <input type="text" name="received_date"><br>
-            Receipt: <input type="file" name="file"><br>
-            <input type="submit" value="Add Inventory">
-        </form>
-        <script>
-            function toggleLbsOzFields() {
-                const unitSelect = document.getElementById('unitSelect');
-                const lbsOzFields = document.getElementById('lbsOzFields');
-                if (unitSelect.value === 'lbs_oz') {
-                    lbsOzFields.style.display = 'block';
-                } else {
-                    lbsOzFields.style.display = 'none';
-                }
-            }
-        </script>
-    '''
+        # History に記録を追加
+        audit.record('Add Inventory', f"Added {quantity} {unit} of {product_name} (Lot: {lot_number}) on {received_date}")
+        return redirect(url_for('main.home'))
 
+    return render_template('inventory_form.html', item=None, quantity_lbs='', quantity_oz='', receipt=None)
 
 
 
@@ -254,41 +277,31 @@ def add_inventory():
 
 
 
-@app.route('/edit/<int:id>', methods=['GET', 'POST'])
+
+
+@bp.route('/edit/<int:id>', methods=['GET', 'POST'])
 def edit_inventory(id):
-    conn = sqlite3.connect('inventory.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM inventory WHERE id=?", (id,))
     item = c.fetchone()
 
-    print(f"取得したitemの内容: {item}", flush=True)
+    current_app.logger.debug('Editing inventory item: %s', item)
 
     if request.method == 'POST':
-        print(f"POSTリクエストを受け取りました。", flush=True)
+        current_app.logger.debug('Updating inventory item %s', id)
 
         product_name = request.form['product_name']
         lot_number = request.form['lot_number']
-        quantity = float(request.form['quantity'])
-        unit = request.form['unit']
-        received_date = request.form['received_date'] 
-
-        # ファイルがリクエストにあるか確認
-        if 'file' in request.files and request.files['file'].filename != '':
-            file = request.files['file']
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        else:
-            filename = item[6]  # 元のファイル名を使用
-
-        print(f"ファイル名: {filename}", flush=True)
+        received_date = normalize_date(request.form['received_date'])
+        expiration_date = normalize_date(request.form.get('expiration_date'))
 
         # エラーハンドリングの追加
         unit = request.form['unit']
         if unit == 'lbs_oz':  # Lbs & Ozの場合は分割処理
             try:
-                quantity_lbs = int(request.form.get('quantity_lbs', 0))
-                quantity_oz = int(request.form.get('quantity_oz', 0))
+                quantity_lbs = float(request.form.get('quantity_lbs') or 0)
+                quantity_oz = float(request.form.get('quantity_oz') or 0)
                 quantity = (quantity_lbs * 16) + quantity_oz  # lbsをozに変換して合計
             except ValueError:
                 return "Error: Invalid quantity values.", 400
@@ -298,343 +311,262 @@ def edit_inventory(id):
             except ValueError:
                 return "Error: Invalid quantity.", 400
 
-        c.execute("UPDATE inventory SET product_name=?, lot_number=?, quantity=?, unit=?, receipt_file=? WHERE id=?",
-                  (product_name, lot_number, quantity, unit, filename, id))
+        if not units.is_valid(unit):
+            return "Error: Unknown unit.", 400
+        try:
+            quantity_base = units.to_base(quantity, unit)
+        except ValueError:
+            return "Error: Invalid quantity.", 400
+
+        # ファイルがリクエストにあるか確認 (入力の確認が終わってから保存する)
+        filename = item[6]  # 元のファイル名を使用
+        if 'file' in request.files and request.files['file'].filename != '':
+            file = request.files['file']
+            if file and allowed_file(file.filename):
+                filename = receipts.store(conn, file, current_app.config['UPLOAD_FOLDER'])
+
+        current_app.logger.debug('Receipt file: %s', filename)
+
+        c.execute("UPDATE inventory SET product_name=?, lot_number=?, quantity=?, unit=?, receipt_file=?, quantity_base=?, received_date=?, expiration_date=? WHERE id=?",
+                  (product_name, lot_number, quantity, unit, filename, quantity_base, received_date, expiration_date, id))
+
+        # 台帳に増減を記録 (商品・ロット・単位の種類が変わった場合は元の在庫を減らして新しい在庫を増やす)
+        if (product_name, lot_number) == (item[1], item[2]) and units.same_dimension(unit, item[4]):
+            if quantity_base != item[7]:
+                ledger.record_movement(conn, product_name, lot_number, quantity_base - item[7], unit, 'edit')
+        else:
+            ledger.record_movements(conn, [(item[1], item[2], -item[7], item[4], 'edit'),
+                                           (product_name, lot_number, quantity_base, unit, 'edit')])
         conn.commit()
-        conn.close()
-        return redirect(url_for('home'))
+        audit.record('Edit Inventory', f"Updated {product_name} (Lot: {lot_number}) to {quantity} {unit}, "
+                                       f"received {received_date}, Expiry: {expiration_date or '-'}")
+        if filename != item[6]:
+            receipts.release(conn, [item[6]], current_app.config['UPLOAD_FOLDER'])  # 使われなくなったファイルを削除
+        return redirect(url_for('main.home'))
 
     # ファイルがある場合に、ファイルを開くリンクを表示
-    file_link = ""
-    if item[6]:  # item[5]がファイル名であると仮定
-        print(f"ファイル名: {item[6]}")
-        if allowed_file(item[6]):  # allowed_file() 関数でファイル形式を確認
-        # 画像ファイルなら表示
-            if item[6].lower().endswith(('png', 'jpg', 'jpeg')):
-                file_link = f'<img src="/uploads/{item[6]}" alt="Attached image" style="max-width:200px;"><br>'
-        # 画像以外ならリンクを表示
-        else:
-            file_link = f'<a href="/uploads/{item[6]}" target="_blank">Open existing file</a><br>'
-        print(f"生成されたfile_link: {file_link}", flush=True)
+    receipt = None
+    if item[6] and allowed_file(item[6]):  # allowed_file() 関数でファイル形式を確認
+        receipt = {'url': url_for('main.uploaded_file', filename=item[6]), 'image_url': None}
+        # 画像ファイルならサムネイルを表示 (まだできていなければ元の画像を縮小して表示)
+        if item[6].lower().endswith(('png', 'jpg', 'jpeg')):
+            if receipts.has_thumbnail(current_app.config['UPLOAD_FOLDER'], item[6]):
+                receipt['image_url'] = url_for('main.uploaded_thumbnail', filename=receipts.thumbnail_name(item[6]))
+            else:
+                receipt['image_url'] = receipt['url']
 
-    
     # Quantityをlbsとozに分割する処理
-    unit = item[4]
-    if unit == 'lbs_oz':  # Lbs & Ozの場合、lbsとozに分割
-        quantity_lbs = item[3] // 16
-        quantity_oz = item[3] % 16
+    if item[4] == 'lbs_oz':  # Lbs & Ozの場合、lbsとozに分割
+        quantity_lbs, quantity_oz = units.split_lbs_oz(item[3])
     else:
         quantity_lbs = 0
         quantity_oz = 0
 
-    return f'''
-        <form method="post" enctype="multipart/form-data">
-            Product Name: <input type="text" name="product_name" value="{item[1]}"><br>
-            Lot Number: <input type="text" name="lot_number" value="{item[2]}"><br>
-            
-            <!-- 修正: 通常のQuantity入力 -->
-            Quantity: <input type="text" name="quantity" value="{item[3]}"><br>
-
-            Unit: 
-            <select name="unit" id="unitSelect" onchange="toggleLbsOzFields()">
-                <option value="g" {"selected" if unit == "g" else ""}>g</option>
-                <option value="kg" {"selected" if unit == "kg" else ""}>kg</option>
-                <option value="ml" {"selected" if unit == "ml" else ""}>ml</option>
-                <option value="L" {"selected" if unit == "L" else ""}>L</option>
-                <option value="lbs_oz" {"selected" if unit == "lbs_oz" else ""}>Lbs & Oz</option>
-            </select><br>
-
-            <!-- 修正: Lbs & Oz入力フィールドを隠しておく -->
-            <div id="lbsOzFields" style="display: none;">
-                Lbs: <input type="text" name="quantity_lbs" value="{quantity_lbs}"> 
-                Oz: <input type="text" name="quantity_oz" value="{quantity_oz}"><br>
-            </div>
-            Received Date: <input type="text" name="received_date" value="{item[5]}"><br>
-            
-             {file_link}
-            
-            Receipt: <input type="file" name="file"><br>
-            <input type="submit" value="Update">
-        </form>
-
-        <!-- JavaScript修正: Unit選択に応じてLbs & Oz入力欄を表示 -->
-        <script>
-            function toggleLbsOzFields() {{
-                const unitSelect = document.getElementById('unitSelect');
-                const lbsOzFields = document.getElementById('lbsOzFields');
-                const quantityField = document.getElementsByName('quantity')[0];
-
-                if (unitSelect.value === 'lbs_oz') {{
-                    lbsOzFields.style.display = 'block';  // Lbs & Oz入力欄を表示
-                    quantityField.disabled = true;  // 通常のQuantity入力を無効化
-                }} else {{
-                    lbsOzFields.style.display = 'none';  // Lbs & Oz入力欄を非表示
-                    quantityField.disabled = false;  // 通常のQuantity入力を有効化
-                }}
-            }}
-            
-            // ページ読み込み時に現在のUnitに応じて表示を切り替える
-            window.onload = toggleLbsOzFields;
-        </script>
-    '''
-
-
-
-
-
-
-
-
-
-
-
+    return render_template('inventory_form.html', item=item, quantity_lbs=quantity_lbs, quantity_oz=quantity_oz,
+                           receipt=receipt)
 
 
-
-
-
-@app.route('/delete/<int:id>', methods=['POST'])
+@bp.route('/delete/<int:id>', methods=['POST'])
 def delete_inventory(id):
-    conn = sqlite3.connect('inventory.db')
+    conn = get_db()
     c = conn.cursor()
+    c.execute("SELECT product_name, lot_number, quantity_base, unit, receipt_file FROM inventory WHERE id=?", (id,))
+    item = c.fetchone()
     c.execute("DELETE FROM inventory WHERE id=?", (id,))
+    if item:
+        ledger.record_movement(conn, item[0], item[1], -item[2], item[3], 'delete')
     conn.commit()
-    conn.close()
-    return redirect(url_for('home'))
+    if item:
+        audit.record('Delete Inventory', f"Deleted {item[0]} (Lot: {item[1]})")
+        receipts.release(conn, [item[4]], current_app.config['UPLOAD_FOLDER'])  # 使われなくなったファイルを削除
+    return redirect(url_for('main.home'))
 
 
 
 
-@app.route('/inventory_chart')
+# グラフ画像のレスポンスを作成する
+# ETag はデータのバージョンから作るので、変更がなければ304を返してクエリも描画もしない
+def chart_response(key, version, render, load):
+    etag = hashlib.sha1(f'{key}:{version}'.encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(charts.get_png(key, version, render, load), mimetype='image/png')
+    response.set_etag(etag)
+    if request.args.get('v') == str(version):
+        # URLにバージョンが含まれている場合は内容が変わらないので長期間キャッシュさせる
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+@bp.route('/inventory_chart')
 def inventory_chart():
-    conn = sqlite3.connect('inventory.db')
+    conn = get_db()
     c = conn.cursor()
 
-    # 各原料の名前、数量、単位を取得
-    c.execute("SELECT product_name, SUM(quantity), unit FROM inventory GROUP BY product_name, unit")
-    data = c.fetchall()
-    conn.close()
+    c.execute("SELECT DISTINCT product_name FROM inventory ORDER BY product_name")
+    product_names = [row[0] for row in c.fetchall()]
 
-    product_names = [row[0] for row in data]
-    quantities = [row[1] for row in data]
-    units = [row[2] for row in data]
+    # グラフはブラウザで描画する (データは /api/v1/inventory_totals)。PNG はダウンロード用
+    png_url = url_for('main.inventory_chart_png', v=db.data_version(conn, 'inventory'))
 
-    plt.figure(figsize=(10, 6))
+    current_app.logger.debug('Rendering inventory chart for %d products', len(product_names))
 
-    # bars変数に棒グラフのバーの情報を保存
-    bars = plt.bar(product_names, quantities)
+    # Flaskテンプレートに商品名とグラフのURLを渡して表示
+    return render_template('inventory_chart.html', data_url=url_for('api.inventory_totals'), png_url=png_url,
+                           product_names=product_names)
 
-     # グラフの天辺に数量と単位を表示
-    for bar, quantity, unit in zip(bars, quantities, units):
-        yval = bar.get_height()
-        plt.text(bar.get_x() + bar.get_width()/2, yval, f'{quantity} {unit}', va='bottom', ha='center')
 
-    plt.xlabel('Product Name')
-    plt.ylabel('Quantity')
-    plt.title('Inventory Visualization')
+# 各原料の合計 (stock_on_hand の利用できる在庫。質量・体積ごとに g / ml で表示) を描画関数の引数にして返す
+def inventory_chart_data(conn):
+    data = stock.totals(conn)
+    return ([row['product_name'] for row in data], [row['quantity'] for row in data], [row['unit'] for row in data])
 
-    # Save the image to memory and prepare it for display in the browser
-    img = io.BytesIO()
-    plt.savefig(img, format='png')
-    img.seek(0)
-    graph_url = base64.b64encode(img.getvalue()).decode()
 
+# async=1 の場合はバックグラウンドジョブとして描画し、ジョブの状態のURLを返す
+@bp.route('/inventory_chart.png')
+def inventory_chart_png():
+    if request.args.get('async', type=int) == 1:
+        return jobs.submit_response('inventory_chart', {})
 
-    print(f"Rendering inventory_chart.html with graph_url: {graph_url} and product_names: {product_names}")
+    conn = get_db()
+    return chart_response('inventory', db.data_version(conn, 'inventory'), charts.render_inventory_chart,
+                          lambda: inventory_chart_data(conn))
 
-    # Flaskテンプレートに商品名とグラフのデータを渡して表示
-    return render_template('inventory_chart.html', graph_url=graph_url, product_names=product_names)
 
-    
+@jobs.register('inventory_chart', tables=['inventory'], limit=1)
+def inventory_chart_job(conn, params, out, job):
+    out.write(charts.get_png('inventory', db.data_version(conn, 'inventory'), charts.render_inventory_chart,
+                             lambda: inventory_chart_data(conn)))
+    return 'image/png', 'inventory_chart.png'
 
 
+# start, end, bucket, max_points は /api/v1/inventory_history と同じ (最初に表示する期間と単位)
+# グラフはブラウザで描画し、ドラッグで選んだ範囲を読み込み直す。PNG はダウンロード用
+@bp.route('/inventory_history/<product_name>')
+def inventory_history(product_name):
+    params = {name: request.args[name] for name in ('start', 'end', 'bucket', 'max_points') if request.args.get(name)}
+    return render_template('inventory_history.html', product_name=product_name, params=params,
+                           buckets=api.SERIES_BUCKETS,
+                           data_url=url_for('api.inventory_history', product_name=product_name),
+                           png_url=url_for('main.inventory_history_png', product_name=product_name))
+
+
+@bp.route('/inventory_history/<product_name>/chart.png')
+def inventory_history_png(product_name):
+    conn = get_db()
+    bucket = request.args.get('bucket', 'auto')
+    if bucket not in api.SERIES_BUCKETS:
+        return "Error: Unknown bucket.", 400
+    try:
+        start, end = ledger.normalize_range(request.args.get('start'), request.args.get('end'))
+    except ValueError:
+        return "Error: Invalid date.", 400
+    max_points = min(max(request.args.get('max_points', ledger.MAX_POINTS, type=int), 3), api.MAX_SERIES_POINTS)
+
+    def load():
+        # 期間に合った単位 (台帳・日・週・月) で残高の推移を取得して間引き、g または ml で表示する
+        timestamps, balances, period = ledger.history_series(conn, product_name, start, end, max_points,
+                                                             None if bucket == 'auto' else bucket)
+        current_app.logger.debug('History of %s: %d points (%s)', product_name, len(timestamps), period or 'movements')
+        unit = ledger.display_unit(conn, product_name)
+        if unit:
+            balances = units.from_base_many(balances, unit)
+        return product_name, timestamps, balances
+
+    return chart_response(f'history:{product_name}:{start}:{end}:{bucket}:{max_points}',
+                          db.data_version(conn, 'stock_movements'), charts.render_history_chart, load)
+
+
+
+
+
+
+# フォームの材料を (材料名, 数量, 単位, 基本単位の数量) のリストにする
+# DBを変更する前にすべての材料を確認する。知らない単位や数値でない数量は ValueError
+def recipe_ingredients():
+    ingredients = request.form.getlist('ingredient_name')
+    quantities = request.form.getlist('quantity')
+    ingredient_units = request.form.getlist('unit')
+
+    rows = []
+    for i in range(len(ingredients)):
+        if not units.is_valid(ingredient_units[i]):
+            raise ValueError('Unknown unit.')
+        try:
+            if ingredient_units[i] == 'lbs_oz':
+                quantity_lbs = float(request.form.getlist('quantity_lbs')[i] or 0)
+                quantity_oz = float(request.form.getlist('quantity_oz')[i] or 0)
+                quantity = (quantity_lbs * 16) + quantity_oz
+            else:
+                quantity = float(quantities[i])
+            quantity_base = units.to_base(quantity, ingredient_units[i])
+        except (ValueError, IndexError):
+            raise ValueError('Invalid quantity.')
+        rows.append((ingredients[i], quantity, ingredient_units[i], quantity_base))
+    return rows
 
 
+@bp.route('/add_recipe', methods=['GET', 'POST'])
+def add_recipe():
+    if request.method == 'POST':
+        drink_name = request.form['drink_name']
+        try:
+            ingredients = recipe_ingredients()
+        except ValueError as e:
+            return f"Error: {e}", 400
 
-@app.route('/inventory_history/<product_name>')
-def inventory_history(product_name):
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
+        conn = get_db()
+        c = conn.cursor()
+        c.execute("INSERT INTO recipes (drink_name) VALUES (?)", (drink_name,))
+        recipe_id = c.lastrowid
 
-    # 指定された商品の履歴を取得
-    c.execute("SELECT timestamp, details FROM history WHERE details LIKE ? ORDER BY timestamp", ('%' + product_name + '%',))
-    data = c.fetchall()
-    conn.close()
-
-    # データを解析して数量の変動を抽出
-    timestamps = []
-    quantity_changes = []
-    total_quantities = []
-    current_total = 0
-
-    for row in data:
-        timestamp, details = row
-        # "Added 1000.0 g of Termeric" というような文字列から数量を抽出
-        if 'Added' in details:
-            quantity = float(details.split(' ')[1])  # "1000.0"の部分を取得
-        elif 'Manufactured' in details:
-            quantity = -float(details.split(' ')[1])  # 製造は在庫が減るためマイナス
-        else:
-            continue
+        # 複数の材料を登録
+        c.executemany("INSERT INTO ingredients (recipe_id, ingredient_name, quantity, unit, quantity_base) VALUES (?, ?, ?, ?, ?)",
+                      [(recipe_id,) + row for row in ingredients])
 
-        # タイムスタンプと数量の変化をリストに追加
-        timestamps.append(timestamp)
-        current_total += quantity  # 在庫の累計を計算
-        total_quantities.append(current_total)
+        conn.commit()
+        audit.record('Add Recipe', f"Added recipe {drink_name} with {len(ingredients)} ingredients")
+        return redirect(url_for('main.view_recipes'))
 
-    # グラフを描画
-    plt.figure(figsize=(10, 6))
-    plt.plot(timestamps, total_quantities, marker='o')
+    return render_template('recipe_form.html', drink_name='', ingredients=[], submit_label='Add Recipe')
 
-    plt.xlabel('Time')
-    plt.ylabel('Total Quantity')
-    plt.title(f'Inventory History for {product_name}')
 
-    # グラフをブラウザに表示するために画像をメモリに保存
-    img = io.BytesIO()
-    plt.savefig(img, format='png')
-    img.seek(0)
-    graph_url = base64.b64encode(img.getvalue()).decode()
 
-    return f'<img src="data:image/png;base64,{graph_url}"/>'
 
 
 
 
 
 
-@app.route('/add_recipe', methods=['GET', 'POST'])
-def add_recipe():
-    if request.method == 'POST':
-        drink_name = request.form['drink_name']
-        
-        conn = sqlite3.connect('inventory.db')
-        c = conn.cursor()
-        c.execute("INSERT INTO recipes (drink_name) VALUES (?)", (drink_name,))
-        recipe_id = c.lastrowid
 
-        # 複数の材料を登録
-        ingredients = request.form.getlist('ingredient_name')
-        quantities = request.form.getlist('quantity')
-        units = request.form.getlist('unit')
-
-        for i in range(len(ingredients)):
-            if units[i] == 'lbs_oz':
-                quantity_lbs = int(request.form.getlist('quantity_lbs')[i])
-                quantity_oz = int(request.form.getlist('quantity_oz')[i])
-                quantity = (quantity_lbs * 16) + quantity_oz
-            else:
-                quantity = float(quantities[i])
-            c.execute("INSERT INTO ingredients (recipe_id, ingredient_name, quantity, unit) VALUES (?, ?, ?, ?)",
-                      (recipe_id, ingredients[i], quantity, units[i]))
 
-        conn.commit()
-        conn.close()
-        return redirect(url_for('view_recipes'))
-
-    return '''
-        <form method="post" id="recipeForm">
-            Drink Name: <input type="text" name="drink_name"><br>
-            <div id="ingredientContainer">
-                <div>
-                    Ingredient 1: <input type="text" name="ingredient_name"><br>
-                    Quantity 1: <input type="text" name="quantity"><br>
-                    Unit: 
-                    <select name="unit" id="unitSelect" onchange="toggleLbsOzFields()">
-                        <option value="g">g</option>
-                        <option value="kg">kg</option>
-                        <option value="ml">ml</option>
-                        <option value="L">L</option>
-                        <option value="lbs_oz">Lbs & Oz</option>
-                    </select><br>
-
-                    <div id="lbsOzFields" style="display: none;">
-                        Quantity: 
-                        <input type="text" name="quantity_lbs"> lbs
-                        <input type="text" name="quantity_oz"> oz
-                    </div>
-                </div>
-            </div>
-            <button type="button" onclick="addIngredient()">Add Ingredient</button><br>
-            <input type="submit" value="Add Recipe">
-        </form>
-        <script>
-            function toggleLbsOzFields() {
-                const unitSelect = document.getElementById('unitSelect');
-                const lbsOzFields = document.getElementById('lbsOzFields');
-                if (unitSelect.value === 'lbs_oz') {
-                    lbsOzFields.style.display = 'block';
-                } else {
-                    lbsOzFields.style.display = 'none';
-                }
-            }
-
-            function addIngredient() {
-                const container = document.getElementById('ingredientContainer');
-                const newIngredient = document.createElement('div');
-                newIngredient.innerHTML = `
-                    Ingredient <input type="text" name="ingredient_name"><br>
-                    Quantity <input type="text" name="quantity"><br>
-                    Unit: 
-                    <select name="unit" onchange="toggleLbsOzFields()">
-                        <option value="g">g</option>
-                        <option value="kg">kg</option>
-                        <option value="ml">ml</option>
-                        <option value="L">L</option>
-                        <option value="oz">oz</option>
-                        <option value="lbs">lbs</option>
-                        <option value="lbs_oz">Lbs & Oz</option>
-                    </select><br>
-                    <div id="lbsOzFields" style="display: none;">
-                        Quantity: 
-                        <input type="text" name="quantity_lbs"> lbs
-                        <input type="text" name="quantity_oz"> oz
-                    </div>
-                `;
-                container.appendChild(newIngredient);
-            }
-        </script>
-    '''
-
-
-
-
-
-
-
-
-
-
-
-@app.route('/edit_recipe/<int:recipe_id>', methods=['GET', 'POST'])
+
+@bp.route('/edit_recipe/<int:recipe_id>', methods=['GET', 'POST'])
 def edit_recipe(recipe_id):
-    conn = sqlite3.connect('inventory.db')
+    conn = get_db()
     c = conn.cursor()
 
     if request.method == 'POST':
+        try:
+            ingredients = recipe_ingredients()
+        except ValueError as e:
+            return f"Error: {e}", 400
+
         # レシピ名を更新
         c.execute("UPDATE recipes SET drink_name = ? WHERE id = ?", (request.form['drink_name'], recipe_id))
         # 現在の材料を削除して新しい材料を追加
         c.execute("DELETE FROM ingredients WHERE recipe_id = ?", (recipe_id,))
-
-        ingredients = request.form.getlist('ingredient_name')
-        quantities = request.form.getlist('quantity')
-        units = request.form.getlist('unit')
-
-        for i in range(len(ingredients)):
-            if units[i] == 'lbs_oz':
-                quantity_lbs = int(request.form.getlist('quantity_lbs')[i])
-                quantity_oz = int(request.form.getlist('quantity_oz')[i])
-                quantity = (quantity_lbs * 16) + quantity_oz
-            else:
-                quantity = float(quantities[i])
-
-            c.execute("INSERT INTO ingredients (recipe_id, ingredient_name, quantity, unit) VALUES (?, ?, ?, ?)",
-                      (recipe_id, ingredients[i], quantity, units[i]))
+        c.executemany("INSERT INTO ingredients (recipe_id, ingredient_name, quantity, unit, quantity_base) VALUES (?, ?, ?, ?, ?)",
+                      [(recipe_id,) + row for row in ingredients])
 
         conn.commit()
-        conn.close()
-        return redirect(url_for('view_recipes'))
+        audit.record('Edit Recipe', f"Updated recipe {request.form['drink_name']} with {len(ingredients)} ingredients")
+        return redirect(url_for('main.view_recipes'))
 
     # レシピ名と材料を取得
     c.execute("SELECT drink_name FROM recipes WHERE id = ?", (recipe_id,))
@@ -642,94 +574,23 @@ def edit_recipe(recipe_id):
 
     c.execute("SELECT ingredient_name, quantity, unit FROM ingredients WHERE recipe_id = ?", (recipe_id,))
     ingredients = c.fetchall()
-    conn.close()
 
-    # 既存の材料フィールドを生成
-    ingredient_fields = ''
-    for i, (ingredient_name, quantity, unit) in enumerate(ingredients, start=1):
+    # 既存の材料フィールドの値 (Lbs & Oz の場合は lbs と oz に分割)
+    ingredient_values = []
+    for ingredient_name, quantity, unit in ingredients:
         if unit == 'lbs_oz':
-            quantity_lbs = quantity // 16
-            quantity_oz = quantity % 16
+            quantity_lbs, quantity_oz = units.split_lbs_oz(quantity)
         else:
             quantity_lbs = 0
             quantity_oz = 0
+        ingredient_values.append({'name': ingredient_name, 'quantity': quantity, 'unit': unit,
+                                  'lbs': quantity_lbs, 'oz': quantity_oz})
 
-        ingredient_fields += f'''
-            Ingredient {i}: <input type="text" name="ingredient_name" value="{ingredient_name}"><br>
-            Quantity: <input type="text" name="quantity" value="{quantity}"><br>
-            Unit: 
-            <select name="unit" id="unitSelect_{i}" onchange="toggleLbsOzFields({i})">
-                <option value="g" {"selected" if unit == "g" else ""}>g</option>
-                <option value="kg" {"selected" if unit == "kg" else ""}>kg</option>
-                <option value="ml" {"selected" if unit == "ml" else ""}>ml</option>
-                <option value="L" {"selected" if unit == "L" else ""}>L</option>
-                <option value="oz" {"selected" if unit == "oz" else ""}>oz</option>
-                <option value="lbs" {"selected" if unit == "lbs" else ""}>lbs</option>
-                <option value="lbs_oz" {"selected" if unit == "lbs_oz" else ""}>Lbs & Oz</option>
-            </select><br>
-            <div id="lbsOzFields_{i}" style="display: {'block' if unit == 'lbs_oz' else 'none'};">
-                Lbs: <input type="text" name="quantity_lbs" value="{quantity_lbs}"> 
-                Oz: <input type="text" name="quantity_oz" value="{quantity_oz}"><br>
-            </div>
-        '''
-
-    return f'''
-        <form method="post" id="recipeForm">
-            Drink Name: <input type="text" name="drink_name" value="{drink_name}"><br>
-            <div id="ingredientContainer">
-                {ingredient_fields}
-            </div>
-            <button type="button" onclick="addIngredient()">Add Ingredient</button><br>
-            <input type="submit" value="Update Recipe">
-        </form>
+    return render_template('recipe_form.html', drink_name=drink_name, ingredients=ingredient_values,
+                           submit_label='Update Recipe')
 
-        <script>
-            function toggleLbsOzFields(index) {{
-                const unitSelect = document.getElementById('unitSelect_' + index);
-                const lbsOzFields = document.getElementById('lbsOzFields_' + index);
-                if (unitSelect.value === 'lbs_oz') {{
-                    lbsOzFields.style.display = 'block';
-                }} else {{
-                    lbsOzFields.style.display = 'none';
-                }}
-            }}
 
-            // ページ読み込み時にUnitに応じてLbs & Ozフィールドを切り替え
-            window.onload = function() {{
-                for (let i = 1; i <= {len(ingredients)}; i++) {{
-                    toggleLbsOzFields(i);
-                }}
-            }};
-            
-            // Add Ingredientの関数（JavaScriptでnewIndexを動的に生成）
-            function addIngredient() {{
-                const container = document.getElementById('ingredientContainer');
-                const newIndex = container.querySelectorAll('input[name="ingredient_name"]').length;  // 正確にインデックスを生成
 
-                const newIngredient = `
-                    <div>
-                        Ingredient ${newIndex + 1}: <input type="text" name="ingredient_name"><br>
-                        Quantity: <input type="text" name="quantity"><br>
-                        Unit: 
-                        <select name="unit" onchange="toggleLbsOzFields(${newIndex + 1})">
-                            <option value="g">g</option>
-                            <option value="kg">kg</option>
-                            <option value="ml">ml</option>
-                            <option value="L">L</option>
-                            <option value="oz">oz</option>
-                            <option value="lbs">lbs</option>
-                            <option value="lbs_oz">Lbs & Oz</option>
-                        </select><br>
-                        <div id="lbsOzFields_${newIndex + 1}" style="display: none;">
-                            Lbs: <input type="text" name="quantity_lbs"> 
-                            Oz: <input type="text" name="quantity_oz"><br>
-                        </div>
-                    </div>
-                `;
-                container.insertAdjacentHTML('beforeend', newIngredient);
-            }}
-        </script>
-    '''
 
 
 
@@ -749,143 +610,158 @@ def edit_recipe(recipe_id):
 
 
 
-
-
-@app.route('/view_recipes')
+@bp.route('/view_recipes')
 def view_recipes():
-    conn = sqlite3.connect('inventory.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute("""
         SELECT r.id, r.drink_name, i.ingredient_name, i.quantity
         FROM recipes r
         JOIN ingredients i ON r.id = i.recipe_id
+        ORDER BY r.id, i.id
     """)
-    recipes = c.fetchall()
-    conn.close()
-
-    recipe_list = ''
-    current_drink = ''
-    for recipe in recipes:
-        if recipe[1] != current_drink:
-            current_drink = recipe[1]
-            recipe_list += f'<h3>{recipe[1]}</h3>'
-        recipe_list += f'<p>{recipe[2]} - {recipe[3]}</p>'
-        recipe_list += f'<a href="/edit_recipe/{recipe[0]}">Edit</a>'
-
-        # レシピの削除ボタンを追加
-        recipe_list += f'''
-            <form action="/delete_recipe/{recipe[0]}" method="post" style="display:inline;">
-                <button type="submit">Delete</button>
-            </form><br>
-        '''
-
-    return f'''
-        <h1>Recipe List</h1>
-        {recipe_list}
-        <a href="/add_recipe">Add New Recipe</a><br>
-        <a href="/">Back to Home</a>
-    '''
-
-@app.route('/delete_recipe/<int:recipe_id>', methods=['POST'])
+
+    # レシピごとに材料をまとめる
+    recipes = []
+    for recipe_id, drink_name, ingredient_name, quantity in c.fetchall():
+        if not recipes or recipes[-1]['id'] != recipe_id:
+            recipes.append({'id': recipe_id, 'drink_name': drink_name, 'ingredients': []})
+        recipes[-1]['ingredients'].append((ingredient_name, quantity))
+
+    return render_template('recipes.html', recipes=recipes)
+
+@bp.route('/delete_recipe/<int:recipe_id>', methods=['POST'])
 def delete_recipe(recipe_id):
-    conn = sqlite3.connect('inventory.db')
+    conn = get_db()
     c = conn.cursor()
     
     # レシピに関連する材料を削除
     c.execute("DELETE FROM ingredients WHERE recipe_id = ?", (recipe_id,))
     
     # レシピ自体を削除
-    c.execute("DELETE FROM recipes WHERE id = ?", (recipe_id,))
+    recipe = c.execute("DELETE FROM recipes WHERE id = ? RETURNING drink_name", (recipe_id,)).fetchone()
     
     conn.commit()
-    conn.close()
-    return redirect(url_for('view_recipes'))
+    if recipe:
+        audit.record('Delete Recipe', f"Deleted recipe {recipe[0]}")
+    return redirect(url_for('main.view_recipes'))
 
-@app.route('/produce/<int:recipe_id>', methods=['POST'])
+@bp.route('/produce/<int:recipe_id>', methods=['POST'])
 def produce(recipe_id):
-    conn = sqlite3.connect('inventory.db')
+    conn = get_db()
     c = conn.cursor()
 
     # 該当するレシピの材料を取得
-    c.execute("SELECT ingredient_name, quantity FROM ingredients WHERE recipe_id=?", (recipe_id,))
+    c.execute("SELECT ingredient_name, quantity_base, unit FROM ingredients WHERE recipe_id=?", (recipe_id,))
     ingredients = c.fetchall()
 
-    # 在庫から材料を引き算
-    for ingredient in ingredients:
-        c.execute("UPDATE inventory SET quantity = quantity - ? WHERE product_name = ?",
-                  (ingredient[1], ingredient[0]))
+    # 在庫から材料を引き算 (賞味期限の近いロット・古いロットから自動で割り当てる)
+    # 割り当てと引き算は書き込みトランザクションの中で行うので、同時に製造しても同じ在庫を二重に使わない
+    def work(conn):
+        allocator = Allocator(conn)
+        for ingredient_name, quantity_base, unit in ingredients:
+            picks, short = allocator.allocate(ingredient_name, units.dimension(unit), quantity_base)
+            if short:
+                raise manufacturing.InsufficientStock([{'product_name': ingredient_name}])
+            manufacturing.deduct(conn, [(lot_id, ingredient_name, used) for lot_id, lot_number, lot_unit, used in picks])
+            ledger.record_movements(conn, [(ingredient_name, lot_number, -used, lot_unit, 'produce')
+                                           for lot_id, lot_number, lot_unit, used in picks])
 
-    conn.commit()
-    conn.close()
-    return redirect(url_for('home'))
+    try:
+        db.write_transaction(conn, work)
+    except manufacturing.InsufficientStock as e:
+        return f"Error: Not enough {e.shortages[0]['product_name']} in stock.", 400
 
-import os
+    recipe = c.execute("SELECT drink_name FROM recipes WHERE id = ?", (recipe_id,)).fetchone()
+    audit.record('Produce', f"Produced 1 batch of {recipe[0] if recipe else f'recipe {recipe_id}'}")
+    return redirect(url_for('main.home'))
 
 
 
-@app.route('/manufacture/<int:recipe_id>', methods=['GET', 'POST'])
+@bp.route('/manufacture/<int:recipe_id>', methods=['GET', 'POST'])
 def manufacture(recipe_id):  # recipe_idを受け取るように修正
-    conn = sqlite3.connect('inventory.db')
+    conn = get_db()
     c = conn.cursor()
 
     # 選択したレシピに基づいて原材料を取得
-    c.execute("SELECT ingredient_name, quantity FROM ingredients WHERE recipe_id=?", (recipe_id,))
+    c.execute("SELECT ingredient_name, quantity, unit, quantity_base FROM ingredients WHERE recipe_id=?", (recipe_id,))
     ingredients = c.fetchall()
 
     if request.method == 'POST':
         drink_name = request.form['drink_name']
-        manufacture_date = request.form['manufacture_date']
-        expiration_date = request.form['expiration_date']
+        manufacture_date = normalize_date(request.form['manufacture_date'])
+        expiration_date = normalize_date(request.form['expiration_date'])
+        # 製造した数量と単位 (単位は bottles などの自由な文字列)
+        try:
+            produced_quantity = float(request.form['produced_quantity'])
+        except ValueError:
+            return "Error: Invalid quantity.", 400
+        if not math.isfinite(produced_quantity) or produced_quantity <= 0:
+            return "Error: Invalid quantity.", 400
+        produced_unit = request.form['produced_unit'].strip()
+        if not produced_unit:
+            return "Error: Produced unit is required.", 400
         lot_numbers = request.form.getlist('lot_number')  # 各原材料のLOT番号を取得
         quantities = request.form.getlist('quantity')     # 各原材料の使用量を取得
 
         # 原材料ごとの在庫を更新する処理
-        for i, (ingredient_name, recipe_quantity) in enumerate(ingredients):
-            lot_number = lot_numbers[i]
-            used_quantity = float(quantities[i])  # 使用量をfloat型に変換
-            # 在庫から減らす処理
-            c.execute("UPDATE inventory SET quantity = quantity - ? WHERE product_name = ? AND lot_number = ?", 
-                      (used_quantity, ingredient_name, lot_number))
-
-        # 製造履歴を追加
-        c.execute("INSERT INTO manufactures (drink_name, manufacture_date, expiration_date) VALUES (?, ?, ?)",
-                  (drink_name, manufacture_date, expiration_date))
-        
-        # History に記録を追加
-        action_details = f"Manufactured {used_quantity} of {drink_name} on {manufacture_date}, Expiry: {expiration_date}"
-        c.execute("INSERT INTO history (action_type, details, timestamp) VALUES (?, ?, datetime('now'))",
-                  ('Manufacture', action_details))
+        # 割り当てと引き算は書き込みトランザクションの中で行い、ロットの残量が足りない場合は何も変更しない
+        def work(conn):
+            c = conn.cursor()
+            allocator = Allocator(conn)
+            used_lots = []  # (inventory_id, 原材料名, lot_number, 使用量)
+            for i, (ingredient_name, recipe_quantity, recipe_unit, recipe_base) in enumerate(ingredients):
+                lot_number = lot_numbers[i].strip()
+                used_quantity = float(quantities[i]) if quantities[i].strip() else recipe_quantity  # 使用量をfloat型に変換
+
+                if not lot_number:
+                    # LOT番号が空欄の場合は自動で割り当てる (使用量はレシピの単位)
+                    picks, short = allocator.allocate(ingredient_name, units.dimension(recipe_unit),
+                                                      units.to_base(used_quantity, recipe_unit))
+                    if short:
+                        raise manufacturing.InsufficientStock([{'product_name': ingredient_name}])
+                else:
+                    # 使用量は自動割り当てと同じくレシピの単位で入力されるので、レシピの単位で基本単位に変換する
+                    c.execute("SELECT id, unit, available FROM inventory WHERE product_name = ? AND lot_number = ?", (ingredient_name, lot_number))
+                    lot = c.fetchone()
+                    if lot is None:
+                        raise ValueError(f"Lot {lot_number} of {ingredient_name} not found.")
+                    if not lot[2]:
+                        raise ValueError(f"Lot {lot_number} of {ingredient_name} has expired.")
+                    if not units.is_valid(lot[1]) or not units.same_dimension(lot[1], recipe_unit):
+                        raise ValueError(f"Lot {lot_number} of {ingredient_name} is in {lot[1]}, which cannot be converted from {recipe_unit}.")
+                    picks = [(lot[0], lot_number, lot[1], units.to_base(used_quantity, recipe_unit))]
+
+                # 在庫から減らす処理 (残量が足りなければ InsufficientStock)
+                manufacturing.deduct(conn, [(lot_id, ingredient_name, used_base) for lot_id, picked_lot, lot_unit, used_base in picks])
+                for lot_id, picked_lot, lot_unit, used_base in picks:
+                    ledger.record_movement(conn, ingredient_name, picked_lot, -used_base, lot_unit, 'manufacture')
+                    used_lots.append((lot_id, ingredient_name, picked_lot, used_base))
+
+            # 製造履歴と使用したロットを追加
+            c.execute("INSERT INTO manufactures (drink_name, manufacture_date, expiration_date, quantity, unit) VALUES (?, ?, ?, ?, ?)",
+                      (drink_name, manufacture_date, expiration_date, produced_quantity, produced_unit))
+            manufacturing.record_allocations(conn, [(c.lastrowid,) + used for used in used_lots])
+
+        try:
+            db.write_transaction(conn, work)
+        except manufacturing.InsufficientStock as e:
+            return f"Error: Not enough {e.shortages[0]['product_name']} in stock.", 400
+        except ValueError as e:
+            return f"Error: {e}", 400
 
-        conn.commit()
-        conn.close()
+        # History に記録を追加
+        audit.record('Manufacture', f"Manufactured {produced_quantity} {produced_unit} of {drink_name} on {manufacture_date}, Expiry: {expiration_date}")
 
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
 
     
 
-    # 原材料ごとにLOT番号と使用量を入力するフォームを生成
-    ingredient_fields = ''
-    for i, (ingredient_name, recipe_quantity) in enumerate(ingredients):
-        ingredient_fields += f'''
-            <p>原材料: {ingredient_name} (必要な数量: {recipe_quantity})</p>
-            LOT番号: <input type="text" name="lot_number" required><br>
-            使用数量: <input type="text" name="quantity" required><br>
-        '''
+    # 原材料ごとにLOT番号と使用量を入力するフォーム
+    return render_template('manufacture.html', ingredients=ingredients)
 
-    # Pythonのf文字列を使ってingredient_fieldsをフォーム内に埋め込むように修正
-    return f'''
-        <h1>Manufacture Products</h1>
-        <form method="post">
-            Drink Name: <input type="text" name="drink_name" required><br>
-            Manufacture Date: <input type="date" name="manufacture_date" required><br>
-            Expiration Date: <input type="date" name="expiration_date" required><br>
 
-            <!-- 原材料ごとのLOT番号と使用量を入力 -->
-            {ingredient_fields}
 
-            <input type="submit" value="Manufacture">
-        </form>
-    '''
 
 
 
@@ -895,59 +771,114 @@ def manufacture(recipe_id):  # recipe_idを受け取るように修正
 
 
 
+# 在庫の一括インポート (export_inventory() と同じ形式のCSV、.csv.gz も可)
+# 結果は追加した行数と、エラーになった行の一覧をJSONで返す
+@bp.route('/import_inventory', methods=['GET', 'POST'])
+def import_inventory():
+    if request.method == 'POST':
+        file = request.files.get('file')
+        if file is None or file.filename == '':
+            return jsonify({'error': 'file is required'}), 400
+        if request.args.get('async', type=int) == 1:
+            # ファイルを保存してバックグラウンドジョブで読み込む
+            name = f'import-{uuid.uuid4().hex}' + ('.csv.gz' if file.filename.endswith('.gz') else '.csv')
+            file.save(os.path.join(current_app.config['JOB_FOLDER'], name))
+            return jobs.submit_response('import_inventory', {'file': name})
+        report = imports.import_inventory_csv(get_db(), imports.open_csv(file.stream, file.filename))
+        return jsonify(report)
 
+    return render_template('import_inventory.html')
 
-#Csv fileにして、エクスポートするコード。
-import csv
-from flask import send_file
 
-# 在庫データのエクスポート
-@app.route('/export_inventory')
-def export_inventory():
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
 
-    # 在庫データを取得
-    c.execute("SELECT * FROM inventory")
-    inventory_data = c.fetchall()
+# 途中で失敗すると読み込み済みのチャンクが重複するので再実行しない
+@jobs.register('import_inventory', max_attempts=1)
+def import_inventory_job(conn, params, out, job):
+    name = os.path.basename(params.get('file', ''))
+    if not name.startswith('import-'):
+        raise ValueError('Invalid import file')
+    path = os.path.join(current_app.config['JOB_FOLDER'], name)
+    try:
+        with open(path, 'rb') as f:
+            report = imports.import_inventory_csv(conn, imports.open_csv(f, name), on_chunk=job.check)
+    finally:
+        os.remove(path)
+    out.write(json.dumps(report).encode('utf-8'))
+    return 'application/json', 'import_report.json'
+
+
+# まとめて製造するAPI (1シフト分の製造計画を1回で登録する)
+# POST JSON:
+# {"manufacture_date": "2024-09-01", "expiration_date": "2024-12-31",
+#  "batches": [{"recipe_id": 1, "batches": 5}, {"recipe_id": 2, "batches": 3, "quantity": 30, "unit": "bottles"}]}
+# 材料が1つでも足りない場合は何も変更せずに409を返す
+@bp.route('/manufacture_batch', methods=['POST'])
+def manufacture_batch():
+    data = request.get_json(silent=True) or {}
+    plan = data.get('batches')
+    if not plan or not data.get('manufacture_date') or not data.get('expiration_date'):
+        return jsonify({'error': 'manufacture_date, expiration_date and batches are required'}), 400
+    for item in plan:
+        if not isinstance(item.get('recipe_id'), int) or not isinstance(item.get('batches'), int) or item['batches'] <= 0:
+            return jsonify({'error': 'each batch needs an integer recipe_id and a positive integer batches'}), 400
+        quantity = item.get('quantity', item['batches'])
+        if isinstance(quantity, bool) or not isinstance(quantity, (int, float)) or not math.isfinite(quantity) or quantity <= 0:
+            return jsonify({'error': 'quantity must be a positive number'}), 400
+        unit = item.get('unit', 'batch')
+        if not isinstance(unit, str) or not unit.strip():
+            return jsonify({'error': 'unit must be a non-empty string'}), 400
+
+    try:
+        count = manufacturing.manufacture_batch(get_db(), plan, normalize_date(data['manufacture_date']),
+                                                normalize_date(data['expiration_date']))
+    except manufacturing.UnknownRecipe as e:
+        return jsonify({'error': str(e)}), 404
+    except manufacturing.InsufficientStock as e:
+        return jsonify({'error': 'insufficient stock', 'shortages': e.shortages}), 409
+    return jsonify({'manufactured': count})
+
+
 
-    # CSVファイルにデータを書き込む
-    csv_file_path = 'inventory_export.csv'
-    with open(csv_file_path, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['ID', 'Product Name', 'Lot Number', 'Quantity', 'Received Date'])
-        writer.writerows(inventory_data)
 
-    conn.close()
 
-    # ファイルをダウンロードするために送信
-    return send_file(csv_file_path, as_attachment=True)
 
-# レシピデータのエクスポート
-@app.route('/export_recipes')
-def export_recipes():
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
 
-    # レシピデータを取得
-    c.execute("""
-        SELECT r.id, r.drink_name, i.ingredient_name, i.quantity
-        FROM recipes r
-        JOIN ingredients i ON r.id = i.recipe_id
-    """)
-    recipe_data = c.fetchall()
 
-    # CSVファイルにデータを書き込む
-    csv_file_path = 'recipes_export.csv'
-    with open(csv_file_path, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['Recipe ID', 'Drink Name', 'Ingredient Name', 'Quantity'])
-        writer.writerows(recipe_data)
 
-    conn.close()
 
-    # ファイルをダウンロードするために送信
-    return send_file(csv_file_path, as_attachment=True)
+
+#Csv fileにして、エクスポートするコード。
+# どちらのエクスポートも以下のクエリパラメータに対応:
+#   gzip=1     gzipで圧縮して送信
+#   product    商品名(レシピの場合はドリンク名)で絞り込み
+#   after      このIDより後の行から再開 (途中で切れたダウンロードの再開用)
+# 在庫のみ:
+#   from, to   入荷日 (received_date) の範囲で絞り込み
+import exports
+from exports import csv_response, csv_chunks
+
+# 在庫データのエクスポート
+# async=1 の場合はバックグラウンドジョブとして実行し、ジョブの状態のURLを返す
+@bp.route('/export_inventory')
+def export_inventory():
+    if request.args.get('async', type=int) == 1:
+        return jobs.submit_response('export_inventory', request.args)
+
+    query, params = exports.inventory_query(request.args)
+    cursor = get_db().execute(query, params)
+    return csv_response(csv_chunks(cursor, exports.INVENTORY_HEADER), 'inventory_export.csv',
+                        compress=request.args.get('gzip', type=int) == 1)
+
+# レシピデータのエクスポート
+@bp.route('/export_recipes')
+def export_recipes():
+    if request.args.get('async', type=int) == 1:
+        return jobs.submit_response('export_recipes', request.args)
+
+    query, params = exports.recipes_query(request.args)
+    cursor = get_db().execute(query, params)
+    return csv_response(csv_chunks(cursor, exports.RECIPES_HEADER), 'recipes_export.csv',
+                        compress=request.args.get('gzip', type=int) == 1)
 
 
 
@@ -960,4 +891,5 @@ def export_recipes():
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    logging.basicConfig(level=logging.INFO)
+    create_app().run(debug=True)
@@ -0,0 +1,166 @@
+# 履歴 (history) の記録
+#
+# 在庫やレシピを変更する処理は、コミットした後に record() で履歴を1行追加する。
+# 行はメモリ上のキューに入れるだけで、書き込みスレッドがまとめて追加する (グループコミット)。
+# - 書き込みスレッドは最初の行を受け取ってから FLUSH_INTERVAL 秒待つか BATCH_ROWS 行たまったら、
+#   executemany で追加して1回だけコミットする
+# - timestamp は record() を呼んだ時刻 (UTC, datetime('now') と同じ形式) なので、書き込みが遅れても順序は変わらない
+# - キューが MAX_QUEUE 行でいっぱいの場合は、書き込みが追いつくまで record() を待たせる (バックプレッシャー)。
+#   QUEUE_TIMEOUT 秒待っても空かなければ、その場で書き込む (履歴は落とさない)
+# - 書き込みに失敗した行は RETRY_DELAY 秒後に再び書き込む
+# - 停止時 (stop()、プロセスの終了時) はキューに残った行を書き込んでから終了する
+# - 書き込みスレッドを起動していない場合 (START_BACKGROUND_THREADS = False) は record() がその場で書き込む
+import atexit
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+import db
+
+BATCH_ROWS = 500          # 1回のコミットで追加する最大の行数
+FLUSH_INTERVAL = 0.05     # 最初の行を受け取ってから書き込むまでの最大の秒数
+MAX_QUEUE = 10000         # キューに入れておける最大の行数
+QUEUE_TIMEOUT = 5         # キューが空くのを待つ最大の秒数
+RETRY_DELAY = 1           # 書き込みに失敗した場合に再び書き込むまでの秒数
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+_writer = None
+
+
+class HistoryWriter:
+    def __init__(self, path, max_queue=MAX_QUEUE):
+        self.path = path
+        self._queue = queue.Queue(max_queue)
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='history-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    # キューに残った行を書き込んでからスレッドを終了する
+    def stop(self, timeout=None):
+        if not self.running:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        atexit.unregister(self.stop)
+
+    # キューに入れた行がすべて書き込まれるまで待つ
+    def flush(self):
+        if self.running:
+            self._queue.join()
+
+    # rows は (action_type, details, timestamp) のリスト
+    def put(self, rows):
+        if not self.running:
+            self._write(rows)
+            return
+        for index, row in enumerate(rows):
+            try:
+                self._queue.put(row, timeout=QUEUE_TIMEOUT)
+            except queue.Full:
+                logger.warning('History queue is full, writing %d rows synchronously', len(rows) - index)
+                self._write(rows[index:])
+                return
+
+    def _loop(self):
+        stopping = False
+        while not stopping:
+            row = self._queue.get()
+            if row is _STOP:
+                self._queue.task_done()
+                break
+            rows = [row]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(rows) < BATCH_ROWS:
+                try:
+                    row = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if row is _STOP:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                rows.append(row)
+
+            while True:
+                try:
+                    self._write(rows)
+                    break
+                except Exception:
+                    if stopping:
+                        logger.exception('Could not write %d history rows', len(rows))
+                        break
+                    logger.exception('Writing %d history rows failed, retrying', len(rows))
+                    time.sleep(RETRY_DELAY)
+            for _ in rows:
+                self._queue.task_done()
+
+        # 停止を受け取った後に入れられた行も書き込む
+        rows = []
+        while True:
+            try:
+                row = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._queue.task_done()
+            if row is not _STOP:
+                rows.append(row)
+        if rows:
+            self._write(rows)
+
+    def _write(self, rows):
+        pool = db.get_pool(self.path)
+        conn = pool.acquire()
+        try:
+            db.write_transaction(conn, lambda conn: conn.executemany(
+                "INSERT INTO history (action_type, details, timestamp) VALUES (?, ?, ?)", rows))
+        finally:
+            pool.release(conn)
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+# 履歴を1行記録する。変更をコミットした後に呼ぶ (ロールバックした変更は記録しない)
+def record(action_type, details):
+    record_many([(action_type, details)])
+
+
+# entries は (action_type, details) のリスト
+def record_many(entries):
+    if not entries:
+        return
+    if _writer is None:
+        raise RuntimeError('audit.init_app() has not been called')
+    timestamp = _now()
+    _writer.put([(action_type, details, timestamp) for action_type, details in entries])
+
+
+def flush():
+    if _writer is not None:
+        _writer.flush()
+
+
+# start=False の場合は書き込みスレッドを起動せず、record() がその場で書き込む
+# (Flask のアプリを使わないコマンドラインのスクリプトからも呼ぶ)
+def init(path, start=True):
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+    _writer = HistoryWriter(path)
+    if start:
+        _writer.start()
+
+
+def init_app(app, start=True):
+    init(app.config['DATABASE'], start)
@@ -0,0 +1,200 @@
+# ベンチマーク用のデータの生成
+#
+# rows を基準に、在庫 (inventory)・レシピと材料・製造履歴・履歴・在庫の台帳を作る。
+# 同じ rows と seed からは常に同じデータを作る (日付も固定の基準日から決める)。
+#   inventory        rows 行 (ロットごとに台帳の 'add' を1行)
+#   stock_movements  rows + rows / 2 行 (残りは 'manufacture' の払い出し)
+#   history          rows 行
+#   manufactures     rows / 10 行
+#   recipes          rows / 100 行 (1レシピに材料 3〜8 行)
+# 商品は rows / 200 種類 (最小 20)。1割の商品に発注点を設定する。
+#
+#   python bench_data.py bench.db --rows 100000 [--seed 1]
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+import db
+import units
+
+VERSION = 1                         # 生成するデータを変えたら上げる (bench_routes.py のキャッシュの名前に使う)
+SEED = 1
+BATCH_ROWS = 10000
+BASE_DATE = datetime(2024, 1, 1)    # 生成するデータの最後の日付
+HISTORY_DAYS = 5 * 365              # BASE_DATE の何日前からのデータを作るか
+MASS_UNITS = ['g', 'kg', 'oz', 'lbs']
+VOLUME_UNITS = ['ml', 'L']
+
+
+def product_count(rows):
+    return max(rows // 200, 20)
+
+
+def product_name(index):
+    return f'Product {index:05d}'
+
+
+def lot_number(lot_id):
+    return f'L{lot_id:08d}'
+
+
+def _timestamp(rng):
+    return BASE_DATE - timedelta(days=rng.random() * HISTORY_DAYS)
+
+
+def _batches(iterable, size=BATCH_ROWS):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# (inventory の行, 台帳の 'add' の行) を返す
+def _inventory(rng, rows, products):
+    for lot_id in range(1, rows + 1):
+        index = rng.randrange(products)
+        unit = rng.choice(VOLUME_UNITS if index % 4 == 0 else MASS_UNITS)   # 4つに1つは液体
+        quantity = rng.randint(1, 50)
+        received = _timestamp(rng)
+        # 3割は賞味期限なし、3割は期限切れ、残りは実行する日によらず期限内 (BASE_DATE の10〜20年後)
+        kind = rng.random()
+        if kind < 0.3:
+            expiration = None
+        elif kind < 0.6:
+            expiration = (received + timedelta(days=rng.randint(180, 720))).strftime('%Y-%m-%d')
+        else:
+            expiration = (BASE_DATE + timedelta(days=rng.randint(3650, 7300))).strftime('%Y-%m-%d')
+        quantity_base = units.to_base(quantity, unit)
+        yield ((product_name(index), lot_number(lot_id), quantity, unit, received.strftime('%Y-%m-%d'),
+                quantity_base, expiration),
+               (received.strftime('%Y-%m-%d %H:%M:%S'), product_name(index), lot_number(lot_id),
+                quantity_base, unit, 'add'))
+
+
+# 払い出しの行を BATCH_ROWS 行ずつ返す。ロットの 'add' の行は movement_staging (rowid = ロットのID) から読む
+# 払い出しはロットの追加より小さい量にする (残高が大きく負にならないように)
+def _withdrawals(conn, rng, rows):
+    remaining = rows // 2
+    while remaining:
+        draws = [(rng.randrange(rows) + 1, _timestamp(rng).strftime('%Y-%m-%d %H:%M:%S'), rng.randint(4, 20))
+                 for _ in range(min(remaining, BATCH_ROWS))]
+        remaining -= len(draws)
+        lot_ids = sorted({lot_id for lot_id, used, divisor in draws})
+        lots = {row[0]: row[1:] for row in conn.execute(
+            f"SELECT rowid, timestamp, product_name, lot_number, delta, unit FROM movement_staging "
+            f"WHERE rowid IN ({', '.join('?' * len(lot_ids))})", lot_ids)}
+        batch = []
+        for lot_id, used, divisor in draws:
+            timestamp, name, lot, quantity_base, unit = lots[lot_id]
+            batch.append((max(used, timestamp), name, lot, -(quantity_base // divisor), unit, 'manufacture'))
+        yield batch
+
+
+def _history(rng, rows, products):
+    for _ in range(rows):
+        index = rng.randrange(products)
+        timestamp = _timestamp(rng).strftime('%Y-%m-%d %H:%M:%S')
+        if rng.random() < 0.8:
+            yield ('Add Inventory', f'Added {rng.randint(1, 50)} g of {product_name(index)}', timestamp)
+        else:
+            yield ('Manufacture', f'Manufactured {rng.randint(1, 20)} L of Drink {index:05d}', timestamp)
+
+
+def _manufactures(rng, count, recipes):
+    for _ in range(count):
+        made = _timestamp(rng)
+        yield (f'Drink {rng.randrange(recipes):05d}', made.strftime('%Y-%m-%d'),
+               (made + timedelta(days=rng.randint(30, 720))).strftime('%Y-%m-%d'), rng.randint(1, 100), 'L')
+
+
+# path に新しいデータベースを作る (既にある場合は作り直す)。戻り値は各テーブルの行数
+def generate(path, rows, seed=SEED):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    db.migrate(path)
+
+    rng = random.Random(seed)
+    products = product_count(rows)
+    recipes = max(rows // 100, 1)
+    counts = {}
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    try:
+        # 台帳の行は一時テーブルに順不同で追加して、最後に時刻順に並べ替えて stock_movements に入れる
+        # (全ての行を Python のリストに持たない)
+        conn.execute('CREATE TEMP TABLE movement_staging (timestamp TEXT, product_name TEXT, lot_number TEXT, '
+                     'delta INTEGER, unit TEXT, reason TEXT)')
+        for batch in _batches(_inventory(rng, rows, products)):
+            conn.executemany("INSERT INTO inventory (product_name, lot_number, quantity, unit, received_date, "
+                             "quantity_base, expiration_date) VALUES (?, ?, ?, ?, ?, ?, ?)", [lot for lot, movement in batch])
+            conn.executemany("INSERT INTO movement_staging VALUES (?, ?, ?, ?, ?, ?)", [movement for lot, movement in batch])
+        counts['inventory'] = rows
+
+        for batch in _withdrawals(conn, rng, rows):
+            conn.executemany("INSERT INTO movement_staging VALUES (?, ?, ?, ?, ?, ?)", batch)
+        # チェックポイントのトリガーは台帳が時刻順に追加されることを前提にしている
+        conn.execute("INSERT INTO stock_movements (timestamp, product_name, lot_number, delta, unit, reason) "
+                     "SELECT timestamp, product_name, lot_number, delta, unit, reason FROM movement_staging "
+                     "ORDER BY timestamp, product_name, lot_number, delta, unit, reason")
+        counts['stock_movements'] = rows + rows // 2
+        conn.execute('DROP TABLE movement_staging')
+
+        ingredients = 0
+        for recipe in range(recipes):
+            recipe_id = conn.execute("INSERT INTO recipes (drink_name) VALUES (?)", (f'Drink {recipe:05d}',)).lastrowid
+            lines = []
+            for index in rng.sample(range(products), min(rng.randint(3, 8), products)):
+                unit = 'ml' if index % 4 == 0 else 'g'
+                quantity = rng.randint(1, 10)
+                lines.append((recipe_id, product_name(index), quantity, unit, units.to_base(quantity, unit)))
+            conn.executemany("INSERT INTO ingredients (recipe_id, ingredient_name, quantity, unit, quantity_base) "
+                             "VALUES (?, ?, ?, ?, ?)", lines)
+            ingredients += len(lines)
+        counts['recipes'] = recipes
+        counts['ingredients'] = ingredients
+
+        for batch in _batches(_manufactures(rng, rows // 10, recipes)):
+            conn.executemany("INSERT INTO manufactures (drink_name, manufacture_date, expiration_date, quantity, unit) "
+                             "VALUES (?, ?, ?, ?, ?)", batch)
+        counts['manufactures'] = rows // 10
+
+        for batch in _batches(_history(rng, rows, products)):
+            conn.executemany("INSERT INTO history (action_type, details, timestamp) VALUES (?, ?, ?)", batch)
+        counts['history'] = rows
+
+        reorder = [(product_name(index), 'volume' if index % 4 == 0 else 'mass', 20000000, 5000000,
+                    'ml' if index % 4 == 0 else 'g')
+                   for index in range(0, products, 10)]
+        conn.executemany("INSERT INTO reorder_points (product_name, dimension, reorder_point, safety_stock, unit) "
+                         "VALUES (?, ?, ?, ?, ?)", reorder)
+        counts['reorder_points'] = len(reorder)
+        conn.commit()
+        conn.execute('ANALYZE')
+    finally:
+        conn.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a deterministic database for benchmarks')
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=SEED)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    counts = generate(args.path, args.rows, args.seed)
+    print(f'Generated {counts} in {time.perf_counter() - start:.1f} s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+# ルートごとのベンチマーク
+#
+# bench_data.py で作ったデータベースに対して、app.py の各ルートを Flask のテストクライアントで
+# 繰り返し呼び出し、レイテンシ (p50/p90/p95/p99)・スループット・SQL の文の数と行数・最大 RSS を測る。
+# 規模 (--rows) ごとに別のプロセスで実行するので、最大 RSS はその規模だけの値になる。
+# 結果は JSON で出力する (--output)。--compare に前回の結果を渡すと p50 を比べ、
+# --max-regression 倍より遅くなったルートがあれば終了コード 1 を返す。
+#
+#   python bench_routes.py --rows 1000 --rows 100000 --iterations 50 --output bench.json
+#   python bench_routes.py --rows 1000 --compare bench.json
+#
+# 書き込みのルート (POST) は毎回データを変えるので、規模ごとにデータベースのコピーを使い、
+# 読み込みのルートをすべて測った後に実行する。
+# /uploads/... (ファイルを返すだけ) と /jobs/... (ジョブの実行は別スレッド) は対象にしない。
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROWS = [1000, 100000]
+ITERATIONS = 30
+MAX_REGRESSION = 1.25
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    index = min(int(round(percent / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss   # Linux では KB
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# (名前, メソッド, パス, フォームのデータ)。パスとデータは繰り返しの番号 i を受け取る関数でもよい
+def routes(conn):
+    import bench_data
+    product = bench_data.product_name(1)
+    recipe_id = conn.execute("SELECT MIN(id) FROM recipes").fetchone()[0]
+    lot_id = conn.execute("SELECT id FROM inventory ORDER BY id LIMIT 1 OFFSET (SELECT COUNT(*) / 2 FROM inventory)").fetchone()[0]
+    first_page_end = conn.execute("SELECT id FROM inventory ORDER BY id LIMIT 1 OFFSET 49").fetchone()
+    last_lot = conn.execute("SELECT MAX(id) FROM inventory").fetchone()[0]
+
+    read = [
+        ('home', 'GET', '/', None),
+        ('home_page_2', 'GET', f'/?after={first_page_end[0] if first_page_end else 0}', None),
+        ('home_search', 'GET', '/?search=' + product[-4:], None),
+        ('more_history', 'GET', '/more_history', None),
+        ('inventory_chart', 'GET', '/inventory_chart', None),
+        ('inventory_chart_png', 'GET', '/inventory_chart.png', None),
+        ('inventory_history', 'GET', f'/inventory_history/{product}', None),
+        ('inventory_history_png', 'GET', f'/inventory_history/{product}/chart.png', None),
+        ('inventory_history_png_range', 'GET', f'/inventory_history/{product}/chart.png?start=2023-01-01&end=2023-06-30', None),
+        ('manufacture_form', 'GET', f'/manufacture/{recipe_id}', None),
+        ('view_recipes', 'GET', '/view_recipes', None),
+        ('add_form', 'GET', '/add', None),
+        ('edit_form', 'GET', f'/edit/{lot_id}', None),
+        ('add_recipe_form', 'GET', '/add_recipe', None),
+        ('edit_recipe_form', 'GET', f'/edit_recipe/{recipe_id}', None),
+        ('reorder_points', 'GET', '/reorder_points', None),
+        ('expiring', 'GET', '/expiring?days=365', None),
+        ('import_form', 'GET', '/import_inventory', None),
+        ('export_inventory', 'GET', '/export_inventory', None),
+        ('export_inventory_gzip', 'GET', '/export_inventory?gzip=1', None),
+        ('export_recipes', 'GET', '/export_recipes', None),
+        ('api_inventory', 'GET', '/api/v1/inventory', None),
+        ('api_low_stock', 'GET', '/api/v1/low_stock', None),
+        ('api_inventory_totals', 'GET', '/api/v1/inventory_totals', None),
+        ('api_inventory_history', 'GET', f'/api/v1/inventory_history/{product}', None),
+        ('api_inventory_history_range', 'GET', f'/api/v1/inventory_history/{product}?start=2023-01-01&end=2023-06-30', None),
+        ('metrics', 'GET', '/metrics', None),
+    ]
+
+    csv_header = 'ID,Product Name,Lot Number,Quantity,Unit,Received Date,Receipt File,Expiration Date\n'
+    write = [
+        ('add', 'POST', '/add', lambda i: {
+            'product_name': product, 'lot_number': f'BENCH-ADD-{i}', 'quantity': '5', 'unit': 'g',
+            'received_date': '2024-01-01', 'expiration_date': ''}),
+        ('edit', 'POST', f'/edit/{lot_id}', lambda i: {
+            'product_name': product, 'lot_number': 'BENCH-EDIT', 'quantity': str(10 + i % 5), 'unit': 'g',
+            'received_date': '2024-01-01', 'expiration_date': ''}),
+        ('manufacture', 'POST', f'/manufacture/{recipe_id}', lambda i: _manufacture_form(conn, recipe_id)),
+        ('produce', 'POST', f'/produce/{recipe_id}', None),
+        ('add_recipe', 'POST', '/add_recipe', lambda i: {
+            'drink_name': f'Bench Drink {i}', 'ingredient_name': [product], 'quantity': ['5'], 'unit': ['g']}),
+        ('import_inventory', 'POST', '/import_inventory', lambda i: {
+            'file': (io.BytesIO((csv_header + ''.join(f',{product},BENCH-IMPORT-{i}-{n},5,g,2024-01-01,,\n'
+                                                      for n in range(20))).encode('utf-8')), 'bench.csv')}),
+        ('delete', 'POST', lambda i: f'/delete/{last_lot - i}', None),
+    ]
+    return read, write
+
+
+def _manufacture_form(conn, recipe_id):
+    count = conn.execute("SELECT COUNT(*) FROM ingredients WHERE recipe_id = ?", (recipe_id,)).fetchone()[0]
+    return {'drink_name': 'Bench Drink', 'manufacture_date': '2024-01-01', 'expiration_date': '2099-01-01',
+            'produced_quantity': '1', 'produced_unit': 'L', 'lot_number': [''] * count, 'quantity': [''] * count}
+
+
+def _measure(app, client, name, method, path, data, iterations):
+    import metrics
+    adapter = app.url_map.bind('localhost')
+    latencies = []
+    statuses = set()
+    before = metrics.sql_totals()
+    endpoints = set()
+    start = time.perf_counter()
+    first_ms = None
+    # 1回目 (キャッシュなし) は別に記録し、2回目からを測る
+    for i in range(iterations + 1):
+        url = path(i) if callable(path) else path
+        form = data(i) if callable(data) else data
+        endpoints.add(adapter.match(url.split('?')[0], method=method)[0])
+        t0 = time.perf_counter()
+        response = client.open(url, method=method, data=form)
+        response.get_data()     # ストリーミングのレスポンスは読み終わるまで測る
+        elapsed = (time.perf_counter() - t0) * 1000
+        response.close()
+        statuses.add(response.status_code)
+        if i == 0:
+            first_ms = elapsed
+            start = time.perf_counter()
+        else:
+            latencies.append(elapsed)
+    total = time.perf_counter() - start
+    after = metrics.sql_totals()
+
+    sql = [0, 0.0, 0]
+    for endpoint in endpoints:
+        old = before.get(endpoint, (0, 0.0, 0))
+        new = after.get(endpoint, (0, 0.0, 0))
+        sql = [sql[n] + new[n] - old[n] for n in range(3)]
+    requests = iterations + 1
+    return {
+        'method': method, 'path': path(0) if callable(path) else path, 'status': sorted(statuses),
+        'iterations': iterations, 'first_ms': round(first_ms, 3),
+        'p50_ms': round(_percentile(latencies, 50), 3), 'p90_ms': round(_percentile(latencies, 90), 3),
+        'p95_ms': round(_percentile(latencies, 95), 3), 'p99_ms': round(_percentile(latencies, 99), 3),
+        'mean_ms': round(statistics.mean(latencies), 3), 'max_ms': round(max(latencies), 3),
+        'throughput_rps': round(iterations / total, 1) if total else None,
+        'sql_statements_per_request': round(sql[0] / requests, 1),
+        'sql_rows_per_request': round(sql[2] / requests, 1),
+        'sql_ms_per_request': round(sql[1] * 1000 / requests, 3),
+        'peak_rss_kb': _peak_rss_kb(),
+    }
+
+
+# 1つの規模を測る (子プロセスで実行する)
+def run_scale(rows, seed, iterations, data_dir, only=None):
+    import bench_data
+    source = os.path.join(data_dir, f'bench-v{bench_data.VERSION}-{rows}-{seed}.db')
+    generate_seconds = None
+    if not os.path.exists(source):
+        start = time.perf_counter()
+        bench_data.generate(source, rows, seed)
+        generate_seconds = round(time.perf_counter() - start, 2)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        database = os.path.join(workdir, 'inventory.db')
+        shutil.copy(source, database)
+        import app as appmod
+        app = appmod.create_app({'DATABASE': database, 'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+                                 'JOB_FOLDER': os.path.join(workdir, 'job_results'),
+                                 'START_BACKGROUND_THREADS': False})
+        client = app.test_client()
+        conn = sqlite3.connect(database)
+        read, write = routes(conn)
+        results = {}
+        for name, method, path, data in read + write:
+            if only and name not in only:
+                continue
+            results[name] = _measure(app, client, name, method, path, data, iterations)
+            print(f'  {rows:>9} {name:<28} p50 {results[name]["p50_ms"]:9.2f} ms  '
+                  f'p99 {results[name]["p99_ms"]:9.2f} ms  {results[name]["sql_statements_per_request"]:6.1f} SQL/req',
+                  file=sys.stderr)
+        conn.close()
+
+    return {'rows': rows, 'seed': seed, 'generate_seconds': generate_seconds,
+            'db_size_bytes': os.path.getsize(source), 'peak_rss_kb': _peak_rss_kb(), 'routes': results}
+
+
+def compare(baseline, current, max_regression):
+    base = {(scale['rows'], name): result for scale in baseline['scales'] for name, result in scale['routes'].items()}
+    regressions = []
+    print(f'{"rows":>9} {"route":<28} {"before":>10} {"after":>10} {"ratio":>7}')
+    for scale in current['scales']:
+        for name, result in scale['routes'].items():
+            old = base.get((scale['rows'], name))
+            if not old or not old['p50_ms']:
+                continue
+            ratio = result['p50_ms'] / old['p50_ms']
+            mark = ' *' if ratio > max_regression else ''
+            print(f'{scale["rows"]:>9} {name:<28} {old["p50_ms"]:>10.2f} {result["p50_ms"]:>10.2f} {ratio:>7.2f}{mark}')
+            if ratio > max_regression:
+                regressions.append((scale['rows'], name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every route against generated data')
+    parser.add_argument('--rows', type=int, action='append', help=f'scale in inventory rows (default {ROWS})')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    parser.add_argument('--route', action='append', help='only run the named routes')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'inventory-bench'),
+                        help='where generated databases are kept between runs')
+    parser.add_argument('--output', help='write the JSON results to this file (default: stdout)')
+    parser.add_argument('--compare', help='previous JSON results to compare p50 latency against')
+    parser.add_argument('--max-regression', type=float, default=MAX_REGRESSION)
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        json.dump(run_scale(args.child, args.seed, args.iterations, args.data_dir, args.route), sys.stdout)
+        return 0
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    scales = []
+    for rows in args.rows or ROWS:
+        command = [sys.executable, os.path.abspath(__file__), '--child', str(rows), '--seed', str(args.seed),
+                   '--iterations', str(args.iterations), '--data-dir', args.data_dir]
+        for name in args.route or []:
+            command += ['--route', name]
+        output = subprocess.run(command, cwd=BASE_DIR, stdout=subprocess.PIPE, text=True, check=True).stdout
+        scales.append(json.loads(output))
+
+    result = {'commit': _git_commit(), 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+              'iterations': args.iterations, 'scales': scales}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), result, args.max_regression)
+        if regressions:
+            print(f'{len(regressions)} routes are more than {args.max_regression}x slower', file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+# 起動時間のベンチマーク
+#
+# 新しいプロセスで app を import し、create_app() して最初のリクエスト (GET /) を返すまでの時間を測る。
+# 中央値が予算 (STARTUP_BUDGET_MS) を超えた場合や、起動時に重いライブラリ (matplotlib など) が
+# 読み込まれた場合は終了コード 1 を返す。
+#
+#   python bench_startup.py [--runs 10] [--budget 500]
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+
+STARTUP_BUDGET_MS = 500
+RUNS = 10
+# グラフや画像を扱うときに初めて読み込むライブラリ
+LAZY_MODULES = ('matplotlib', 'numpy', 'PIL')
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 子プロセスで実行するコード。測定結果を JSON で標準出力に書く
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import app as appmod
+imported = time.perf_counter()
+application = appmod.create_app({'DATABASE': sys.argv[1], 'UPLOAD_FOLDER': sys.argv[2], 'JOB_FOLDER': sys.argv[3]})
+created = time.perf_counter()
+status = application.test_client().get('/').status_code
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - created) * 1000,
+    'total_ms': (served - start) * 1000,
+    'status': status,
+    'heavy_modules': [name for name in %r if name in sys.modules],
+}))
+''' % (LAZY_MODULES,)
+
+
+def run_once(workdir, source):
+    database = os.path.join(workdir, 'inventory.db')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(database + suffix):
+            os.remove(database + suffix)
+    # 本番のデータベースを変更しないようにコピーを使う
+    shutil.copy(source, database)
+    output = subprocess.run([sys.executable, '-c', CHILD, database, os.path.join(workdir, 'uploads'),
+                             os.path.join(workdir, 'job_results')],
+                            cwd=BASE_DIR, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold start time of the application')
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--budget', type=float, default=float(os.environ.get('STARTUP_BUDGET_MS', STARTUP_BUDGET_MS)),
+                        help='budget for the median total time in milliseconds')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # 1回目はマイグレーションと .pyc の作成を含むので測定しない。
+        # 2回目からはマイグレーション済みのデータベースのコピーで測る
+        run_once(workdir, os.path.join(BASE_DIR, 'inventory.db'))
+        migrated = os.path.join(workdir, 'migrated.db')
+        conn = sqlite3.connect(os.path.join(workdir, 'inventory.db'))
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.close()
+        shutil.copy(os.path.join(workdir, 'inventory.db'), migrated)
+        results = [run_once(workdir, migrated) for _ in range(args.runs)]
+
+    summary = {key: round(statistics.median(result[key] for result in results), 1)
+               for key in ('import_ms', 'create_app_ms', 'first_request_ms', 'total_ms')}
+    summary['max_total_ms'] = round(max(result['total_ms'] for result in results), 1)
+    summary['budget_ms'] = args.budget
+    summary['heavy_modules'] = sorted({name for result in results for name in result['heavy_modules']})
+    summary['errors'] = [result['status'] for result in results if result['status'] != 200]
+    summary['ok'] = summary['total_ms'] <= args.budget and not summary['heavy_modules'] and not summary['errors']
+    print(json.dumps(summary, indent=2))
+    return 0 if summary['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+# 製造可能数の計算
+#
+# レシピ×材料の必要量の行列 (基本単位) と材料ごとの在庫のベクトルから、
+# NumPy でレシピごとの最大バッチ数と、足りなくなる材料をまとめて計算する。
+# 行列はデータのバージョンごとにキャッシュし、在庫やレシピが変わったときだけ作り直す。
+import threading
+import db
+
+_cache = {}  # 'matrix' -> (versions, Matrix)
+_lock = threading.Lock()
+
+TABLES = ['inventory', 'recipes', 'ingredients']
+
+
+class Matrix:
+    def __init__(self, recipe_ids, drink_names, materials, requirements, stock):
+        self.recipe_ids = recipe_ids        # 行: レシピ
+        self.drink_names = drink_names
+        self.materials = materials          # 列: (商品名, 質量/体積)
+        self.requirements = requirements    # 1バッチあたりの必要量 (レシピ数 × 材料数)
+        self.stock = stock                  # 材料ごとの在庫 (材料数)
+        self.results = {}                   # 計算結果のキャッシュ
+
+
+def _build(conn):
+    import numpy as np
+
+    recipes = conn.execute("SELECT id, drink_name FROM recipes ORDER BY id").fetchall()
+    rows = conn.execute('''
+        SELECT i.recipe_id, i.ingredient_name, u.dimension, SUM(i.quantity_base)
+        FROM ingredients i JOIN units u ON u.unit = i.unit
+        GROUP BY i.recipe_id, i.ingredient_name, u.dimension''').fetchall()
+
+    recipe_index = {recipe_id: n for n, (recipe_id, _) in enumerate(recipes)}
+    materials = sorted({(name, dimension) for _, name, dimension, _ in rows})
+    material_index = {material: n for n, material in enumerate(materials)}
+
+    requirements = np.zeros((len(recipes), len(materials)))
+    for recipe_id, name, dimension, quantity_base in rows:
+        if recipe_id in recipe_index:
+            requirements[recipe_index[recipe_id], material_index[(name, dimension)]] = quantity_base
+
+    stock = np.zeros(len(materials))
+    for name, dimension, available in conn.execute('''
+            SELECT i.product_name, u.dimension, SUM(i.quantity_base)
+            FROM inventory i JOIN units u ON u.unit = i.unit
+            WHERE i.quantity_base > 0 AND i.available = 1
+            GROUP BY i.product_name, u.dimension'''):
+        if (name, dimension) in material_index:
+            stock[material_index[(name, dimension)]] = available
+
+    return Matrix([recipe_id for recipe_id, _ in recipes], [name for _, name in recipes],
+                  materials, requirements, stock)
+
+
+# キャッシュされた行列を返す (在庫・レシピが変わっていれば作り直す)
+def get_matrix(conn):
+    versions, _ = db.data_versions(conn, TABLES)
+    with _lock:
+        entry = _cache.get('matrix')
+        if entry and entry[0] == versions:
+            return entry[1]
+    matrix = _build(conn)
+    with _lock:
+        _cache['matrix'] = (versions, matrix)
+    return matrix
+
+
+# 在庫に対する必要量の割合 (材料を使わないレシピは inf)
+def _ratios(requirements, stock):
+    import numpy as np
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(requirements > 0, stock / requirements, np.inf)
+
+
+# 計算結果を行列と一緒にキャッシュする (行列が作り直されるまで再計算しない)
+def _cached_result(func):
+    def wrapper(matrix):
+        if func.__name__ not in matrix.results:
+            matrix.results[func.__name__] = func(matrix)
+        return matrix.results[func.__name__]
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+# レシピごとに、今の在庫だけで何バッチ作れるかと、最初に足りなくなる材料
+@_cached_result
+def max_batches(matrix):
+    import numpy as np
+
+    ratios = _ratios(matrix.requirements, matrix.stock)
+    batches = np.floor(ratios.min(axis=1)) if len(matrix.materials) else np.full(len(matrix.recipe_ids), np.inf)
+    limiting = ratios.argmin(axis=1) if len(matrix.materials) else None
+
+    result = []
+    for n, recipe_id in enumerate(matrix.recipe_ids):
+        unlimited = not np.isfinite(batches[n])
+        result.append({
+            'recipe_id': recipe_id,
+            'drink_name': matrix.drink_names[n],
+            'max_batches': None if unlimited else int(batches[n]),
+            'limiting_ingredient': None if unlimited else matrix.materials[limiting[n]][0],
+        })
+    return result
+
+
+# 在庫を共有したときに合計のバッチ数ができるだけ多くなる組み合わせ (貪欲法による近似)
+# 毎回、一番少ない在庫の割合を最も消費しないレシピを選び、作れる数の半分ずつ追加する
+@_cached_result
+def plan_mix(matrix):
+    import numpy as np
+
+    remaining = matrix.stock.copy()
+    counts = np.zeros(len(matrix.recipe_ids), dtype=np.int64)
+    requirements = matrix.requirements
+    uses_stock = (requirements > 0).any(axis=1)
+    if not uses_stock.any():
+        return []
+
+    while True:
+        possible = np.floor(_ratios(requirements, remaining).min(axis=1))
+        possible[~uses_stock] = 0
+        candidates = possible >= 1
+        if not candidates.any():
+            break
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pressure = np.where(requirements > 0, requirements / np.maximum(remaining, 1), 0).max(axis=1)
+        pressure[~candidates] = np.inf
+        best = int(pressure.argmin())
+        amount = max(1, int(possible[best]) // 2)
+        counts[best] += amount
+        remaining -= requirements[best] * amount
+
+    return [{'recipe_id': recipe_id, 'drink_name': matrix.drink_names[n], 'batches': int(counts[n])}
+            for n, recipe_id in enumerate(matrix.recipe_ids) if counts[n]]
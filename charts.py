@@ -0,0 +1,104 @@
+# グラフ画像の生成とキャッシュ
+#
+# グラフはデータのバージョン (data_versions テーブル) ごとにキャッシュし、
+# データが変わっていなければ描画せずにキャッシュから返す。
+# 描画は pyplot のグローバルな状態を使わず、Figure と Agg キャンバスで行い、
+# 同時に描画する数を制限したスレッドプールで実行する。
+import io
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+RENDER_WORKERS = 2        # 同時に描画するグラフの最大数
+CACHE_ENTRIES = 64        # キャッシュするグラフの最大数
+MARKER_POINTS = 100       # 折れ線グラフの点にマーカーを付ける最大の点の数
+
+_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix='chart')
+_cache = OrderedDict()    # key -> (version, png)
+_pending = {}             # (key, version) -> Future (同じグラフを二重に描画しないため)
+_lock = threading.Lock()
+
+
+def _new_figure():
+    # matplotlib は重いので、実際に描画するときに初めて読み込む
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(10, 6))
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _to_png(fig):
+    img = io.BytesIO()
+    fig.savefig(img, format='png')
+    return img.getvalue()
+
+
+# 在庫の棒グラフ
+def render_inventory_chart(product_names, quantities, units):
+    fig = _new_figure()
+    ax = fig.subplots()
+
+    # bars変数に棒グラフのバーの情報を保存
+    bars = ax.bar(product_names, quantities)
+
+    # グラフの天辺に数量と単位を表示
+    for bar, quantity, unit in zip(bars, quantities, units):
+        ax.text(bar.get_x() + bar.get_width() / 2, bar.get_height(), f'{quantity} {unit}', va='bottom', ha='center')
+
+    ax.set_xlabel('Product Name')
+    ax.set_ylabel('Quantity')
+    ax.set_title('Inventory Visualization')
+    return _to_png(fig)
+
+
+# 商品ごとの在庫推移の折れ線グラフ (timestamps は 'YYYY-MM-DD HH:MM:SS')
+# 横軸は時間に比例させる。点が多い場合はマーカーを付けない
+def render_history_chart(product_name, timestamps, total_quantities):
+    fig = _new_figure()
+    ax = fig.subplots()
+    ax.plot([datetime.fromisoformat(timestamp) for timestamp in timestamps], total_quantities,
+            marker='o' if len(timestamps) <= MARKER_POINTS else None)
+    fig.autofmt_xdate()
+
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Total Quantity')
+    ax.set_title(f'Inventory History for {product_name}')
+    return _to_png(fig)
+
+
+def cached(key, version):
+    with _lock:
+        entry = _cache.get(key)
+        if entry and entry[0] == version:
+            _cache.move_to_end(key)
+            return entry[1]
+    return None
+
+
+# キャッシュにあればそれを返し、なければワーカーで描画してキャッシュする
+# load はデータを読み込んで描画関数の引数を返す関数 (キャッシュがあれば呼ばれない)
+def get_png(key, version, render, load):
+    png = cached(key, version)
+    if png is not None:
+        return png
+
+    args = load()
+    with _lock:
+        future = _pending.get((key, version))
+        if future is None:
+            future = _executor.submit(render, *args)
+            _pending[(key, version)] = future
+    try:
+        png = future.result()
+    finally:
+        with _lock:
+            _pending.pop((key, version), None)
+
+    with _lock:
+        _cache[key] = (version, png)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_ENTRIES:
+            _cache.popitem(last=False)
+    return png
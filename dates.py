@@ -0,0 +1,22 @@
+# 日付の正規化
+#
+# 入荷日や賞味期限は '7/26/2024' や '9/2/24' のような形式で入力されることがあるので、
+# 保存する前に 'YYYY-MM-DD' 形式にそろえる (文字列のまま正しく並び替え・範囲検索できるように)。
+from datetime import datetime
+
+INPUT_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%Y/%m/%d')
+
+
+# 'YYYY-MM-DD' に変換する。解釈できない場合は入力をそのまま返す。空の場合は None
+def normalize_date(text):
+    if text is None:
+        return None
+    text = text.strip()
+    if not text:
+        return None
+    for fmt in INPUT_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return text
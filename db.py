@@ -0,0 +1,828 @@
+import sqlite3
+import queue
+import random
+import threading
+import time
+from flask import current_app, g
+import dates
+import ledger
+import metrics
+import units
+
+# コネクションプールの設定
+POOL_SIZE = 8             # プールに保持する接続数
+BUSY_TIMEOUT = 5.0        # ロック待ちの秒数
+WRITE_RETRIES = 4         # 書き込みトランザクションが SQLITE_BUSY で失敗したときにやり直す回数
+RETRY_DELAY = 0.05        # やり直すまでの最大の待ち時間 (秒)。やり直すたびに倍にする
+CACHE_SIZE_KB = 20000     # 接続ごとのページキャッシュ (約20MB)
+STATEMENT_CACHE = 256     # プリペアドステートメントのキャッシュ数
+
+
+# 新しい接続を作成し、WALなどのPRAGMAを設定する
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE, factory=metrics.MeteredConnection)
+    conn.execute('PRAGMA journal_mode=WAL')  # 読み込みが書き込みをブロックしないようにする
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)}')
+    conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.set_trace_callback(metrics.trace)  # SQL の文の数を数える (metrics.py)
+    return conn
+
+
+class ConnectionPool:
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    # 空いている接続を返す。なければ新しく作る
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return _connect(self.path)
+
+    # 接続をプールに戻す。未コミットの変更は破棄する
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+# データベースのパスごとにプールを1つだけ作成する
+def get_pool(path=None):
+    path = path or current_app.config['DATABASE']
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(path, ConnectionPool(path))
+    return pool
+
+
+# リクエスト(アプリコンテキスト)ごとに1つの接続を使い回す
+def get_db():
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+
+def _is_busy(error):
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
+# work(conn) を書き込みトランザクションの中で実行してコミットし、戻り値を返す
+# BEGIN IMMEDIATE で最初に書き込みロックを取るので、トランザクションの中で読んだ在庫は
+# コミットするまで他の接続に変更されない (読んでから書くまでの間の lost update が起きない)。
+# ロックが取れずに SQLITE_BUSY になった場合は、ロールバックしてランダムな時間 (jitter) 待ってから
+# WRITE_RETRIES 回までやり直す。work は何度呼ばれてもよいように、変更はすべて conn で行うこと。
+# その他の例外はロールバックしてそのまま送出する (呼ぶ前にコミットしていない変更があってはいけない)
+def write_transaction(conn, work, retries=WRITE_RETRIES):
+    for attempt in range(retries + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            result = work(conn)
+            conn.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if not _is_busy(e) or attempt == retries:
+                raise
+            time.sleep(random.uniform(0, RETRY_DELAY * 2 ** attempt))
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+
+# アプリコンテキスト終了時に接続をプールへ戻す
+def close_db(exc=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
+
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
+
+
+
+# ---- キーセットページネーション ----
+# OFFSET を使わず、最後に表示した id を基準に次のページを取得するので
+# どのページでも同じコストで取得できる。
+# after: この id の次から取得 / before: この id の手前まで取得
+# columns の先頭は id にすること。
+# 戻り値は (rows, next_cursor, prev_cursor)。前後のページがない場合は None
+def keyset_page(conn, table, columns='*', where='', params=(), after=None, before=None,
+                page_size=50, newest_first=False):
+    conditions = [where] if where else []
+    args = list(params)
+    backwards = before is not None
+    cursor = before if backwards else after
+    if cursor is not None:
+        # newest_first の場合は「次のページ」が小さい id の方向になる
+        conditions.append('id < ?' if newest_first != backwards else 'id > ?')
+        args.append(cursor)
+    order = 'DESC' if newest_first != backwards else 'ASC'
+    sql = f'SELECT {columns} FROM {table}'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(f'({cond})' for cond in conditions)
+    sql += f' ORDER BY id {order} LIMIT ?'
+    args.append(page_size + 1)
+
+    rows = conn.execute(sql, args).fetchall()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, cursor is not None
+
+    next_cursor = rows[-1][0] if rows and has_next else None
+    prev_cursor = rows[0][0] if rows and has_prev else None
+    return rows, next_cursor, prev_cursor
+
+# ---- スキーマのマイグレーション ----
+# PRAGMA user_version に現在のスキーマのバージョンを保存し、
+# 未適用のマイグレーションだけを順番に実行する。
+# 新しいスキーマ変更は MIGRATIONS の末尾に追加すること(既存のものは変更しない)。
+
+# v1: 基本のテーブル (旧 init_db() と create_*.py を統一したもの)
+def _migration_1(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS inventory (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_name TEXT NOT NULL,
+        lot_number TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        unit TEXT NOT NULL,
+        received_date TEXT NOT NULL,
+        receipt_file TEXT
+    )''')
+
+    # 古いデータベースには `receipt_file` カラムがない場合がある
+    columns = [col[1] for col in conn.execute('PRAGMA table_info(inventory)')]
+    if 'receipt_file' not in columns:
+        conn.execute('ALTER TABLE inventory ADD COLUMN receipt_file TEXT')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS recipes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        drink_name TEXT NOT NULL
+    )''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS ingredients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        recipe_id INTEGER NOT NULL,
+        ingredient_name TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        unit TEXT NOT NULL
+    )''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS manufactures (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        drink_name TEXT NOT NULL,
+        manufacture_date TEXT NOT NULL,
+        expiration_date TEXT NOT NULL,
+        quantity REAL NOT NULL,
+        unit TEXT NOT NULL
+    )''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        action_type TEXT NOT NULL,
+        details TEXT NOT NULL,
+        timestamp TEXT NOT NULL
+    )''')
+
+
+# v2: よく使う検索のためのインデックス
+def _migration_2(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_inventory_product_lot ON inventory (product_name, lot_number)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ingredients_recipe ON ingredients (recipe_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_manufactures_expiration ON manufactures (expiration_date)')
+
+
+# v3: 在庫検索用の全文検索インデックス (FTS5 trigram)
+# inventory の内容をトリガーで同期する。数量の更新では再インデックスしない
+def _migration_3(conn):
+    conn.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS inventory_fts USING fts5(
+        product_name, lot_number,
+        content='inventory', content_rowid='id', tokenize='trigram'
+    )''')
+
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS inventory_fts_insert AFTER INSERT ON inventory BEGIN
+        INSERT INTO inventory_fts (rowid, product_name, lot_number)
+        VALUES (new.id, new.product_name, new.lot_number);
+    END''')
+
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS inventory_fts_delete AFTER DELETE ON inventory BEGIN
+        INSERT INTO inventory_fts (inventory_fts, rowid, product_name, lot_number)
+        VALUES ('delete', old.id, old.product_name, old.lot_number);
+    END''')
+
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS inventory_fts_update AFTER UPDATE OF product_name, lot_number ON inventory BEGIN
+        INSERT INTO inventory_fts (inventory_fts, rowid, product_name, lot_number)
+        VALUES ('delete', old.id, old.product_name, old.lot_number);
+        INSERT INTO inventory_fts (rowid, product_name, lot_number)
+        VALUES (new.id, new.product_name, new.lot_number);
+    END''')
+
+    # 既存の在庫データをインデックスに登録
+    conn.execute("INSERT INTO inventory_fts (inventory_fts) VALUES ('rebuild')")
+
+
+# v4: テーブルごとの変更カウンター
+# 書き込みのたびにトリガーでバージョンを上げ、キャッシュの無効化に使う
+def _migration_4(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS data_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID''')
+    for table in ('inventory', 'history'):
+        _add_version_triggers(conn, table)
+
+
+def _add_version_triggers(conn, table):
+    conn.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)", (table,))
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+            UPDATE data_versions SET version = version + 1 WHERE name = '{table}';
+        END''')
+
+
+# v5: 在庫の増減を記録する台帳 (stock_movements) と残高のチェックポイント
+def _migration_5(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stock_movements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_name TEXT NOT NULL,
+        lot_number TEXT,
+        delta REAL NOT NULL,
+        unit TEXT,
+        reason TEXT NOT NULL,
+        timestamp TEXT NOT NULL DEFAULT (datetime('now'))
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_movements_product_time ON stock_movements (product_name, timestamp)')
+
+    # 商品ごとの現在の残高
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stock_balances (
+        product_name TEXT PRIMARY KEY,
+        balance REAL NOT NULL DEFAULT 0,
+        movements INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID''')
+
+    # 100件ごとに残高を保存し、累計を最初から計算し直さなくて済むようにする
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stock_checkpoints (
+        product_name TEXT NOT NULL,
+        movement_id INTEGER NOT NULL,
+        timestamp TEXT NOT NULL,
+        balance REAL NOT NULL,
+        PRIMARY KEY (product_name, timestamp, movement_id)
+    ) WITHOUT ROWID''')
+
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS stock_movements_balance AFTER INSERT ON stock_movements BEGIN
+        INSERT INTO stock_balances (product_name, balance, movements) VALUES (new.product_name, new.delta, 1)
+        ON CONFLICT (product_name) DO UPDATE SET balance = balance + new.delta, movements = movements + 1;
+        INSERT INTO stock_checkpoints (product_name, movement_id, timestamp, balance)
+        SELECT product_name, new.id, new.timestamp, balance FROM stock_balances
+        WHERE product_name = new.product_name AND movements % 100 = 0;
+    END''')
+
+    _add_version_triggers(conn, 'stock_movements')
+
+    # 既存の在庫を開始残高として登録する
+    conn.execute('''
+    INSERT INTO stock_movements (product_name, lot_number, delta, unit, reason)
+    SELECT product_name, lot_number, quantity, unit, 'opening' FROM inventory ORDER BY id''')
+
+
+# v6: 数量を整数の基本単位 (mg / µl) で保存する
+# units テーブルがあるので、合計や在庫の引き算はSQLだけで行える
+def _migration_6(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS units (
+        unit TEXT PRIMARY KEY,
+        dimension TEXT NOT NULL,
+        factor REAL NOT NULL
+    ) WITHOUT ROWID''')
+    conn.executemany("INSERT OR REPLACE INTO units (unit, dimension, factor) VALUES (?, ?, ?)",
+                     [(unit, dim, factor) for unit, (dim, factor) in units.UNITS.items()])
+
+    # 在庫とレシピの材料に基本単位の数量を追加 (quantity は表示用として残す)
+    for table in ('inventory', 'ingredients'):
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN quantity_base INTEGER')
+        conn.execute(f'''
+        UPDATE {table} SET quantity_base = CAST(ROUND(quantity * (
+            SELECT factor FROM units WHERE units.unit = {table}.unit)) AS INTEGER)''')
+
+    # quantity_base が変わったら表示用の quantity も更新する
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS inventory_display_quantity AFTER UPDATE OF quantity_base ON inventory BEGIN
+        UPDATE inventory SET quantity = new.quantity_base * 1.0 / (SELECT factor FROM units WHERE unit = new.unit)
+        WHERE id = new.id;
+    END''')
+
+    # 台帳の増減と残高も基本単位の整数で作り直す
+    conn.execute('DROP TRIGGER IF EXISTS stock_movements_balance')
+    for event in ('insert', 'update', 'delete'):
+        conn.execute(f'DROP TRIGGER IF EXISTS stock_movements_version_{event}')
+
+    conn.execute('''
+    CREATE TABLE stock_movements_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_name TEXT NOT NULL,
+        lot_number TEXT,
+        delta INTEGER NOT NULL,
+        unit TEXT,
+        reason TEXT NOT NULL,
+        timestamp TEXT NOT NULL DEFAULT (datetime('now'))
+    )''')
+    conn.execute('''
+    INSERT INTO stock_movements_new (id, product_name, lot_number, delta, unit, reason, timestamp)
+    SELECT m.id, m.product_name, m.lot_number, CAST(ROUND(m.delta * COALESCE(u.factor, 1)) AS INTEGER),
+           m.unit, m.reason, m.timestamp
+    FROM stock_movements m LEFT JOIN units u ON u.unit = m.unit''')
+    conn.execute('DROP TABLE stock_movements')
+    conn.execute('ALTER TABLE stock_movements_new RENAME TO stock_movements')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_movements_product_time ON stock_movements (product_name, timestamp)')
+
+    conn.execute('DROP TABLE stock_balances')
+    conn.execute('''
+    CREATE TABLE stock_balances (
+        product_name TEXT PRIMARY KEY,
+        balance INTEGER NOT NULL DEFAULT 0,
+        movements INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID''')
+    conn.execute('''
+    INSERT INTO stock_balances (product_name, balance, movements)
+    SELECT product_name, SUM(delta), COUNT(*) FROM stock_movements GROUP BY product_name''')
+
+    conn.execute('DROP TABLE stock_checkpoints')
+    conn.execute('''
+    CREATE TABLE stock_checkpoints (
+        product_name TEXT NOT NULL,
+        movement_id INTEGER NOT NULL,
+        timestamp TEXT NOT NULL,
+        balance INTEGER NOT NULL,
+        PRIMARY KEY (product_name, timestamp, movement_id)
+    ) WITHOUT ROWID''')
+    conn.execute('''
+    INSERT INTO stock_checkpoints (product_name, movement_id, timestamp, balance)
+    SELECT product_name, id, timestamp, balance FROM (
+        SELECT product_name, id, timestamp,
+               SUM(delta) OVER (PARTITION BY product_name ORDER BY id) AS balance,
+               ROW_NUMBER() OVER (PARTITION BY product_name ORDER BY id) AS n
+        FROM stock_movements)
+    WHERE n % 100 = 0''')
+
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS stock_movements_balance AFTER INSERT ON stock_movements BEGIN
+        INSERT INTO stock_balances (product_name, balance, movements) VALUES (new.product_name, new.delta, 1)
+        ON CONFLICT (product_name) DO UPDATE SET balance = balance + new.delta, movements = movements + 1;
+        INSERT INTO stock_checkpoints (product_name, movement_id, timestamp, balance)
+        SELECT product_name, new.id, new.timestamp, balance FROM stock_balances
+        WHERE product_name = new.product_name AND movements % 100 = 0;
+    END''')
+    _add_version_triggers(conn, 'stock_movements')
+
+
+# v7: ロットの自動割り当て (FEFO / FIFO) のための賞味期限・インデックスと割り当ての記録
+def _migration_7(conn):
+    conn.execute('ALTER TABLE inventory ADD COLUMN expiration_date TEXT')
+
+    # 入荷日を 'YYYY-MM-DD' にそろえて、文字列のまま古い順に並べられるようにする
+    conn.create_function('normalize_date', 1, dates.normalize_date)
+    conn.execute('UPDATE inventory SET received_date = normalize_date(received_date)')
+
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_inventory_fifo ON inventory (product_name, received_date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_inventory_fefo ON inventory (product_name, expiration_date, received_date)')
+
+    # 製造ごとにどのロットからどれだけ使ったか
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS manufacture_allocations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        manufacture_id INTEGER NOT NULL,
+        inventory_id INTEGER,
+        product_name TEXT NOT NULL,
+        lot_number TEXT NOT NULL,
+        quantity_base INTEGER NOT NULL
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_manufacture_allocations_manufacture ON manufacture_allocations (manufacture_id)')
+
+
+# v8: 変更カウンターに最終更新日時を追加し、レシピ・材料・製造記録も対象にする (APIの ETag / Last-Modified 用)
+def _migration_8(conn):
+    conn.execute('ALTER TABLE data_versions ADD COLUMN updated_at TEXT')
+    conn.execute("UPDATE data_versions SET updated_at = datetime('now')")
+    for table in ('inventory', 'history', 'stock_movements', 'recipes', 'ingredients', 'manufactures'):
+        _add_change_triggers(conn, table)
+
+
+def _add_change_triggers(conn, table):
+    conn.execute("INSERT OR IGNORE INTO data_versions (name, version, updated_at) VALUES (?, 0, datetime('now'))", (table,))
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {table}_version_{event.lower()}')
+        conn.execute(f'''
+        CREATE TRIGGER {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+            UPDATE data_versions SET version = version + 1, updated_at = datetime('now') WHERE name = '{table}';
+        END''')
+
+
+# v9: レシートファイルを内容のハッシュで保存し、inventory から参照されている数を数える (receipts.py)
+def _migration_9(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS receipts (
+        stored_name TEXT PRIMARY KEY,
+        original_name TEXT,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT
+    )''')
+    # receipts にない名前 (以前のファイル名で保存されたもの) は数えない
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS inventory_receipt_insert AFTER INSERT ON inventory
+    WHEN new.receipt_file IS NOT NULL BEGIN
+        UPDATE receipts SET refcount = refcount + 1 WHERE stored_name = new.receipt_file;
+    END''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS inventory_receipt_delete AFTER DELETE ON inventory
+    WHEN old.receipt_file IS NOT NULL BEGIN
+        UPDATE receipts SET refcount = refcount - 1 WHERE stored_name = old.receipt_file;
+    END''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS inventory_receipt_update AFTER UPDATE OF receipt_file ON inventory
+    WHEN old.receipt_file IS NOT new.receipt_file BEGIN
+        UPDATE receipts SET refcount = refcount - 1 WHERE stored_name = old.receipt_file;
+        UPDATE receipts SET refcount = refcount + 1 WHERE stored_name = new.receipt_file;
+    END''')
+
+
+# v10: バックグラウンドジョブ (jobs.py)
+def _migration_10(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        params TEXT NOT NULL,
+        status TEXT NOT NULL,
+        cache_key TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 1,
+        run_after TEXT NOT NULL,
+        error TEXT,
+        result_path TEXT,
+        mimetype TEXT,
+        filename TEXT,
+        created_at TEXT NOT NULL,
+        started_at TEXT,
+        finished_at TEXT
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, run_after)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_cache_key ON jobs (cache_key)')
+
+
+# v11: 商品ごとの在庫の合計 (inventory のトリガーで更新)、発注点・安全在庫と在庫不足のアラート (stock.py)
+def _migration_11(conn):
+    # 商品と質量/体積ごとの合計 (基本単位)。合計を SUM で計算し直さずに1行で確認できる
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stock_on_hand (
+        product_name TEXT NOT NULL,
+        dimension TEXT NOT NULL,
+        on_hand INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (product_name, dimension)
+    ) WITHOUT ROWID''')
+    conn.execute('''
+    INSERT INTO stock_on_hand (product_name, dimension, on_hand)
+    SELECT i.product_name, u.dimension, SUM(i.quantity_base)
+    FROM inventory i JOIN units u ON u.unit = i.unit
+    GROUP BY i.product_name, u.dimension''')
+
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS stock_on_hand_insert AFTER INSERT ON inventory
+    WHEN new.unit IN (SELECT unit FROM units) BEGIN
+        INSERT INTO stock_on_hand (product_name, dimension, on_hand)
+        VALUES (new.product_name, (SELECT dimension FROM units WHERE unit = new.unit), new.quantity_base)
+        ON CONFLICT (product_name, dimension) DO UPDATE SET on_hand = on_hand + excluded.on_hand;
+    END''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS stock_on_hand_delete AFTER DELETE ON inventory
+    WHEN old.unit IN (SELECT unit FROM units) BEGIN
+        UPDATE stock_on_hand SET on_hand = on_hand - old.quantity_base
+        WHERE product_name = old.product_name AND dimension = (SELECT dimension FROM units WHERE unit = old.unit);
+    END''')
+    # 商品・質量/体積が同じ場合は差分だけを足す (途中で在庫が減ったように見えてアラートが出ないようにする)
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS stock_on_hand_update AFTER UPDATE OF product_name, unit, quantity_base ON inventory
+    WHEN old.product_name = new.product_name
+     AND (SELECT dimension FROM units WHERE unit = old.unit) IS (SELECT dimension FROM units WHERE unit = new.unit) BEGIN
+        UPDATE stock_on_hand SET on_hand = on_hand + new.quantity_base - old.quantity_base
+        WHERE product_name = new.product_name AND dimension = (SELECT dimension FROM units WHERE unit = new.unit);
+    END''')
+    # 商品名・単位の種類が変わった場合は元の商品から引いて新しい商品に足す
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS stock_on_hand_move AFTER UPDATE OF product_name, unit, quantity_base ON inventory
+    WHEN old.product_name <> new.product_name
+      OR (SELECT dimension FROM units WHERE unit = old.unit) IS NOT (SELECT dimension FROM units WHERE unit = new.unit) BEGIN
+        UPDATE stock_on_hand SET on_hand = on_hand - old.quantity_base
+        WHERE product_name = old.product_name AND dimension = (SELECT dimension FROM units WHERE unit = old.unit);
+        INSERT INTO stock_on_hand (product_name, dimension, on_hand)
+        SELECT new.product_name, dimension, new.quantity_base FROM units WHERE unit = new.unit
+        ON CONFLICT (product_name, dimension) DO UPDATE SET on_hand = on_hand + excluded.on_hand;
+    END''')
+
+    # 発注点と安全在庫 (基本単位)。unit は画面に表示するときの単位
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS reorder_points (
+        product_name TEXT NOT NULL,
+        dimension TEXT NOT NULL,
+        reorder_point INTEGER NOT NULL,
+        safety_stock INTEGER NOT NULL DEFAULT 0,
+        unit TEXT NOT NULL,
+        PRIMARY KEY (product_name, dimension)
+    ) WITHOUT ROWID''')
+
+    # 在庫が発注点・安全在庫を下回ったときに1回だけアラートを追加する
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stock_alerts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_name TEXT NOT NULL,
+        dimension TEXT NOT NULL,
+        level TEXT NOT NULL,
+        on_hand INTEGER NOT NULL,
+        threshold INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        notified INTEGER NOT NULL DEFAULT 0,
+        acknowledged INTEGER NOT NULL DEFAULT 0
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_alerts_open ON stock_alerts (acknowledged, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_alerts_notified ON stock_alerts (notified) WHERE notified = 0')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS stock_on_hand_alert AFTER UPDATE OF on_hand ON stock_on_hand
+    WHEN new.on_hand < old.on_hand BEGIN
+        INSERT INTO stock_alerts (product_name, dimension, level, on_hand, threshold, created_at)
+        SELECT new.product_name, new.dimension,
+               CASE WHEN new.on_hand <= r.safety_stock THEN 'critical' ELSE 'low' END,
+               new.on_hand,
+               CASE WHEN new.on_hand <= r.safety_stock THEN r.safety_stock ELSE r.reorder_point END,
+               datetime('now')
+        FROM reorder_points r
+        WHERE r.product_name = new.product_name AND r.dimension = new.dimension
+          AND ((old.on_hand > r.reorder_point AND new.on_hand <= r.reorder_point)
+               OR (old.on_hand > r.safety_stock AND new.on_hand <= r.safety_stock));
+    END''')
+
+    for table in ('reorder_points', 'stock_alerts'):
+        _add_change_triggers(conn, table)
+
+
+# 賞味期限が過ぎているか ('YYYY-MM-DD' 以外の形式の日付と NULL は期限切れではない)
+def _expired(column):
+    return (f"COALESCE({column} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]' "
+            f"AND {column} < date('now', 'localtime'), 0)")
+
+
+def _create_available_update_trigger(conn, table):
+    conn.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS {table}_available_update AFTER UPDATE OF expiration_date ON {table} BEGIN
+        UPDATE {table} SET available = NOT {_expired('new.expiration_date')}
+        WHERE id = new.id AND available IS NOT (NOT {_expired('new.expiration_date')});
+    END''')
+
+
+# v12: 賞味期限の管理。期限切れの在庫・製品は available = 0 にして割り当て・製造可能数の計算から除く (expiry.py)
+def _migration_12(conn):
+    conn.create_function('normalize_date', 1, dates.normalize_date)
+    conn.execute('UPDATE manufactures SET manufacture_date = COALESCE(normalize_date(manufacture_date), manufacture_date), '
+                 'expiration_date = COALESCE(normalize_date(expiration_date), expiration_date)')
+    conn.execute('UPDATE inventory SET expiration_date = normalize_date(expiration_date)')
+
+    for table in ('inventory', 'manufactures'):
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN available INTEGER NOT NULL DEFAULT 1')
+        conn.execute(f"UPDATE {table} SET available = 0 WHERE {_expired('expiration_date')}")
+        # 利用できる行だけのインデックス。期限切れの確認と「N日以内に期限切れ」の検索は範囲スキャンで済む
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_expiring ON {table} (expiration_date) WHERE available = 1')
+        # 追加・期限の変更のときは、期限切れかどうかをすぐに反映する (時間の経過による期限切れは expiry.sweep() で反映)
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_available_insert AFTER INSERT ON {table}
+        WHEN {_expired('new.expiration_date')} BEGIN
+            UPDATE {table} SET available = 0 WHERE id = new.id;
+        END''')
+        _create_available_update_trigger(conn, table)
+
+    # 在庫の合計 (v11) は利用できるロットだけを数える
+    for trigger in ('stock_on_hand_insert', 'stock_on_hand_delete', 'stock_on_hand_update', 'stock_on_hand_move'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    conn.execute('''
+    UPDATE stock_on_hand SET on_hand = (
+        SELECT TOTAL(i.quantity_base) FROM inventory i JOIN units u ON u.unit = i.unit
+        WHERE i.product_name = stock_on_hand.product_name AND u.dimension = stock_on_hand.dimension
+          AND i.available = 1)''')
+
+    conn.execute('''
+    CREATE TRIGGER stock_on_hand_insert AFTER INSERT ON inventory
+    WHEN new.available AND new.unit IN (SELECT unit FROM units) BEGIN
+        INSERT INTO stock_on_hand (product_name, dimension, on_hand)
+        VALUES (new.product_name, (SELECT dimension FROM units WHERE unit = new.unit), new.quantity_base)
+        ON CONFLICT (product_name, dimension) DO UPDATE SET on_hand = on_hand + excluded.on_hand;
+    END''')
+    conn.execute('''
+    CREATE TRIGGER stock_on_hand_delete AFTER DELETE ON inventory
+    WHEN old.available AND old.unit IN (SELECT unit FROM units) BEGIN
+        UPDATE stock_on_hand SET on_hand = on_hand - old.quantity_base
+        WHERE product_name = old.product_name AND dimension = (SELECT dimension FROM units WHERE unit = old.unit);
+    END''')
+    # 商品・質量/体積が同じ場合は差分だけを足す (途中で在庫が減ったように見えてアラートが出ないようにする)
+    # トリガーの実行順に関係なく合計が合うように、差分も UPSERT で足す
+    conn.execute('''
+    CREATE TRIGGER stock_on_hand_update AFTER UPDATE OF product_name, unit, quantity_base, available ON inventory
+    WHEN old.product_name = new.product_name
+     AND (SELECT dimension FROM units WHERE unit = old.unit) IS (SELECT dimension FROM units WHERE unit = new.unit) BEGIN
+        INSERT INTO stock_on_hand (product_name, dimension, on_hand)
+        SELECT new.product_name, dimension, new.quantity_base * new.available - old.quantity_base * old.available
+        FROM units WHERE unit = new.unit
+        ON CONFLICT (product_name, dimension) DO UPDATE SET on_hand = on_hand + excluded.on_hand;
+    END''')
+    conn.execute('''
+    CREATE TRIGGER stock_on_hand_move AFTER UPDATE OF product_name, unit, quantity_base, available ON inventory
+    WHEN old.product_name <> new.product_name
+      OR (SELECT dimension FROM units WHERE unit = old.unit) IS NOT (SELECT dimension FROM units WHERE unit = new.unit) BEGIN
+        UPDATE stock_on_hand SET on_hand = on_hand - old.quantity_base * old.available
+        WHERE product_name = old.product_name AND dimension = (SELECT dimension FROM units WHERE unit = old.unit);
+        INSERT INTO stock_on_hand (product_name, dimension, on_hand)
+        SELECT new.product_name, dimension, new.quantity_base * new.available FROM units WHERE unit = new.unit
+        ON CONFLICT (product_name, dimension) DO UPDATE SET on_hand = on_hand + excluded.on_hand;
+    END''')
+
+
+# v13: 賞味期限を消したとき (NULL) に available が NULL になって更新に失敗していたトリガーを作り直す
+def _migration_13(conn):
+    for table in ('inventory', 'manufactures'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {table}_available_update')
+        _create_available_update_trigger(conn, table)
+
+
+# v14: 商品ごとの日・週・月の増減 (net) と期末残高 (closing) (ledger.history_series() で使う)
+# last_timestamp は期間の最後の増減の日時で、closing はその時点の残高
+def _migration_14(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stock_rollups (
+        product_name TEXT NOT NULL,
+        period TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        net INTEGER NOT NULL,
+        closing INTEGER NOT NULL,
+        movements INTEGER NOT NULL,
+        last_timestamp TEXT NOT NULL,
+        PRIMARY KEY (product_name, period, bucket)
+    ) WITHOUT ROWID''')
+
+    for period, bucket in ledger.ROLLUP_PERIODS.items():
+        conn.execute(f'''
+        INSERT INTO stock_rollups (product_name, period, bucket, net, closing, movements, last_timestamp)
+        SELECT product_name, '{period}', bucket, net, SUM(net) OVER (PARTITION BY product_name ORDER BY bucket),
+               movements, last_timestamp
+        FROM (SELECT product_name, {bucket.format('timestamp')} AS bucket, SUM(delta) AS net, COUNT(*) AS movements,
+                     MAX(timestamp) AS last_timestamp
+              FROM stock_movements GROUP BY product_name, bucket)
+        WHERE bucket IS NOT NULL''')
+
+        # 新しい期間の期末残高は直前の期間の期末残高から始める。
+        # 過去の日時の増減が追加された場合は、それより後の期間の期末残高も更新する (時刻順に追加されれば0行)
+        # 日時として読めない timestamp の増減は集計しない
+        new_bucket = bucket.format('new.timestamp')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS stock_movements_rollup_{period} AFTER INSERT ON stock_movements
+        WHEN {new_bucket} IS NOT NULL BEGIN
+            INSERT INTO stock_rollups (product_name, period, bucket, net, closing, movements, last_timestamp)
+            SELECT new.product_name, '{period}', {new_bucket}, new.delta,
+                   new.delta + COALESCE((SELECT closing FROM stock_rollups
+                                         WHERE product_name = new.product_name AND period = '{period}'
+                                           AND bucket < {new_bucket}
+                                         ORDER BY bucket DESC LIMIT 1), 0),
+                   1, new.timestamp
+            WHERE true
+            ON CONFLICT (product_name, period, bucket) DO UPDATE SET
+                net = net + excluded.net, closing = closing + excluded.net, movements = movements + 1,
+                last_timestamp = MAX(last_timestamp, excluded.last_timestamp);
+            UPDATE stock_rollups SET closing = closing + new.delta
+            WHERE product_name = new.product_name AND period = '{period}' AND bucket > {new_bucket};
+        END''')
+
+
+# v15: 表示用の quantity をトリガーで計算し直すのは quantity_base だけを更新した場合にする
+# (編集で quantity と quantity_base を一緒に更新したときに、入力した数量を換算の誤差のある値で上書きしていた)
+# 計算した値は基本単位より細かい桁を丸める。誤差が入った既存の数量も丸める
+def _migration_15(conn):
+    decimals = ' '.join(f"WHEN '{unit}' THEN {units.display_decimals(unit)}" for unit in units.UNITS)
+    conn.execute('DROP TRIGGER IF EXISTS inventory_display_quantity')
+    conn.execute(f'''
+    CREATE TRIGGER inventory_display_quantity AFTER UPDATE OF quantity_base ON inventory
+    WHEN new.quantity IS old.quantity BEGIN
+        UPDATE inventory SET quantity = ROUND(new.quantity_base * 1.0 / (SELECT factor FROM units WHERE unit = new.unit),
+                                              CASE new.unit {decimals} ELSE 6 END)
+        WHERE id = new.id;
+    END''')
+    conn.execute(f"UPDATE inventory SET quantity = ROUND(quantity, CASE unit {decimals} END) "
+                 f"WHERE unit IN ({', '.join(repr(unit) for unit in units.UNITS)}) "
+                 f"AND quantity <> ROUND(quantity, CASE unit {decimals} END)")
+
+
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+    _migration_8,
+    _migration_9,
+    _migration_10,
+    _migration_11,
+    _migration_12,
+    _migration_13,
+    _migration_14,
+    _migration_15,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+# テーブルの変更カウンターを返す
+def data_version(conn, table):
+    row = conn.execute("SELECT version FROM data_versions WHERE name = ?", (table,)).fetchone()
+    return row[0] if row else 0
+
+
+# 複数のテーブルの変更カウンターと最終更新日時 ('YYYY-MM-DD HH:MM:SS', UTC) をまとめて返す
+def data_versions(conn, tables):
+    placeholders = ', '.join('?' * len(tables))
+    rows = dict((name, (version, updated_at)) for name, version, updated_at in conn.execute(
+        f"SELECT name, version, updated_at FROM data_versions WHERE name IN ({placeholders})", tables))
+    versions = tuple(rows.get(table, (0, None))[0] for table in tables)
+    updated = [updated_at for version, updated_at in rows.values() if updated_at]
+    return versions, max(updated) if updated else None
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+# 未適用のマイグレーションを実行する。スキーマが最新なら何もしない
+def migrate(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    try:
+        if schema_version(conn) >= SCHEMA_VERSION:
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 他のプロセスが先にマイグレーションした可能性があるので再確認
+            version = schema_version(conn)
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {number}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import os
+    migrate(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inventory.db'))
+    print('Database schema is up to date.')
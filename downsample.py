@@ -0,0 +1,42 @@
+# 折れ線グラフの点の間引き (Largest-Triangle-Three-Buckets)
+#
+# 最初と最後の点は残し、間の点を threshold - 2 個のバケットに分ける。各バケットからは、
+# 直前に選んだ点と次のバケットの平均の点とで作る三角形の面積が最大になる点を1つ選ぶ。
+# 山や谷を残したまま点の数を threshold 個に減らせる (計算量は点の数に比例)。
+
+
+# xs は昇順の数値 (時刻の秒など)。戻り値は残す点のインデックスのリスト
+def lttb(xs, ys, threshold):
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    every = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+
+        # 次のバケットの平均 (最後のバケットの次は最後の点)
+        next_start = end
+        next_end = min(int((i + 2) * every) + 1, n)
+        if next_start >= n - 1:
+            avg_x, avg_y = xs[n - 1], ys[n - 1]
+        else:
+            count = next_end - next_start
+            avg_x = sum(xs[next_start:next_end]) / count
+            avg_y = sum(ys[next_start:next_end]) / count
+
+        ax, ay = xs[a], ys[a]
+        best = start
+        best_area = -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                best = j
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
@@ -0,0 +1,81 @@
+# 賞味期限の管理
+#
+# inventory と manufactures の expiration_date は 'YYYY-MM-DD' で保存し、
+# 利用できる行 (available = 1) だけの部分インデックスを作っている (db.py v12)。
+# - expiring(): N日以内に期限が切れる在庫・製品 (インデックスの範囲スキャン)
+# - sweep(): 期限が切れた行を available = 0 にする。部分インデックスには未処理の行しか入っていないので、
+#   新しく期限が切れた行だけを読む (テーブル全体は読まない)
+# 期限切れの在庫は割り当て (allocation.py)、製造可能数 (capacity.py)、在庫の合計 (stock_on_hand) から除かれる。
+import logging
+import threading
+import audit
+import db
+
+SWEEP_INTERVAL = 3600     # 期限切れを確認する間隔 (秒)
+DEFAULT_DAYS = 30
+
+logger = logging.getLogger(__name__)
+
+EXPIRED = ("expiration_date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]' "
+           "AND expiration_date < date('now', 'localtime')")
+
+
+# 今日から days 日以内に期限が切れる在庫と製品
+def expiring(conn, days=DEFAULT_DAYS):
+    until = f'+{int(days)} days'
+    lots = conn.execute('''
+        SELECT id, product_name, lot_number, quantity, unit, expiration_date FROM inventory
+        WHERE available = 1 AND expiration_date BETWEEN date('now', 'localtime') AND date('now', 'localtime', ?)
+        ORDER BY expiration_date''', (until,)).fetchall()
+    batches = conn.execute('''
+        SELECT id, drink_name, manufacture_date, quantity, unit, expiration_date FROM manufactures
+        WHERE available = 1 AND expiration_date BETWEEN date('now', 'localtime') AND date('now', 'localtime', ?)
+        ORDER BY expiration_date''', (until,)).fetchall()
+    return {
+        'inventory': [dict(zip(['id', 'product_name', 'lot_number', 'quantity', 'unit', 'expiration_date'], row))
+                      for row in lots],
+        'manufactures': [dict(zip(['id', 'drink_name', 'manufacture_date', 'quantity', 'unit', 'expiration_date'], row))
+                         for row in batches],
+    }
+
+
+# 期限が切れた在庫・製品を利用できないようにして、履歴に記録する。戻り値は (在庫の数, 製品の数)
+def sweep(conn):
+    lots = conn.execute(f'''
+        UPDATE inventory SET available = 0
+        WHERE available = 1 AND {EXPIRED}
+        RETURNING product_name, lot_number, expiration_date''').fetchall()
+    batches = conn.execute(f'''
+        UPDATE manufactures SET available = 0
+        WHERE available = 1 AND {EXPIRED}
+        RETURNING drink_name, manufacture_date, expiration_date''').fetchall()
+    history = ([('Expired', f'{product_name} (Lot: {lot_number}) expired on {expiration_date}')
+                for product_name, lot_number, expiration_date in lots] +
+               [('Expired', f'{drink_name} manufactured on {manufacture_date} expired on {expiration_date}')
+                for drink_name, manufacture_date, expiration_date in batches])
+    conn.commit()
+    audit.record_many(history)
+    return len(lots), len(batches)
+
+
+def _sweep_loop(app, interval, stop):
+    while True:
+        pool = db.get_pool(app.config['DATABASE'])
+        conn = pool.acquire()
+        try:
+            lots, batches = sweep(conn)
+            if lots or batches:
+                logger.info('Marked %d lots and %d batches as expired', lots, batches)
+        except Exception:
+            logger.exception('Expiry sweep failed')
+        finally:
+            pool.release(conn)
+        if stop.wait(interval):
+            break
+
+
+# 起動時と SWEEP_INTERVAL 秒ごとに sweep() を実行するスレッドを開始する。戻り値の Event で停止できる
+def start_sweeper(app, interval=SWEEP_INTERVAL):
+    stop = threading.Event()
+    threading.Thread(target=_sweep_loop, args=(app, interval, stop), name='expiry-sweeper', daemon=True).start()
+    return stop
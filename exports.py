@@ -0,0 +1,137 @@
+# CSVエクスポートのストリーミング
+#
+# 一時ファイルを使わず、カーソルから少しずつ読み出してCSVに変換し
+# そのままレスポンスとして送信する。メモリ使用量はテーブルの大きさに関係なく一定。
+# バックグラウンドジョブ (jobs.py) として実行した場合は、同じCSVをファイルに書き込む。
+import csv
+import io
+import zlib
+from flask import Response, stream_with_context
+import jobs
+
+CHUNK_ROWS = 1000  # 1回に読み出す行数
+
+INVENTORY_HEADER = ['ID', 'Product Name', 'Lot Number', 'Quantity', 'Unit', 'Received Date', 'Receipt File', 'Expiration Date']
+RECIPES_HEADER = ['Recipe ID', 'Drink Name', 'Ingredient Name', 'Quantity']
+
+
+def _int(args, name):
+    try:
+        return int(args[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# 絞り込みの条件 (product, from, to, after) から在庫のクエリを作る
+# args は request.args またはジョブのパラメータ (dict)
+def inventory_query(args):
+    conditions = []
+    params = []
+    if args.get('product'):
+        conditions.append('product_name = ?')
+        params.append(args['product'])
+    if args.get('from'):
+        conditions.append('received_date >= ?')
+        params.append(args['from'])
+    if args.get('to'):
+        conditions.append('received_date <= ?')
+        params.append(args['to'])
+    if _int(args, 'after') is not None:
+        conditions.append('id > ?')
+        params.append(_int(args, 'after'))
+
+    query = "SELECT id, product_name, lot_number, quantity, unit, received_date, receipt_file, expiration_date FROM inventory"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY id"
+    return query, params
+
+
+# 絞り込みの条件 (product, after) からレシピのクエリを作る
+def recipes_query(args):
+    conditions = []
+    params = []
+    if args.get('product'):
+        conditions.append('r.drink_name = ?')
+        params.append(args['product'])
+    if _int(args, 'after') is not None:
+        conditions.append('i.id > ?')
+        params.append(_int(args, 'after'))
+
+    query = """
+        SELECT r.id, r.drink_name, i.ingredient_name, i.quantity
+        FROM recipes r
+        JOIN ingredients i ON r.id = i.recipe_id
+    """
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY i.id"
+    return query, params
+
+
+# カーソルの結果をCSVの文字列として CHUNK_ROWS 行ずつ返す
+def csv_chunks(cursor, header, chunk_rows=CHUNK_ROWS):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            break
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+# gzip形式で圧縮しながら返す
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 で gzip ヘッダーを付ける
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def csv_response(chunks, filename, compress=False):
+    if compress:
+        chunks = gzip_chunks(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    else:
+        mimetype = 'text/csv'
+    # stream_with_context でリクエストが終わるまでDB接続を保持する
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+# CSVをファイルに書き込み、ジョブの結果の (mimetype, ファイル名) を返す
+# チャンクごとにキャンセルされていないか確認する
+def write_csv(out, chunks, filename, compress, job):
+    if compress:
+        chunks = gzip_chunks(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    else:
+        mimetype = 'text/csv'
+    for chunk in chunks:
+        job.check()
+        out.write(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+    return mimetype, filename
+
+
+@jobs.register('export_inventory', tables=['inventory'], limit=2)
+def export_inventory_job(conn, params, out, job):
+    query, args = inventory_query(params)
+    return write_csv(out, csv_chunks(conn.execute(query, args), INVENTORY_HEADER), 'inventory_export.csv',
+                     _int(params, 'gzip') == 1, job)
+
+
+@jobs.register('export_recipes', tables=['recipes', 'ingredients'], limit=2)
+def export_recipes_job(conn, params, out, job):
+    query, args = recipes_query(params)
+    return write_csv(out, csv_chunks(conn.execute(query, args), RECIPES_HEADER), 'recipes_export.csv',
+                     _int(params, 'gzip') == 1, job)
@@ -0,0 +1,51 @@
+# 一覧の行のHTMLのキャッシュ
+#
+# 在庫の一覧の行はテンプレートのマクロ (macros.html の inventory_row) で描画するが、
+# 行の内容 (id と各列の値) が前回と同じならマクロを呼ばずに前回のHTMLを使う。
+# 描画のコストはページの行数ではなく、変更された行の数に比例する。
+import threading
+from collections import OrderedDict
+from flask import current_app
+
+MAX_ENTRIES = 10000   # キャッシュする行の最大数
+
+
+class FragmentCache:
+    def __init__(self, template, macro, max_entries=MAX_ENTRIES):
+        self.template = template
+        self.macro = macro
+        self.max_entries = max_entries
+        self._cache = OrderedDict()   # id -> (行, HTML)
+        self._lock = threading.Lock()
+
+    # rows の各行 (先頭の列は id) のHTMLのリストを返す
+    def render(self, rows):
+        html = []
+        missing = []
+        with self._lock:
+            for row in rows:
+                entry = self._cache.get(row[0])
+                if entry and entry[0] == row:
+                    self._cache.move_to_end(row[0])
+                    html.append(entry[1])
+                else:
+                    html.append(None)
+                    missing.append(len(html) - 1)
+        if not missing:
+            return html
+
+        # テンプレートのモジュールは Jinja がコンパイル済みのものを使い回す
+        macro = getattr(current_app.jinja_env.get_template(self.template).module, self.macro)
+        for index in missing:
+            html[index] = macro(rows[index])
+        with self._lock:
+            for index in missing:
+                row = tuple(rows[index])
+                self._cache[row[0]] = (row, html[index])
+                self._cache.move_to_end(row[0])
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return html
+
+
+inventory_rows = FragmentCache('macros.html', 'inventory_row')
@@ -0,0 +1,125 @@
+# 在庫データの一括インポート
+#
+# export_inventory() と同じ列のCSVを少しずつ読み込み、CHUNK_ROWS 行ごとに
+# 検証・基本単位への変換を行って executemany でまとめて追加する (チャンクごとに1回コミット)。
+# ファイル全体をメモリに読み込まないので、大きなファイルでもメモリ使用量は一定。
+#
+# コマンドラインからも実行できる:
+#   python imports.py inventory_export.csv
+import csv
+import audit
+from dates import normalize_date
+import ledger
+import units
+
+CHUNK_ROWS = 1000
+MAX_ERRORS = 1000  # レポートに含めるエラーの最大数
+
+REQUIRED_COLUMNS = ['Product Name', 'Lot Number', 'Quantity', 'Unit', 'Received Date']
+OPTIONAL_COLUMNS = ['Receipt File', 'Expiration Date']
+
+
+# 1行を検証して (inventory の行, エラーメッセージ) を返す
+def _parse_row(row, columns):
+    def value(name):
+        index = columns.get(name)
+        return row[index].strip() if index is not None and index < len(row) else ''
+
+    product_name = value('Product Name')
+    lot_number = value('Lot Number')
+    unit = value('Unit')
+    if not product_name or not lot_number:
+        return None, 'Product Name and Lot Number are required'
+    if not units.is_valid(unit):
+        return None, f'Unknown unit: {unit}'
+    try:
+        quantity = float(value('Quantity'))
+    except ValueError:
+        return None, f"Invalid quantity: {value('Quantity')}"
+    received_date = normalize_date(value('Received Date'))
+    if not received_date:
+        return None, 'Received Date is required'
+
+    return (product_name, lot_number, quantity, unit, received_date, value('Receipt File') or None,
+            units.to_base(quantity, unit), normalize_date(value('Expiration Date'))), None
+
+
+def _insert_chunk(conn, rows):
+    conn.executemany("INSERT INTO inventory (product_name, lot_number, quantity, unit, received_date, receipt_file, quantity_base, expiration_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     rows)
+    ledger.record_movements(conn, [(row[0], row[1], row[6], row[3], 'add') for row in rows])
+    conn.commit()
+    audit.record_many([('Import Inventory', f"Added {row[2]} {row[3]} of {row[0]} (Lot: {row[1]}) on {row[4]}") for row in rows])
+
+
+# lines はCSVのテキストの行 (ファイルオブジェクトなど)
+# on_chunk はチャンクをコミットするたびに呼ばれる (バックグラウンドジョブのキャンセル確認用)
+# 戻り値は {'imported': 追加した行数, 'error_count': エラーの行数, 'errors': [{'line': 行番号, 'error': 内容}, ...]}
+def import_inventory_csv(conn, lines, chunk_rows=CHUNK_ROWS, on_chunk=None):
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    report = {'imported': 0, 'error_count': 0, 'errors': []}
+    if header is None:
+        report['error_count'] = 1
+        report['errors'].append({'line': 1, 'error': 'Empty file'})
+        return report
+
+    columns = {name.strip(): index for index, name in enumerate(header)}
+    missing = [name for name in REQUIRED_COLUMNS if name not in columns]
+    if missing:
+        report['error_count'] = 1
+        report['errors'].append({'line': 1, 'error': f'Missing columns: {", ".join(missing)}'})
+        return report
+
+    chunk = []
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue  # 空行
+        parsed, error = _parse_row(row, columns)
+        if error:
+            report['error_count'] += 1
+            if len(report['errors']) < MAX_ERRORS:
+                report['errors'].append({'line': reader.line_num, 'error': error})
+            continue
+        chunk.append(parsed)
+        if len(chunk) >= chunk_rows:
+            _insert_chunk(conn, chunk)
+            report['imported'] += len(chunk)
+            chunk = []
+            if on_chunk:
+                on_chunk()
+
+    if chunk:
+        _insert_chunk(conn, chunk)
+        report['imported'] += len(chunk)
+    return report
+
+
+# gzip で圧縮されたファイル (export_inventory?gzip=1) にも対応してテキストとして開く
+def open_csv(binary_stream, filename=''):
+    import gzip
+    import io
+    if filename.endswith('.gz'):
+        binary_stream = gzip.GzipFile(fileobj=binary_stream)
+    return io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='')
+
+
+if __name__ == '__main__':
+    import json
+    import os
+    import sys
+    import db
+
+    if len(sys.argv) != 2:
+        print('Usage: python imports.py <inventory.csv>')
+        sys.exit(1)
+    database_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inventory.db')
+    db.migrate(database_path)
+    audit.init(database_path, start=False)  # 履歴はチャンクごとにその場で書き込む
+    pool = db.get_pool(database_path)
+    conn = pool.acquire()
+    try:
+        with open(sys.argv[1], 'rb') as f:
+            print(json.dumps(import_inventory_csv(conn, open_csv(f, sys.argv[1])), indent=2))
+    finally:
+        pool.release(conn)
@@ -0,0 +1,326 @@
+# バックグラウンドジョブ
+#
+# 時間のかかる処理 (CSVエクスポート、グラフの描画、一括インポートなど) をリクエストのスレッドではなく
+# ワーカースレッドで実行する。ジョブは jobs テーブルに保存するので、再起動しても実行待ちのジョブは失われない。
+#   POST /jobs                 {"kind": 種類, "params": {...}} -> 202 と状態のURL
+#   GET  /jobs/<id>            状態 (queued / running / done / failed / cancelled)
+#   GET  /jobs/<id>/result     結果のファイル (完了していなければ 409)
+#   POST /jobs/<id>/cancel     キャンセル
+#
+# - ジョブの種類は register() で登録する。種類ごとに同時に実行する数を制限できる
+# - 結果がテーブル (tables) の内容だけで決まるジョブは、同じパラメータでテーブルが変わっていなければ
+#   前回のジョブ (実行中のものを含む) をそのまま返す
+# - 失敗したジョブは RETRY_DELAY 秒、その倍、... と待ってから max_attempts 回まで再実行する
+# - 複数のプロセスで動かしても、ジョブは UPDATE ... WHERE status = 'queued' で1つのプロセスだけが取得する
+#   (種類ごとの同時実行数の制限はプロセスごと)
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, jsonify, request, send_file, url_for
+import db
+from db import get_db
+
+WORKERS = 4               # 同時に実行するジョブの最大数
+POLL_INTERVAL = 1.0       # 実行待ちのジョブを確認する間隔 (秒)
+RETRY_DELAY = 2           # 1回目の再実行までの秒数
+RESULT_TTL_HOURS = 24     # 終了したジョブと結果のファイルを残す時間
+PRUNE_INTERVAL = 60       # 古いジョブを削除する間隔 (秒)
+
+bp = Blueprint('jobs', __name__, url_prefix='/jobs')
+logger = logging.getLogger(__name__)
+
+Kind = namedtuple('Kind', ['handler', 'tables', 'limit', 'max_attempts'])
+_kinds = {}
+_queue = None
+
+
+class Cancelled(Exception):
+    pass
+
+
+# ジョブの種類を登録するデコレーター
+# handler(conn, params, out, job) は結果を out (バイナリのファイル) に書き込み、(mimetype, ファイル名) を返す。
+# 長い処理の途中で job.check() を呼ぶと、キャンセルされていれば Cancelled が発生する。
+# tables: 結果が依存するテーブル (空の場合は結果をキャッシュしない)
+def register(kind, tables=(), limit=1, max_attempts=3):
+    def decorator(handler):
+        _kinds[kind] = Kind(handler, tuple(tables), limit, max_attempts)
+        return handler
+    return decorator
+
+
+# 実行中のジョブから使う
+class JobContext:
+    def __init__(self, pool, job_id):
+        self.pool = pool
+        self.id = job_id
+
+    # ハンドラーの接続は読み込み中のカーソルが開始時のスナップショットを保持していて、
+    # 後からコミットされたキャンセルが見えないので、別の接続で状態を確認する
+    def check(self):
+        conn = self.pool.acquire()
+        try:
+            row = conn.execute("SELECT status FROM jobs WHERE id = ?", (self.id,)).fetchone()
+        finally:
+            self.pool.release(conn)
+        if row is None or row[0] == 'cancelled':
+            raise Cancelled()
+
+
+class JobQueue:
+    def __init__(self, app, workers=WORKERS):
+        self.app = app
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._running = {}    # job_id -> kind
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._last_prune = 0
+
+    @property
+    def result_folder(self):
+        return self.app.config['JOB_FOLDER']
+
+    def _pool(self):
+        return db.get_pool(self.app.config['DATABASE'])
+
+    def start(self):
+        pool = self._pool()
+        conn = pool.acquire()
+        try:
+            # 前回のプロセスが実行中に終了したジョブをやり直す
+            conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+            conn.commit()
+        finally:
+            pool.release(conn)
+        self._thread = threading.Thread(target=self._loop, name='job-dispatcher', daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+            try:
+                self._dispatch()
+            except Exception:
+                logger.exception('Job dispatcher failed')
+
+    # 実行できるジョブを取得してワーカーに渡す
+    def _dispatch(self):
+        with self._lock:
+            running = Counter(self._running.values())
+        free = self.workers - sum(running.values())
+
+        pool = self._pool()
+        conn = pool.acquire()
+        try:
+            if free > 0:
+                queued = conn.execute("SELECT id, kind FROM jobs WHERE status = 'queued' AND run_after <= datetime('now') "
+                                      "ORDER BY id").fetchall()
+                for job_id, kind in queued:
+                    if free <= 0:
+                        break
+                    spec = _kinds.get(kind)
+                    if spec is None:
+                        conn.execute("UPDATE jobs SET status = 'failed', error = 'Unknown job kind', finished_at = datetime('now') WHERE id = ?",
+                                     (job_id,))
+                        conn.commit()
+                        continue
+                    if running[kind] >= spec.limit:
+                        continue
+                    claimed = conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = datetime('now') "
+                                           "WHERE id = ? AND status = 'queued'", (job_id,)).rowcount
+                    conn.commit()
+                    if not claimed:
+                        continue  # 他のプロセスが先に取得した
+                    running[kind] += 1
+                    free -= 1
+                    with self._lock:
+                        self._running[job_id] = kind
+                    self._executor.submit(self._run, job_id)
+
+            if time.monotonic() - self._last_prune > PRUNE_INTERVAL:
+                self._last_prune = time.monotonic()
+                self._prune(conn)
+        finally:
+            pool.release(conn)
+
+    def _run(self, job_id):
+        pool = self._pool()
+        conn = pool.acquire()
+        part_path = os.path.join(self.result_folder, f'{job_id}.part')
+        try:
+            kind, params, attempts, max_attempts = conn.execute(
+                "SELECT kind, params, attempts, max_attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            try:
+                # ハンドラーは current_app.config を使えるようにアプリコンテキストの中で実行する
+                with self.app.app_context(), open(part_path, 'wb') as out:
+                    mimetype, filename = _kinds[kind].handler(conn, json.loads(params), out, JobContext(pool, job_id))
+                conn.commit()
+                result_path = os.path.join(self.result_folder, str(job_id))
+                os.replace(part_path, result_path)
+                finished = conn.execute("UPDATE jobs SET status = 'done', result_path = ?, mimetype = ?, filename = ?, error = NULL, "
+                                        "finished_at = datetime('now') WHERE id = ? AND status = 'running'",
+                                        (result_path, mimetype, filename, job_id)).rowcount
+                if not finished:
+                    os.remove(result_path)  # 実行中にキャンセルされた
+            except Cancelled:
+                conn.rollback()
+            except Exception as e:
+                conn.rollback()
+                logger.exception('Job %s (%s) failed', job_id, kind)
+                if attempts < max_attempts:
+                    delay = RETRY_DELAY * 2 ** (attempts - 1)
+                    conn.execute("UPDATE jobs SET status = 'queued', error = ?, run_after = datetime('now', ?) "
+                                 "WHERE id = ? AND status = 'running'", (str(e), f'+{delay} seconds', job_id))
+                else:
+                    conn.execute("UPDATE jobs SET status = 'failed', error = ?, finished_at = datetime('now') "
+                                 "WHERE id = ? AND status = 'running'", (str(e), job_id))
+            conn.commit()
+        except Exception:
+            logger.exception('Job %s could not be finished', job_id)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            pool.release(conn)
+            with self._lock:
+                self._running.pop(job_id, None)
+            self.wake()
+
+    # RESULT_TTL_HOURS より前に終了したジョブと結果のファイルを削除する
+    def _prune(self, conn):
+        cutoff = f'-{RESULT_TTL_HOURS} hours'
+        old = conn.execute("SELECT id, result_path FROM jobs WHERE status IN ('done', 'failed', 'cancelled') "
+                           "AND finished_at < datetime('now', ?)", (cutoff,)).fetchall()
+        if not old:
+            return
+        conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id, path in old])
+        conn.commit()
+        for job_id, path in old:
+            if path and os.path.exists(path):
+                os.remove(path)
+
+
+# start=False の場合はディスパッチャーを起動しない (ジョブは追加されるが実行されない)
+def init_app(app, start=True):
+    global _queue
+    app.config.setdefault('JOB_FOLDER', os.path.join(os.path.dirname(app.config['DATABASE']), 'job_results'))
+    os.makedirs(app.config['JOB_FOLDER'], exist_ok=True)
+    app.register_blueprint(bp)
+    _queue = JobQueue(app)
+    if start:
+        _queue.start()
+
+
+def _cache_key(conn, kind, params):
+    versions = db.data_versions(conn, list(_kinds[kind].tables))[0]
+    return hashlib.sha1(json.dumps([kind, params, versions], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# ジョブを追加してIDを返す。同じ結果になるジョブがあればそのIDを返す。知らない種類は ValueError
+def submit(conn, kind, params):
+    spec = _kinds.get(kind)
+    if spec is None:
+        raise ValueError(f'Unknown job kind: {kind}')
+
+    cache_key = None
+    if spec.tables:
+        cache_key = _cache_key(conn, kind, params)
+        row = conn.execute("SELECT id FROM jobs WHERE cache_key = ? AND status IN ('queued', 'running', 'done') "
+                           "ORDER BY id DESC LIMIT 1", (cache_key,)).fetchone()
+        if row:
+            return row[0]
+
+    job_id = conn.execute("INSERT INTO jobs (kind, params, status, cache_key, max_attempts, run_after, created_at) "
+                          "VALUES (?, ?, 'queued', ?, ?, datetime('now'), datetime('now'))",
+                          (kind, json.dumps(params), cache_key, spec.max_attempts)).lastrowid
+    conn.commit()
+    if _queue:
+        _queue.wake()
+    return job_id
+
+
+# 実行待ち・実行中のジョブをキャンセルする。キャンセルできた場合は True
+def cancel(conn, job_id):
+    cancelled = conn.execute("UPDATE jobs SET status = 'cancelled', finished_at = datetime('now') "
+                             "WHERE id = ? AND status IN ('queued', 'running')", (job_id,)).rowcount
+    conn.commit()
+    return bool(cancelled)
+
+
+def _status(row):
+    job_id, kind, status, attempts, error, created_at, started_at, finished_at = row
+    body = {'id': job_id, 'kind': kind, 'status': status, 'attempts': attempts, 'error': error,
+            'created_at': created_at, 'started_at': started_at, 'finished_at': finished_at,
+            'status_url': url_for('jobs.job_status', job_id=job_id)}
+    if status == 'done':
+        body['result_url'] = url_for('jobs.job_result', job_id=job_id)
+    return body
+
+
+def _load(job_id):
+    return get_db().execute("SELECT id, kind, status, attempts, error, created_at, started_at, finished_at "
+                            "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+# ジョブを追加して 202 と状態を返す (エクスポートなどのルートの async=1 からも使う)
+def submit_response(kind, params):
+    params = {name: value for name, value in dict(params).items() if name != 'async'}
+    try:
+        job_id = submit(get_db(), kind, params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    response = jsonify(_status(_load(job_id)))
+    response.status_code = 202
+    response.headers['Location'] = url_for('jobs.job_status', job_id=job_id)
+    return response
+
+
+@bp.route('', methods=['POST'])
+def submit_job():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not body.get('kind'):
+        return jsonify({'error': 'kind is required'}), 400
+    params = body.get('params') or {}
+    if not isinstance(params, dict):
+        return jsonify({'error': 'params must be an object'}), 400
+    return submit_response(body['kind'], params)
+
+
+@bp.route('/<int:job_id>')
+def job_status(job_id):
+    row = _load(job_id)
+    if row is None:
+        return jsonify({'error': 'not found'}), 404
+    return jsonify(_status(row))
+
+
+@bp.route('/<int:job_id>/result')
+def job_result(job_id):
+    row = get_db().execute("SELECT status, result_path, mimetype, filename FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return jsonify({'error': 'not found'}), 404
+    status, result_path, mimetype, filename = row
+    if status != 'done':
+        return jsonify({'error': f'job is {status}', 'status': status}), 409
+    if not os.path.exists(result_path):
+        return jsonify({'error': 'result has expired'}), 410
+    return send_file(result_path, mimetype=mimetype, as_attachment=True, download_name=filename)
+
+
+@bp.route('/<int:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if _load(job_id) is None:
+        return jsonify({'error': 'not found'}), 404
+    if not cancel(get_db(), job_id):
+        return jsonify({'error': 'job has already finished'}), 409
+    return jsonify(_status(_load(job_id)))
@@ -0,0 +1,167 @@
+# 在庫の増減の台帳 (stock_movements)
+#
+# 在庫を変更する処理は必ずここから増減を記録する。
+# delta は基本単位 (units.py の mg / µl) の整数で、増えた場合は正、減った場合は負。
+# unit はロットの表示用の単位。
+# reason: 'opening' / 'add' / 'edit' / 'delete' / 'produce' / 'manufacture'
+#
+# 商品ごとの日・週・月の増減と期末残高は stock_rollups にトリガーで保存している (db.py v14)。
+# history_series() は期間の長さから使う単位を選び、点が多ければ LTTB (downsample.py) で間引くので、
+# 何年分の履歴でもほぼ一定の時間で読み込める。
+from datetime import datetime
+import downsample
+import units
+
+# 集計の単位と、日時からその期間の開始日を求める SQL の式 ({} に日時の式を入れる)
+ROLLUP_PERIODS = {
+    'day': "date({})",
+    'week': "date({}, 'weekday 0', '-6 days')",   # 月曜日から
+    'month': "date({}, 'start of month')",
+}
+PERIOD_DAYS = {'day': 1, 'week': 7, 'month': 31}
+RAW_DAYS = 7              # これ以下の期間は台帳の行をそのまま使う
+MAX_POINTS = 500          # 履歴のグラフの最大の点の数
+
+
+def record_movement(conn, product_name, lot_number, delta, unit, reason):
+    conn.execute("INSERT INTO stock_movements (product_name, lot_number, delta, unit, reason) VALUES (?, ?, ?, ?, ?)",
+                 (product_name, lot_number, delta, unit, reason))
+
+
+# movements は (product_name, lot_number, delta, unit, reason) のリスト
+def record_movements(conn, movements):
+    conn.executemany("INSERT INTO stock_movements (product_name, lot_number, delta, unit, reason) VALUES (?, ?, ?, ?, ?)",
+                     movements)
+
+
+# start より前の時点での残高
+# 直前のチェックポイントから start までの増減だけを足すので、台帳全体は読まない
+def opening_balance(conn, product_name, start):
+    checkpoint = conn.execute('''
+        SELECT movement_id, timestamp, balance FROM stock_checkpoints
+        WHERE product_name = ? AND timestamp < ?
+        ORDER BY timestamp DESC, movement_id DESC LIMIT 1''', (product_name, start)).fetchone()
+    if checkpoint:
+        movement_id, since, balance = checkpoint
+    else:
+        movement_id, since, balance = 0, '', 0
+
+    rest = conn.execute('''
+        SELECT TOTAL(delta) FROM stock_movements
+        WHERE product_name = ? AND timestamp >= ? AND timestamp < ? AND id > ?''',
+        (product_name, since, start, movement_id)).fetchone()[0]
+    return balance + rest
+
+
+# 指定期間の残高の推移を (timestamps, balances) で返す
+# start, end は 'YYYY-MM-DD HH:MM:SS' 形式 (省略すると全期間)
+def balance_series(conn, product_name, start=None, end=None):
+    conditions = ['product_name = ?']
+    params = [product_name]
+    balance = 0
+    if start:
+        balance = opening_balance(conn, product_name, start)
+        conditions.append('timestamp >= ?')
+        params.append(start)
+    if end:
+        conditions.append('timestamp <= ?')
+        params.append(end)
+
+    rows = conn.execute(f'''
+        SELECT timestamp, delta FROM stock_movements
+        WHERE {' AND '.join(conditions)}
+        ORDER BY timestamp, id''', params)
+
+    timestamps = []
+    balances = []
+    for timestamp, delta in rows:
+        balance += delta
+        timestamps.append(timestamp)
+        balances.append(balance)
+    return timestamps, balances
+
+
+# 集計済みの残高の推移を (timestamps, balances) で返す
+# timestamps は各期間の最後の増減の日時 (balances はその時点の残高)
+def rollup_series(conn, product_name, period, start=None, end=None):
+    conditions = ['product_name = ?', 'period = ?']
+    params = [product_name, period]
+    if start:
+        conditions.append(f"bucket >= {ROLLUP_PERIODS[period].format('?')} AND last_timestamp >= ?")
+        params += [start, start]
+    if end:
+        conditions.append('bucket <= ? AND last_timestamp <= ?')
+        params += [end, end]
+    rows = conn.execute(f'''
+        SELECT last_timestamp, closing FROM stock_rollups
+        WHERE {' AND '.join(conditions)}
+        ORDER BY bucket''', params).fetchall()
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+
+def _parse(timestamp):
+    return datetime.fromisoformat(timestamp)
+
+
+# 画面や API で指定された期間 ('YYYY-MM-DD' または 'YYYY-MM-DD HH:MM:SS', 省略可) をそろえる
+# end が日付だけの場合はその日の終わりまで含める。形式が正しくなければ ValueError
+def normalize_range(start, end):
+    start = start or None
+    end = end or None
+    if end and len(end) == 10:
+        end += ' 23:59:59'
+    for value in (start, end):
+        if value:
+            _parse(value)
+    return start, end
+
+
+# days 日間の推移に使う集計の単位 (台帳の行をそのまま使う場合は None)
+def rollup_period(days, max_points=MAX_POINTS):
+    if days <= RAW_DAYS:
+        return None
+    for period in ('day', 'week'):
+        if days / PERIOD_DAYS[period] <= max_points:
+            return period
+    return 'month'
+
+
+# グラフ用の残高の推移。期間に合った単位で読み込み、max_points 個まで間引く
+# period で単位を指定できる ('raw' は台帳の行をそのまま使う。None は期間の長さから選ぶ)
+# 戻り値は (timestamps, balances, 使った単位 (台帳の場合は None))。日時の形式が正しくなければ ValueError
+def history_series(conn, product_name, start=None, end=None, max_points=MAX_POINTS, period=None):
+    if period is None:
+        # 期間は指定された範囲と実際に増減がある範囲の重なり (MIN / MAX はインデックスの端を読むだけ)
+        first = conn.execute("SELECT MIN(timestamp) FROM stock_movements WHERE product_name = ?", (product_name,)).fetchone()[0]
+        last = conn.execute("SELECT MAX(timestamp) FROM stock_movements WHERE product_name = ?", (product_name,)).fetchone()[0]
+        if first is None:
+            return [], [], None
+        span_start = max(_parse(start), _parse(first)) if start else _parse(first)
+        span_end = min(_parse(end), _parse(last)) if end else _parse(last)
+        period = rollup_period(max((span_end - span_start).total_seconds() / 86400, 0), max_points)
+    elif period == 'raw':
+        period = None
+    elif period not in ROLLUP_PERIODS:
+        raise ValueError(f'Unknown period: {period}')
+
+    if period:
+        timestamps, balances = rollup_series(conn, product_name, period, start, end)
+    else:
+        timestamps, balances = balance_series(conn, product_name, start, end)
+
+    if len(timestamps) > max_points:
+        seconds = [_parse(timestamp).timestamp() for timestamp in timestamps]
+        keep = downsample.lttb(seconds, balances, max_points)
+        timestamps = [timestamps[i] for i in keep]
+        balances = [balances[i] for i in keep]
+    return timestamps, balances, period
+
+
+# 商品の残高を表示する単位 (g / ml)。最後の増減の単位の種類から決める (わからなければ None)
+def display_unit(conn, product_name):
+    row = conn.execute("SELECT unit FROM stock_movements WHERE product_name = ? ORDER BY timestamp DESC LIMIT 1",
+                       (product_name,)).fetchone()
+    if row and units.is_valid(row[0]):
+        return units.DISPLAY_UNITS[units.dimension(row[0])]
+    return None
+
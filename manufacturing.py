@@ -0,0 +1,126 @@
+# まとめて製造 (複数のレシピ・複数バッチを1つのトランザクションで処理する)
+#
+# 1. 全レシピの材料をまとめて読み込み、材料ごとの必要量を合計する
+# 2. 在庫が足りるかを1つのクエリで確認する (足りなければ何も変更しない)
+# 3. ロットを割り当て (allocation.py)、在庫の引き算、台帳・割り当ての追加を executemany でまとめて行う
+# 4. コミットした後に履歴を記録する (audit.py)
+# 在庫を減らす処理はすべて db.write_transaction() の中で deduct() を使う (同時に製造しても在庫が負にならない)
+from allocation import Allocator
+import audit
+import db
+import ledger
+import units
+
+
+class InsufficientStock(Exception):
+    def __init__(self, shortages):
+        super().__init__('Insufficient stock: ' + ', '.join(s['product_name'] for s in shortages))
+        self.shortages = shortages
+
+
+class UnknownRecipe(Exception):
+    pass
+
+
+# plan は {'recipe_id': int, 'batches': int, 'quantity': 任意, 'unit': 任意, 'drink_name': 任意} のリスト
+# 戻り値は追加した製造記録の数
+def manufacture_batch(conn, plan, manufacture_date, expiration_date):
+    recipe_ids = sorted({item['recipe_id'] for item in plan})
+    placeholders = ', '.join('?' * len(recipe_ids))
+
+    def work(conn):
+        recipes = dict(conn.execute(f"SELECT id, drink_name FROM recipes WHERE id IN ({placeholders})",
+                                    recipe_ids).fetchall())
+        missing = [recipe_id for recipe_id in recipe_ids if recipe_id not in recipes]
+        if missing:
+            raise UnknownRecipe(f'Unknown recipe: {missing}')
+
+        ingredients = {}
+        for recipe_id, ingredient_name, quantity_base, unit in conn.execute(
+                f"SELECT recipe_id, ingredient_name, quantity_base, unit FROM ingredients WHERE recipe_id IN ({placeholders})",
+                recipe_ids):
+            ingredients.setdefault(recipe_id, []).append((ingredient_name, quantity_base, units.dimension(unit)))
+
+        # 材料 (商品名, 質量/体積) ごとの必要量を合計
+        demand = {}
+        for item in plan:
+            for ingredient_name, quantity_base, dimension in ingredients.get(item['recipe_id'], []):
+                key = (ingredient_name, dimension)
+                demand[key] = demand.get(key, 0) + quantity_base * item['batches']
+
+        shortages = check_availability(conn, demand)
+        if shortages:
+            raise InsufficientStock(shortages)
+
+        # レシピごとにロットを割り当てて (FEFO / FIFO)、製造記録と一緒に保存する
+        allocator = Allocator(conn)
+        deductions = []
+        movements = []
+        allocations = []
+        history = []
+        for item in plan:
+            drink_name = item.get('drink_name') or recipes[item['recipe_id']]
+            quantity = item.get('quantity', item['batches'])
+            unit = item.get('unit', 'batch')
+            # 割り当ての記録に製造IDが必要なので、製造記録は1件ずつ追加する
+            manufacture_id = conn.execute(
+                "INSERT INTO manufactures (drink_name, manufacture_date, expiration_date, quantity, unit) VALUES (?, ?, ?, ?, ?)",
+                (drink_name, manufacture_date, expiration_date, quantity, unit)).lastrowid
+            history.append(('Manufacture', f"Manufactured {quantity} {unit} of {drink_name} on {manufacture_date}, Expiry: {expiration_date}"))
+
+            for ingredient_name, quantity_base, dimension in ingredients.get(item['recipe_id'], []):
+                picks, short = allocator.allocate(ingredient_name, dimension, quantity_base * item['batches'])
+                if short:
+                    raise InsufficientStock([{'product_name': ingredient_name, 'dimension': dimension,
+                                              'needed': quantity_base * item['batches'],
+                                              'available': quantity_base * item['batches'] - short}])
+                for lot_id, lot_number, lot_unit, used in picks:
+                    deductions.append((lot_id, ingredient_name, used))
+                    movements.append((ingredient_name, lot_number, -used, lot_unit, 'manufacture'))
+                    allocations.append((manufacture_id, lot_id, ingredient_name, lot_number, used))
+
+        deduct(conn, deductions)
+        ledger.record_movements(conn, movements)
+        record_allocations(conn, allocations)
+        return history
+
+    history = db.write_transaction(conn, work)
+    audit.record_many(history)
+    return len(history)
+
+
+# 在庫を減らす。deductions は (inventory_id, 商品名, 使用量) のリスト
+# 残量が使用量以上の利用できるロットだけを減らし (条件付きの UPDATE)、更新されなかったロットがあれば
+# InsufficientStock を送出する (write_transaction() がトランザクションごとロールバックする)
+def deduct(conn, deductions):
+    for lot_id, product_name, used in deductions:
+        updated = conn.execute("UPDATE inventory SET quantity_base = quantity_base - ? "
+                               "WHERE id = ? AND quantity_base >= ? AND available = 1", (used, lot_id, used)).rowcount
+        if updated != 1:
+            row = conn.execute("SELECT quantity_base FROM inventory WHERE id = ? AND available = 1", (lot_id,)).fetchone()
+            raise InsufficientStock([{'product_name': product_name, 'inventory_id': lot_id, 'needed': used,
+                                      'available': row[0] if row else 0}])
+
+
+# 必要量と在庫の合計を1つのクエリで比較し、足りない材料を返す
+def check_availability(conn, demand):
+    if not demand:
+        return []
+    values = ', '.join(['(?, ?, ?)'] * len(demand))
+    params = [value for (name, dimension), needed in demand.items() for value in (name, dimension, needed)]
+    rows = conn.execute(f'''
+        WITH demand (product_name, dimension, needed) AS (VALUES {values})
+        SELECT d.product_name, d.dimension, d.needed, TOTAL(i.quantity_base) AS on_hand
+        FROM demand d
+        LEFT JOIN units u ON u.dimension = d.dimension
+        LEFT JOIN inventory i ON i.product_name = d.product_name AND i.unit = u.unit AND i.quantity_base > 0 AND i.available = 1
+        GROUP BY d.product_name, d.dimension, d.needed
+        HAVING on_hand < d.needed''', params).fetchall()
+    return [{'product_name': name, 'dimension': dimension, 'needed': needed, 'available': int(available)}
+            for name, dimension, needed, available in rows]
+
+
+# allocations は (manufacture_id, inventory_id, product_name, lot_number, quantity_base) のリスト
+def record_allocations(conn, allocations):
+    conn.executemany("INSERT INTO manufacture_allocations (manufacture_id, inventory_id, product_name, lot_number, quantity_base) VALUES (?, ?, ?, ?, ?)",
+                     allocations)
@@ -0,0 +1,290 @@
+# リクエストと SQL の計測
+#
+# GET /metrics で Prometheus のテキスト形式で出力する。
+#   http_request_duration_seconds   ルート (endpoint) ごとのレイテンシのヒストグラム
+#   http_requests_total             ルート・メソッド・ステータスごとのリクエスト数
+#   http_request_sql_statements     1リクエストで実行した SQL の文の数のヒストグラム
+#   sql_statements_total / sql_seconds_total / sql_rows_total / sql_slow_queries_total
+#                                   ルートごとの SQL の文の数・時間・返した行数・遅いクエリの数
+#                                   (リクエストの外のジョブやスレッドの分は endpoint="background")
+# - 文の数は接続のトレースコールバックで数える (トリガーの中で実行された文も含む)
+# - 時間と行数は db._connect() が作る MeteredConnection のカーソルで測る
+#   (SELECT は execute と fetch の合計。ストリーミングのレスポンスの本体を送る時間はレイテンシに含まない)
+# - SLOW_QUERY_SECONDS 以上かかったクエリは EXPLAIN QUERY PLAN と一緒にログに出力する
+# - app.config['PROFILING'] が True の場合、?profile=1 を付けたリクエストを cProfile で計測して
+#   レスポンスの代わりに結果 (text/plain) を返す
+import bisect
+import cProfile
+import io
+import logging
+import pstats
+import sqlite3
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import Blueprint, current_app, g, request
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SLOW_QUERY_SECONDS = 0.1
+PROFILE_LINES = 40        # プロファイルの結果に出力する関数の数
+BACKGROUND = 'background'
+
+bp = Blueprint('metrics', __name__)
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # 最後は +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+# SQL の文の数・時間 (秒)・返した行数
+class SqlStats:
+    __slots__ = ('statements', 'seconds', 'rows', 'slow')
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.slow = 0
+
+    def add(self, other):
+        self.statements += other.statements
+        self.seconds += other.seconds
+        self.rows += other.rows
+        self.slow += other.slow
+
+
+_requests = Counter()                                        # (endpoint, method, status) -> 数
+_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))   # (endpoint, method) -> Histogram
+_statements = defaultdict(lambda: Histogram(STATEMENT_BUCKETS))  # endpoint -> Histogram
+_sql = defaultdict(SqlStats)                                 # endpoint -> SqlStats
+
+
+# リクエスト中ならそのリクエストの SqlStats。リクエストの外では None
+def _current():
+    return getattr(_local, 'stats', None)
+
+
+def _record(statements=0, seconds=0.0, rows=0, slow=0):
+    stats = _current()
+    if stats is None:
+        with _lock:
+            stats = _sql[BACKGROUND]
+            stats.statements += statements
+            stats.seconds += seconds
+            stats.rows += rows
+            stats.slow += slow
+        return
+    stats.statements += statements
+    stats.seconds += seconds
+    stats.rows += rows
+    stats.slow += slow
+
+
+# sqlite3 のトレースコールバック (接続で文が実行されるたびに呼ばれる)
+def trace(statement):
+    _record(statements=1)
+
+
+def _log_slow(conn, sql, parameters, elapsed):
+    try:
+        # 計測しない素のカーソルで実行する
+        plan = sqlite3.Cursor(conn).execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+        plan = '\n'.join(f'  {detail}' for _, _, _, detail in plan)
+    except sqlite3.Error as e:
+        plan = f'  (no plan: {e})'
+    logger.warning('Slow query (%.1f ms): %s\n%s', elapsed * 1000, ' '.join(sql.split()), plan)
+
+
+# 実行と読み込みの時間、返した行数を測るカーソル
+class MeteredCursor(sqlite3.Cursor):
+    _sql = None
+    _parameters = ()
+    _elapsed = 0.0
+    _logged = True
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        self._sql, self._parameters, self._elapsed, self._logged = sql, parameters, 0.0, False
+        self._measured(time.perf_counter() - start, 0)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        # パラメータは読み切っているので EXPLAIN QUERY PLAN は出力しない
+        self._sql, self._parameters, self._elapsed, self._logged = sql, None, 0.0, False
+        self._measured(time.perf_counter() - start, 0)
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._measured(time.perf_counter() - start, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._measured(time.perf_counter() - start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._measured(time.perf_counter() - start, len(rows))
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        row = super().__next__()
+        self._measured(time.perf_counter() - start, 1)
+        return row
+
+    def _measured(self, elapsed, rows):
+        self._elapsed += elapsed
+        slow = not self._logged and self._elapsed >= SLOW_QUERY_SECONDS
+        _record(seconds=elapsed, rows=rows, slow=slow)
+        if slow:
+            self._logged = True
+            if self._parameters is None:
+                logger.warning('Slow query (%.1f ms): %s', self._elapsed * 1000, ' '.join(self._sql.split()))
+            else:
+                _log_slow(self.connection, self._sql, self._parameters, self._elapsed)
+
+
+# db._connect() で使う接続のクラス。conn.execute() も MeteredCursor を使う
+class MeteredConnection(sqlite3.Connection):
+    def cursor(self, factory=MeteredCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def _before_request():
+    _local.stats = SqlStats()
+    g.metrics_start = time.perf_counter()
+    if current_app.config.get('PROFILING') and request.args.get('profile') == '1':
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def _after_request(response):
+    stats = _current()
+    if stats is None or 'metrics_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.metrics_start
+    with _lock:
+        _requests[(_endpoint(), request.method, response.status_code)] += 1
+        _latency[(_endpoint(), request.method)].observe(elapsed)
+    logger.debug('%s %s %s %.1f ms, %d statements (%.1f ms), %d rows', request.method, request.path,
+                 response.status_code, elapsed * 1000, stats.statements, stats.seconds * 1000, stats.rows)
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        out = io.StringIO()
+        out.write(f'{request.method} {request.full_path} -> {response.status_code} in {elapsed * 1000:.1f} ms, '
+                  f'{stats.statements} SQL statements ({stats.seconds * 1000:.1f} ms), {stats.rows} rows\n\n')
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        response = current_app.response_class(out.getvalue(), mimetype='text/plain')
+    return response
+
+
+# SQL の集計はリクエストの終了時に行う。stream_with_context のレスポンスでは、本体を送り終えたときにも
+# もう一度呼ばれるので、送信中に読んだ行はその分として追加する
+def _teardown_request(exc=None):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+    stats = _current()
+    if stats is None:
+        return
+    _local.stats = SqlStats()
+    with _lock:
+        if 'metrics_observed' not in g:
+            g.metrics_observed = True
+            _statements[_endpoint()].observe(stats.statements)
+        _sql[_endpoint()].add(stats)
+
+
+def _labels(**labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _histogram_lines(name, histogram, **labels):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+        cumulative += count
+        yield f'{name}_bucket{_labels(**labels, le=bound)} {cumulative}'
+    yield f'{name}_sum{_labels(**labels)} {histogram.sum}'
+    yield f'{name}_count{_labels(**labels)} {cumulative}'
+
+
+# Prometheus のテキスト形式
+def render():
+    lines = []
+    with _lock:
+        lines += ['# HELP http_request_duration_seconds Request latency by endpoint.',
+                  '# TYPE http_request_duration_seconds histogram']
+        for (endpoint, method), histogram in sorted(_latency.items()):
+            lines += _histogram_lines('http_request_duration_seconds', histogram, endpoint=endpoint, method=method)
+
+        lines += ['# HELP http_requests_total Requests by endpoint, method and status.',
+                  '# TYPE http_requests_total counter']
+        lines += [f'http_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {count}'
+                  for (endpoint, method, status), count in sorted(_requests.items())]
+
+        lines += ['# HELP http_request_sql_statements SQL statements executed per request.',
+                  '# TYPE http_request_sql_statements histogram']
+        for endpoint, histogram in sorted(_statements.items()):
+            lines += _histogram_lines('http_request_sql_statements', histogram, endpoint=endpoint)
+
+        for name, attribute, help_text in (
+                ('sql_statements_total', 'statements', 'SQL statements executed.'),
+                ('sql_seconds_total', 'seconds', 'Time spent executing SQL and reading rows.'),
+                ('sql_rows_total', 'rows', 'Rows returned by SQL queries.'),
+                ('sql_slow_queries_total', 'slow', f'Queries slower than {SLOW_QUERY_SECONDS} seconds.')):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            lines += [f'{name}{_labels(endpoint=endpoint)} {getattr(stats, attribute)}'
+                      for endpoint, stats in sorted(_sql.items())]
+    return '\n'.join(lines) + '\n'
+
+
+# エンドポイントごとの SQL の合計 {endpoint: (文の数, 秒, 行数)} (ベンチマークで使う)
+def sql_totals():
+    with _lock:
+        return {endpoint: (stats.statements, stats.seconds, stats.rows) for endpoint, stats in _sql.items()}
+
+
+@bp.route('/metrics')
+def metrics():
+    return current_app.response_class(render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.register_blueprint(bp)
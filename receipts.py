@@ -0,0 +1,125 @@
+# レシートファイルの保存 (内容のハッシュで保存する)
+#
+# アップロードされたファイルはチャンクごとにハッシュを計算しながらディスクに書き込み、
+# '<sha256>.<拡張子>' の名前で保存する。同じ内容のファイルは1つだけ保存される。
+# inventory.receipt_file から参照されている数は receipts.refcount にトリガーで数えていて (db.py v9)、
+# 参照がなくなったファイルは release() で削除する。
+# 画像のサムネイルはバックグラウンドで uploads/thumbs/ に作る。
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import db
+
+CHUNK_SIZE = 64 * 1024
+THUMBNAIL_SIZE = (200, 200)
+THUMBNAIL_FOLDER = 'thumbs'
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+_STORED_NAME = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbnail')
+
+logger = logging.getLogger(__name__)
+
+
+# 内容のハッシュで保存された名前か (変更されないので長くキャッシュできる)
+def is_stored_name(filename):
+    return bool(_STORED_NAME.match(filename))
+
+
+def thumbnail_name(filename):
+    return os.path.splitext(filename)[0] + '.png'
+
+
+def thumbnail_path(upload_folder, filename):
+    return os.path.join(upload_folder, THUMBNAIL_FOLDER, thumbnail_name(filename))
+
+
+def has_thumbnail(upload_folder, filename):
+    return os.path.exists(thumbnail_path(upload_folder, filename))
+
+
+# アップロードされたファイル (werkzeug の FileStorage) を保存して、保存した名前を返す
+# receipts に行を追加するだけで、参照数は inventory に保存したときにトリガーで増える
+def store(conn, file, upload_folder):
+    extension = os.path.splitext(file.filename)[1].lower()
+    digest = hashlib.sha256()
+    size = 0
+
+    # 一時ファイルに書き込みながらハッシュを計算する (ファイル全体をメモリに読み込まない)
+    fd, temp_path = tempfile.mkstemp(dir=upload_folder, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = file.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+
+        stored_name = digest.hexdigest() + extension
+        path = os.path.join(upload_folder, stored_name)
+
+        # release() は書き込みのロックを持ったまま参照のなくなったファイルを削除するので、
+        # 同じロックを取ってからファイルがあるか確認する。ロックは呼び出し元がコミットする
+        # (inventory から参照して refcount が増える) まで持ち続ける
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        if os.path.exists(path):
+            os.remove(temp_path)  # 同じ内容のファイルが既にある
+        else:
+            os.replace(temp_path, path)
+        conn.execute("INSERT INTO receipts (stored_name, original_name, size, created_at) VALUES (?, ?, ?, datetime('now')) "
+                     "ON CONFLICT (stored_name) DO NOTHING",
+                     (stored_name, file.filename, size))
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    if extension in IMAGE_EXTENSIONS and not has_thumbnail(upload_folder, stored_name):
+        _executor.submit(make_thumbnail, path, thumbnail_path(upload_folder, stored_name))
+    return stored_name
+
+
+# 画像を縮小して PNG で保存する。Pillow がない場合はサムネイルを作らない (元の画像を表示する)
+def make_thumbnail(path, destination):
+    try:
+        from PIL import Image
+    except ImportError:
+        return
+    try:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with Image.open(path) as image:
+            image.thumbnail(THUMBNAIL_SIZE)
+            temp_path = destination + '.part'
+            image.save(temp_path, 'PNG')
+        os.replace(temp_path, destination)
+    except Exception:
+        logger.exception('Failed to create thumbnail for %s', path)
+
+
+# 参照がなくなったファイル (refcount = 0) を削除する。変更をコミットした後に呼ぶ
+# store() が同じファイルを使い始めないように、行とファイルの削除は1つの書き込みトランザクションで行う
+def release(conn, filenames, upload_folder):
+    filenames = [filename for filename in set(filenames) if filename and is_stored_name(filename)]
+    if not filenames:
+        return
+    placeholders = ', '.join('?' * len(filenames))
+
+    def work(conn):
+        unused = [row[0] for row in conn.execute(
+            f"SELECT stored_name FROM receipts WHERE stored_name IN ({placeholders}) AND refcount <= 0", filenames)]
+        if not unused:
+            return
+        conn.execute(f"DELETE FROM receipts WHERE stored_name IN ({', '.join('?' * len(unused))}) AND refcount <= 0", unused)
+        for filename in unused:
+            for path in (os.path.join(upload_folder, filename), thumbnail_path(upload_folder, filename)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    db.write_transaction(conn, work)
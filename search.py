@@ -0,0 +1,48 @@
+# 在庫の全文検索 (inventory_fts を使用)
+#
+# trigram トークナイザーなので3文字以上の検索語は部分一致・前方一致で検索できる。
+# 一致する在庫がない場合は、検索語の trigram のいずれかを含む在庫を
+# 関連度順に返す(ロット番号の打ち間違いなどに対応するため)。
+
+MIN_TERM_LENGTH = 3  # trigram で検索できる最短の文字数
+
+
+# FTS5 の文字列として扱えるようにダブルクォートで囲む
+def _quote(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _trigrams(term):
+    return {term[i:i + MIN_TERM_LENGTH] for i in range(len(term) - MIN_TERM_LENGTH + 1)}
+
+
+def _ranked(conn, match, limit, offset):
+    return conn.execute('''
+        SELECT inventory.* FROM inventory_fts
+        JOIN inventory ON inventory.id = inventory_fts.rowid
+        WHERE inventory_fts MATCH ?
+        ORDER BY rank
+        LIMIT ? OFFSET ?''', (match, limit, offset)).fetchall()
+
+
+# 検索結果を関連度順に返す。page は1から
+# 戻り値は (rows, has_next)
+def search_inventory(conn, term, page=1, page_size=50):
+    term = term.strip()
+    offset = (page - 1) * page_size
+
+    if len(term) < MIN_TERM_LENGTH:
+        # 短すぎる検索語は trigram で検索できないので LIKE で検索
+        rows = conn.execute('''
+            SELECT * FROM inventory WHERE product_name LIKE ? OR lot_number LIKE ?
+            ORDER BY id LIMIT ? OFFSET ?''',
+            ('%' + term + '%', '%' + term + '%', page_size + 1, offset)).fetchall()
+    else:
+        match = _quote(term)
+        exists = conn.execute('SELECT 1 FROM inventory_fts WHERE inventory_fts MATCH ? LIMIT 1', (match,)).fetchone()
+        if not exists:
+            # 完全に一致するものがなければあいまい検索に切り替える
+            match = ' OR '.join(_quote(gram) for gram in sorted(_trigrams(term)))
+        rows = _ranked(conn, match, page_size + 1, offset)
+
+    return rows[:page_size], len(rows) > page_size
@@ -0,0 +1,195 @@
+// 在庫のグラフ (SVG)
+//
+// サーバーは JSON (/api/v1/inventory_totals, /api/v1/inventory_history/...) を返すだけで、描画はブラウザで行う。
+//   InventoryCharts.bar(container, labels, values, units)
+//       商品ごとの在庫の棒グラフ
+//   InventoryCharts.line(container, timestamps, values, unit, onZoom)
+//       在庫推移の折れ線グラフ (timestamps は UNIX 時間の秒)。
+//       ドラッグで範囲を選ぶと onZoom(start, end) を呼ぶ (start, end は UNIX 時間の秒)
+const InventoryCharts = (() => {
+    const SVG = 'http://www.w3.org/2000/svg';
+    const WIDTH = 960;
+    const HEIGHT = 420;
+    const MARGIN = {top: 20, right: 20, bottom: 40, left: 80};
+    const BAR_MARGIN_BOTTOM = 120;  // 棒グラフは商品名を斜めに表示する
+    const TICKS = 6;
+
+    function element(name, attributes, parent) {
+        const node = document.createElementNS(SVG, name);
+        for (const [key, value] of Object.entries(attributes || {})) {
+            node.setAttribute(key, value);
+        }
+        if (parent) {
+            parent.appendChild(node);
+        }
+        return node;
+    }
+
+    function text(parent, x, y, content, attributes) {
+        const node = element('text', Object.assign({x: x, y: y, 'font-size': 12, 'font-family': 'sans-serif'}, attributes), parent);
+        node.textContent = content;
+        return node;
+    }
+
+    function svg(container, height) {
+        container.replaceChildren();
+        return element('svg', {viewBox: `0 0 ${WIDTH} ${height}`, width: '100%', role: 'img'}, container);
+    }
+
+    // min から max までを含むきりのいい目盛り (1, 2, 5 x 10^n 刻み)
+    function ticks(min, max) {
+        if (min === max) {
+            max = min + 1;
+        }
+        const raw = (max - min) / TICKS;
+        const magnitude = Math.pow(10, Math.floor(Math.log10(raw)));
+        const step = [1, 2, 5, 10].map(m => m * magnitude).find(s => s >= raw);
+        const first = Math.floor(min / step);
+        const last = Math.ceil(max / step);
+        const values = [];
+        for (let i = first; i <= last; i++) {
+            values.push(Number((i * step).toPrecision(12)));
+        }
+        return values;
+    }
+
+    function formatNumber(value) {
+        return value.toLocaleString(undefined, {maximumFractionDigits: 2});
+    }
+
+    // 期間が2日以内なら時刻も表示する (UTC)
+    function formatTime(seconds, span) {
+        const iso = new Date(seconds * 1000).toISOString();
+        return span <= 2 * 86400 ? iso.slice(0, 16).replace('T', ' ') : iso.slice(0, 10);
+    }
+
+    function yAxis(parent, scale, values, width, unit) {
+        for (const value of values) {
+            const y = scale(value);
+            element('line', {x1: MARGIN.left, x2: width - MARGIN.right, y1: y, y2: y, stroke: '#ddd'}, parent);
+            text(parent, MARGIN.left - 6, y + 4, formatNumber(value), {'text-anchor': 'end'});
+        }
+        if (unit) {
+            text(parent, 12, MARGIN.top + 4, unit);
+        }
+    }
+
+    function empty(container) {
+        container.replaceChildren();
+        const message = document.createElement('p');
+        message.textContent = 'No data.';
+        container.appendChild(message);
+    }
+
+    function bar(container, labels, values, units) {
+        if (!labels.length) {
+            return empty(container);
+        }
+        const height = HEIGHT + BAR_MARGIN_BOTTOM - MARGIN.bottom;
+        const root = svg(container, height);
+        const bottom = height - BAR_MARGIN_BOTTOM;
+        const yValues = ticks(Math.min(0, ...values), Math.max(0, ...values));
+        const yMin = yValues[0];
+        const yMax = yValues[yValues.length - 1];
+        const y = value => bottom - (value - yMin) / (yMax - yMin) * (bottom - MARGIN.top);
+        yAxis(root, y, yValues, WIDTH);
+
+        const band = (WIDTH - MARGIN.left - MARGIN.right) / labels.length;
+        labels.forEach((label, i) => {
+            const x = MARGIN.left + i * band;
+            const top = Math.min(y(values[i]), y(0));
+            const rect = element('rect', {x: x + band * 0.1, y: top, width: band * 0.8,
+                                          height: Math.abs(y(values[i]) - y(0)), fill: '#1f77b4'}, root);
+            element('title', {}, rect).textContent = `${label}: ${formatNumber(values[i])} ${units[i]}`;
+            text(root, x + band / 2, bottom + 12, label,
+                 {'text-anchor': 'end', transform: `rotate(-40 ${x + band / 2} ${bottom + 12})`});
+        });
+    }
+
+    function line(container, timestamps, values, unit, onZoom) {
+        if (!timestamps.length) {
+            return empty(container);
+        }
+        const root = svg(container, HEIGHT);
+        const bottom = HEIGHT - MARGIN.bottom;
+        const right = WIDTH - MARGIN.right;
+        const tMin = timestamps[0];
+        const tMax = Math.max(timestamps[timestamps.length - 1], tMin + 1);
+        const yValues = ticks(Math.min(...values), Math.max(...values));
+        const yMin = yValues[0];
+        const yMax = yValues[yValues.length - 1];
+        const x = t => MARGIN.left + (t - tMin) / (tMax - tMin) * (right - MARGIN.left);
+        const y = value => bottom - (value - yMin) / (yMax - yMin) * (bottom - MARGIN.top);
+        const time = px => tMin + (px - MARGIN.left) / (right - MARGIN.left) * (tMax - tMin);
+        yAxis(root, y, yValues, WIDTH, unit);
+
+        for (let i = 0; i < TICKS; i++) {
+            const t = tMin + (tMax - tMin) * i / (TICKS - 1);
+            text(root, x(t), bottom + 18, formatTime(t, tMax - tMin), {'text-anchor': i === 0 ? 'start' : i === TICKS - 1 ? 'end' : 'middle'});
+        }
+
+        const points = timestamps.map((t, i) => `${x(t).toFixed(1)},${y(values[i]).toFixed(1)}`).join(' ');
+        element('polyline', {points: points, fill: 'none', stroke: '#1f77b4', 'stroke-width': 1.5}, root);
+        if (timestamps.length <= 100) {
+            timestamps.forEach((t, i) => element('circle', {cx: x(t), cy: y(values[i]), r: 3, fill: '#1f77b4'}, root));
+        }
+
+        // マウスの位置に一番近い点の値を表示する
+        const marker = element('circle', {r: 4, fill: '#d62728', visibility: 'hidden'}, root);
+        const label = text(root, right, MARGIN.top - 6, '', {'text-anchor': 'end'});
+        const selection = element('rect', {y: MARGIN.top, height: bottom - MARGIN.top, fill: 'rgba(31, 119, 180, 0.15)',
+                                           visibility: 'hidden'}, root);
+        const overlay = element('rect', {x: MARGIN.left, y: MARGIN.top, width: right - MARGIN.left,
+                                         height: bottom - MARGIN.top, fill: 'transparent', cursor: 'crosshair'}, root);
+        const position = event => {
+            const box = root.getBoundingClientRect();
+            return Math.min(Math.max((event.clientX - box.left) * WIDTH / box.width, MARGIN.left), right);
+        };
+        let dragStart = null;
+
+        overlay.addEventListener('mousemove', event => {
+            const px = position(event);
+            const t = time(px);
+            let nearest = 0;
+            for (let i = 1; i < timestamps.length; i++) {
+                if (Math.abs(timestamps[i] - t) < Math.abs(timestamps[nearest] - t)) {
+                    nearest = i;
+                }
+            }
+            marker.setAttribute('cx', x(timestamps[nearest]));
+            marker.setAttribute('cy', y(values[nearest]));
+            marker.setAttribute('visibility', 'visible');
+            label.textContent = `${formatTime(timestamps[nearest], 0)}  ${formatNumber(values[nearest])} ${unit || ''}`;
+            if (dragStart !== null) {
+                selection.setAttribute('x', Math.min(dragStart, px));
+                selection.setAttribute('width', Math.abs(px - dragStart));
+            }
+        });
+        overlay.addEventListener('mouseleave', () => {
+            marker.setAttribute('visibility', 'hidden');
+            selection.setAttribute('visibility', 'hidden');
+            dragStart = null;
+        });
+        if (onZoom) {
+            overlay.addEventListener('mousedown', event => {
+                dragStart = position(event);
+                selection.setAttribute('x', dragStart);
+                selection.setAttribute('width', 0);
+                selection.setAttribute('visibility', 'visible');
+            });
+            overlay.addEventListener('mouseup', event => {
+                if (dragStart === null) {
+                    return;
+                }
+                const px = position(event);
+                selection.setAttribute('visibility', 'hidden');
+                if (Math.abs(px - dragStart) >= 5) {  // クリックだけの場合は拡大しない
+                    onZoom(Math.floor(time(Math.min(dragStart, px))), Math.ceil(time(Math.max(dragStart, px))));
+                }
+                dragStart = null;
+            });
+        }
+    }
+
+    return {bar: bar, line: line};
+})();
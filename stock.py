@@ -0,0 +1,127 @@
+# 在庫不足の確認 (発注点・安全在庫)
+#
+# 商品ごとの在庫の合計は stock_on_hand テーブルに inventory のトリガーで保存している (db.py v11)。
+# 在庫不足の確認は1行を読むだけで、全ロットの SUM は計算しない。
+# 在庫が発注点・安全在庫を下回ると、トリガーが stock_alerts にアラートを追加する。
+#   low       発注点以下 (発注が必要)
+#   critical  安全在庫以下
+import logging
+import db
+import units
+
+logger = logging.getLogger(__name__)
+
+
+def _status(on_hand, reorder_point, safety_stock):
+    if on_hand <= safety_stock:
+        return 'critical'
+    if on_hand <= reorder_point:
+        return 'low'
+    return 'ok'
+
+
+def _to_dict(product_name, dimension, on_hand, reorder_point, safety_stock, unit):
+    return {'product_name': product_name, 'dimension': dimension, 'unit': unit,
+            'on_hand': units.from_base(on_hand, unit),
+            'reorder_point': units.from_base(reorder_point, unit),
+            'safety_stock': units.from_base(safety_stock, unit),
+            'status': _status(on_hand, reorder_point, safety_stock)}
+
+
+# 商品の在庫の合計 (基本単位)
+def on_hand(conn, product_name, dimension):
+    row = conn.execute("SELECT on_hand FROM stock_on_hand WHERE product_name = ? AND dimension = ?",
+                       (product_name, dimension)).fetchone()
+    return row[0] if row else 0
+
+
+# 商品と質量/体積ごとの在庫の合計 (g / ml)。在庫がない商品は含めない
+def totals(conn):
+    rows = conn.execute("SELECT product_name, dimension, on_hand FROM stock_on_hand WHERE on_hand <> 0 "
+                        "ORDER BY product_name, dimension").fetchall()
+    return [{'product_name': product_name, 'dimension': dimension, 'unit': units.DISPLAY_UNITS[dimension],
+             'quantity': units.to_display(on_hand, dimension)}
+            for product_name, dimension, on_hand in rows]
+
+
+# 発注点を設定する。数量は unit の単位で指定する。知らない単位や安全在庫が発注点より多い場合は ValueError
+def set_reorder_point(conn, product_name, reorder_point, safety_stock, unit):
+    if not units.is_valid(unit):
+        raise ValueError(f'Unknown unit: {unit}')
+    reorder_base = units.to_base(reorder_point, unit)
+    safety_base = units.to_base(safety_stock, unit)
+    if reorder_base < 0 or safety_base < 0:
+        raise ValueError('Reorder point and safety stock must not be negative')
+    if safety_base > reorder_base:
+        raise ValueError('Safety stock must not be greater than the reorder point')
+    conn.execute('''
+        INSERT INTO reorder_points (product_name, dimension, reorder_point, safety_stock, unit) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (product_name, dimension) DO UPDATE SET
+            reorder_point = excluded.reorder_point, safety_stock = excluded.safety_stock, unit = excluded.unit''',
+                 (product_name, units.dimension(unit), reorder_base, safety_base, unit))
+
+
+def delete_reorder_point(conn, product_name, dimension):
+    conn.execute("DELETE FROM reorder_points WHERE product_name = ? AND dimension = ?", (product_name, dimension))
+
+
+# 1つの商品の在庫の状態 (発注点が設定されていなければ None)
+def check(conn, product_name, dimension):
+    row = conn.execute('''
+        SELECT r.product_name, r.dimension, COALESCE(s.on_hand, 0), r.reorder_point, r.safety_stock, r.unit
+        FROM reorder_points r
+        LEFT JOIN stock_on_hand s ON s.product_name = r.product_name AND s.dimension = r.dimension
+        WHERE r.product_name = ? AND r.dimension = ?''', (product_name, dimension)).fetchone()
+    return _to_dict(*row) if row else None
+
+
+# 発注点が設定されている全商品 (low_only=True の場合は発注点以下の商品だけ)
+def reorder_status(conn, low_only=False):
+    rows = conn.execute(f'''
+        SELECT r.product_name, r.dimension, COALESCE(s.on_hand, 0) AS on_hand, r.reorder_point, r.safety_stock, r.unit
+        FROM reorder_points r
+        LEFT JOIN stock_on_hand s ON s.product_name = r.product_name AND s.dimension = r.dimension
+        {'WHERE COALESCE(s.on_hand, 0) <= r.reorder_point' if low_only else ''}
+        ORDER BY CAST(COALESCE(s.on_hand, 0) AS REAL) / MAX(r.reorder_point, 1), r.product_name''').fetchall()
+    return [_to_dict(*row) for row in rows]
+
+
+def low_stock(conn):
+    return reorder_status(conn, low_only=True)
+
+
+# 確認されていないアラート (新しい順)
+def open_alerts(conn, limit=50):
+    rows = conn.execute('''
+        SELECT a.id, a.product_name, a.dimension, a.level, a.on_hand, a.threshold, a.created_at
+        FROM stock_alerts a
+        WHERE a.acknowledged = 0
+        ORDER BY a.id DESC LIMIT ?''', (limit,)).fetchall()
+    display = units.DISPLAY_UNITS
+    return [{'id': alert_id, 'product_name': product_name, 'level': level,
+             'on_hand': units.to_display(on_hand, dimension), 'threshold': units.to_display(threshold, dimension),
+             'unit': display[dimension], 'created_at': created_at}
+            for alert_id, product_name, dimension, level, on_hand, threshold, created_at in rows]
+
+
+def acknowledge(conn, alert_id):
+    return conn.execute("UPDATE stock_alerts SET acknowledged = 1 WHERE id = ? AND acknowledged = 0", (alert_id,)).rowcount
+
+
+# トリガーが追加したアラートをログに出力する (在庫を変更するリクエストの後に呼ぶ)
+# リクエストの接続で呼ぶと未コミットの変更までコミットしてしまうので、別の接続を渡す。
+# コミット済みのアラートだけを通知済みにして、コミットした後にログに出力する
+def notify(conn):
+    if conn.execute("SELECT 1 FROM stock_alerts WHERE notified = 0 LIMIT 1").fetchone() is None:
+        return 0
+
+    def work(conn):
+        rows = conn.execute("SELECT id, product_name, dimension, level, on_hand, threshold FROM stock_alerts WHERE notified = 0").fetchall()
+        conn.executemany("UPDATE stock_alerts SET notified = 1 WHERE id = ?", [(row[0],) for row in rows])
+        return rows
+
+    rows = db.write_transaction(conn, work)
+    for alert_id, product_name, dimension, level, on_hand, threshold in rows:
+        logger.warning('Stock %s: %s is at %s %s (threshold %s)', level, product_name, units.to_display(on_hand, dimension),
+                       units.DISPLAY_UNITS[dimension], units.to_display(threshold, dimension))
+    return len(rows)
@@ -0,0 +1,135 @@
+# 同時製造のストレステスト
+#
+# 複数のプロセスから同じレシピの製造 (/manufacture, /produce, /manufacture_batch) を同時に繰り返し、
+# 在庫が足りなくなるまで材料を取り合う。終わった後に以下を確認する。
+#   - 在庫 (quantity_base) が負になったロットがない
+#   - 成功した製造の数 x レシピの使用量 = 減った在庫 = 台帳 (stock_movements) の払い出しの合計
+#   - 500 エラー ("database is locked" など) が1件もない
+# スループット (成功した製造の数/秒) も出力する。問題があれば終了コード 1 を返す。
+#
+#   python stress_manufacture.py [--workers 8] [--attempts 200]
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKERS = 8
+ATTEMPTS = 200          # プロセスごとの製造の回数
+LOTS = 5                # 材料ごとのロットの数
+LOT_GRAMS = 200         # 1ロットの量 (g / ml)
+RECIPE = [('Sugar', 7, 'g'), ('Syrup', 5, 'ml'), ('Salt', 1, 'g')]   # 1回の製造で使う量
+
+
+# 材料のロットと1つのレシピだけのデータベースを作る。戻り値はレシピのID
+def setup(path):
+    sys.path.insert(0, BASE_DIR)
+    import db
+    import units
+    db.migrate(path)
+    conn = sqlite3.connect(path)
+    recipe_id = conn.execute("INSERT INTO recipes (drink_name) VALUES ('Stress Drink')").lastrowid
+    for name, quantity, unit in RECIPE:
+        conn.execute("INSERT INTO ingredients (recipe_id, ingredient_name, quantity, unit, quantity_base) VALUES (?, ?, ?, ?, ?)",
+                     (recipe_id, name, quantity, unit, units.to_base(quantity, unit)))
+        for n in range(LOTS):
+            conn.execute("INSERT INTO inventory (product_name, lot_number, quantity, unit, received_date, quantity_base) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (name, f'{name}-{n}', LOT_GRAMS, unit, f'2024-01-{n + 1:02d}',
+                                                       units.to_base(LOT_GRAMS, unit)))
+    conn.commit()
+    conn.close()
+    return recipe_id
+
+
+def worker(args):
+    path, recipe_id, attempts, index = args
+    sys.path.insert(0, BASE_DIR)
+    import app as appmod
+    workdir = os.path.dirname(path)
+    app = appmod.create_app({'DATABASE': path, 'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+                             'JOB_FOLDER': os.path.join(workdir, 'job_results'),
+                             'START_BACKGROUND_THREADS': False, 'PRECOMPILE_TEMPLATES': False})
+    client = app.test_client()
+    form = {'drink_name': 'Stress Drink', 'manufacture_date': '2024-01-01', 'expiration_date': '2099-01-01',
+            'produced_quantity': '1', 'produced_unit': 'L', 'lot_number': [''] * len(RECIPE), 'quantity': [''] * len(RECIPE)}
+    statuses = Counter()
+    for n in range(attempts):
+        # 3種類の製造の方法を順番に使う (どれも同じ量を使う)
+        kind = (n + index) % 3
+        if kind == 0:
+            response = client.post(f'/manufacture/{recipe_id}', data=form)
+        elif kind == 1:
+            response = client.post(f'/produce/{recipe_id}')
+        else:
+            response = client.post('/manufacture_batch', json={'manufacture_date': '2024-01-01', 'expiration_date': '2099-01-01',
+                                                               'batches': [{'recipe_id': recipe_id, 'batches': 1}]})
+        statuses[(kind, response.status_code)] += 1
+    return statuses
+
+
+def check(path, succeeded):
+    sys.path.insert(0, BASE_DIR)
+    import units
+    conn = sqlite3.connect(path)
+    problems = []
+    negative = conn.execute("SELECT COUNT(*) FROM inventory WHERE quantity_base < 0").fetchone()[0]
+    if negative:
+        problems.append(f'{negative} lots have a negative balance')
+    for name, quantity, unit in RECIPE:
+        remaining = conn.execute("SELECT TOTAL(quantity_base) FROM inventory WHERE product_name = ?", (name,)).fetchone()[0]
+        used = LOTS * units.to_base(LOT_GRAMS, unit) - remaining
+        expected = succeeded * units.to_base(quantity, unit)
+        ledger = -conn.execute("SELECT TOTAL(delta) FROM stock_movements WHERE product_name = ? AND delta < 0",
+                               (name,)).fetchone()[0]
+        if used != expected or ledger != expected:
+            problems.append(f'{name}: {succeeded} successful runs should use {expected}, '
+                            f'inventory went down by {used:.0f} and the ledger records {ledger:.0f}')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manufacture concurrently and check that stock never goes negative')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--attempts', type=int, default=ATTEMPTS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'inventory.db')
+        recipe_id = setup(path)
+        start = time.perf_counter()
+        with multiprocessing.get_context('spawn').Pool(args.workers) as pool:
+            results = pool.map(worker, [(path, recipe_id, args.attempts, index) for index in range(args.workers)])
+        elapsed = time.perf_counter() - start
+
+        statuses = Counter()
+        for result in results:
+            statuses.update(result)
+        # /manufacture と /produce は成功すると 302、/manufacture_batch は 200
+        succeeded = sum(count for (kind, status), count in statuses.items() if status in (200, 302))
+        errors = sum(count for (kind, status), count in statuses.items() if status >= 500)
+        problems = check(path, succeeded)
+        if errors:
+            problems.append(f'{errors} requests failed with a server error')
+        possible = min(LOTS * LOT_GRAMS // quantity for name, quantity, unit in RECIPE)
+        if succeeded != min(possible, args.workers * args.attempts):
+            problems.append(f'{succeeded} runs succeeded but the stock allows {possible}')
+
+    kinds = ['manufacture', 'produce', 'manufacture_batch']
+    print(json.dumps({
+        'workers': args.workers, 'attempts': args.workers * args.attempts, 'succeeded': succeeded,
+        'possible': possible, 'seconds': round(elapsed, 2),
+        'requests_per_second': round(args.workers * args.attempts / elapsed, 1),
+        'manufactures_per_second': round(succeeded / elapsed, 1),
+        'statuses': {f'{kinds[kind]} {status}': count for (kind, status), count in sorted(statuses.items())},
+        'problems': problems,
+    }, indent=2))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+# 単位の換算
+#
+# 数量はすべて整数の基本単位 (質量はミリグラム、体積はマイクロリットル) で保存し、
+# 画面に表示するときだけ入力された単位に戻す。
+# 'lbs_oz' はポンドとオンスを合計したオンス数で入力されるので、換算係数は oz と同じ。
+import math
+
+MASS = 'mass'
+VOLUME = 'volume'
+
+# 単位 -> (種類, 1単位あたりの基本単位の量)
+UNITS = {
+    'g': (MASS, 1000),
+    'kg': (MASS, 1000000),
+    'oz': (MASS, 28349.523125),
+    'lbs': (MASS, 453592.37),
+    'lbs_oz': (MASS, 28349.523125),
+    'ml': (VOLUME, 1000),
+    'L': (VOLUME, 1000000),
+}
+
+# 合計などを表示するときの単位
+DISPLAY_UNITS = {MASS: 'g', VOLUME: 'ml'}
+
+
+def is_valid(unit):
+    return unit in UNITS
+
+
+def dimension(unit):
+    return UNITS[unit][0]
+
+
+def factor(unit):
+    return UNITS[unit][1]
+
+
+def same_dimension(unit_a, unit_b):
+    return dimension(unit_a) == dimension(unit_b)
+
+
+# SQLite の INTEGER に保存できる最大の値
+MAX_BASE = 2 ** 63 - 1
+
+
+# 数量を基本単位の整数に変換する。知らない単位や、nan / inf など保存できない数量は ValueError
+def to_base(quantity, unit):
+    if unit not in UNITS:
+        raise ValueError(f'Unknown unit: {unit}')
+    quantity = float(quantity)
+    if not math.isfinite(quantity) or abs(quantity * UNITS[unit][1]) > MAX_BASE:
+        raise ValueError(f'Invalid quantity: {quantity}')
+    return round(quantity * UNITS[unit][1])
+
+
+def from_base(base_quantity, unit):
+    return base_quantity / UNITS[unit][1]
+
+
+# 同じ単位の数量をまとめて変換する (グラフなどで多くの行を読み込む場合)
+def from_base_many(base_quantities, unit):
+    scale = 1 / UNITS[unit][1]
+    return [value * scale for value in base_quantities]
+
+
+# 基本単位の数量を合計用の単位 (g / ml) で返す
+def to_display(base_quantity, unit_dimension):
+    return base_quantity / UNITS[DISPLAY_UNITS[unit_dimension]][1]
+
+
+# 基本単位から戻した表示用の数量を丸める桁数。1基本単位より細かい桁は換算の誤差なので捨てる
+# (g は 3 桁、oz は 4 桁、kg は 6 桁)
+def display_decimals(unit):
+    return int(math.log10(UNITS[unit][1]))
+
+
+# Lbs & Oz の数量 (オンス数) を (ポンド, オンス) に分ける
+def split_lbs_oz(quantity):
+    lbs = int(quantity // 16)
+    return lbs, round(quantity - lbs * 16, display_decimals('lbs_oz'))
+